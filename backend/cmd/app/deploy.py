@@ -0,0 +1,348 @@
+import asyncio
+import fcntl
+import os
+import signal
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+# The repository checkout; in the backend image this is / and the scripts
+# are not there, so AUTOKUBE_SCRIPTS_DIR has to point at them
+ROOT_DIR = Path(__file__).resolve().parents[3]
+SCRIPTS_DIR = Path(os.getenv("AUTOKUBE_SCRIPTS_DIR", ROOT_DIR / "scripts"))
+LOGS_DIR = Path(os.getenv("AUTOKUBE_LOGS_DIR", ROOT_DIR / "logs"))
+
+MAX_CONCURRENT_DEPLOYMENTS = int(os.getenv("DEPLOY_CONCURRENCY", "10"))
+LOG_TAIL_LINES = int(os.getenv("DEPLOY_LOG_TAIL_LINES", "5000"))
+# ansible -v can print single result lines far above asyncio's 64 KiB default
+STREAM_LIMIT = 16 * 1024 * 1024
+# Seconds a stage gets to exit after SIGTERM before its process group is killed
+KILL_GRACE = float(os.getenv("DEPLOY_KILL_GRACE", "10"))
+# Finished deployments are kept for DEPLOY_RETENTION seconds, at most DEPLOY_HISTORY of them
+RETENTION = int(os.getenv("DEPLOY_RETENTION", "86400"))
+HISTORY = int(os.getenv("DEPLOY_HISTORY", "100"))
+
+# Per-stage timeouts in seconds; 0 disables the timeout
+STAGE_TIMEOUTS = {
+    "venv": int(os.getenv("DEPLOY_TIMEOUT_VENV", "900")),
+    "inventory": int(os.getenv("DEPLOY_TIMEOUT_INVENTORY", "300")),
+    "ansible": int(os.getenv("DEPLOY_TIMEOUT_ANSIBLE", "7200")),
+    "application": int(os.getenv("DEPLOY_TIMEOUT_APPLICATION", "1800")),
+}
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+SKIPPED = "skipped"
+
+FINISHED_STATES = {SUCCEEDED, FAILED, CANCELLED}
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+@dataclass
+class Stage:
+    name: str
+    # A callable is resolved when the stage starts, after earlier stages ran
+    argv: object
+    cwd: Path = SCRIPTS_DIR
+    timeout: int = 0
+
+
+@dataclass
+class StageResult:
+    name: str
+    status: str = QUEUED
+    returncode: int = None
+    started_at: datetime = None
+    finished_at: datetime = None
+
+
+@dataclass
+class Deployment:
+    cluster_id: str
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    error: str = None
+    created_at: datetime = field(default_factory=_now)
+    started_at: datetime = None
+    finished_at: datetime = None
+    stages: list = field(default_factory=list)
+    log_offset: int = 0
+    log: deque = field(default_factory=lambda: deque(maxlen=LOG_TAIL_LINES))
+    task: asyncio.Task = field(default=None, repr=False)
+    log_file: object = field(default=None, repr=False)
+    # The venv the venv stage linked, pinned by a shared lock until the deployment finishes
+    venv_dir: Path = None
+    venv_lock: object = field(default=None, repr=False)
+
+    @property
+    def current_stage(self):
+        return next((s.name for s in self.stages if s.status == RUNNING), None)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "cluster_id": self.cluster_id,
+            "status": self.status,
+            "current_stage": self.current_stage,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stages": [vars(s) for s in self.stages],
+        }
+
+
+def inventory_path(cluster_id):
+    # myscript.py writes hosts.json instead when INVENTORY_FORMAT=json
+    inventory_dir = Path("inventory") / cluster_id
+    if (SCRIPTS_DIR / "kubespray" / inventory_dir / "hosts.json").exists():
+        return str(inventory_dir / "hosts.json")
+    return str(inventory_dir / "hosts.yaml")
+
+
+def build_stages(cluster_id, nextauth_url, venv_dir=None):
+    # Later stages run from the venv the venv stage picked, not from the
+    # scripts/venv link a concurrent deployment may point elsewhere
+    venv = venv_dir or (lambda: SCRIPTS_DIR / "venv")
+    return [
+        # No-op unless requirements.txt or the interpreter changed
+        Stage("venv", ["python3", str(SCRIPTS_DIR / "venv_manager.py")],
+              timeout=STAGE_TIMEOUTS["venv"]),
+        Stage("inventory", lambda: [str(venv() / "bin" / "python"), str(SCRIPTS_DIR / "myscript.py"),
+                                    nextauth_url, cluster_id],
+              timeout=STAGE_TIMEOUTS["inventory"]),
+        Stage("ansible", lambda: [str(venv() / "bin" / "ansible-playbook"),
+                                  "-i", inventory_path(cluster_id), "cluster.yml", "-b", "-v"],
+              cwd=SCRIPTS_DIR / "kubespray", timeout=STAGE_TIMEOUTS["ansible"]),
+        Stage("application", lambda: [str(venv() / "bin" / "python"), str(SCRIPTS_DIR / "application.py"),
+                                      nextauth_url, cluster_id],
+              timeout=STAGE_TIMEOUTS["application"]),
+    ]
+
+
+class DeployEngine:
+    """
+    Queue of cluster deployments executed by a fixed pool of asyncio workers.
+
+    The worker count is the global concurrency cap; each deployment runs its
+    stages as asyncio subprocesses and appends their output both to an
+    in-memory tail and to logs/deploy-<cluster_id>.log, the file the
+    dashboard's socket server replays to clients.
+    """
+
+    def __init__(self, nextauth_url, concurrency=MAX_CONCURRENT_DEPLOYMENTS):
+        self.nextauth_url = nextauth_url.rstrip("/")
+        self.concurrency = max(1, concurrency)
+        self.deployments = {}
+        self._queue = asyncio.Queue()
+        self._workers = []
+
+    async def start(self):
+        if not SCRIPTS_DIR.is_dir():
+            raise RuntimeError(
+                f"Scripts directory {SCRIPTS_DIR} not found; "
+                "set AUTOKUBE_SCRIPTS_DIR to the checkout's scripts directory"
+            )
+        LOGS_DIR.mkdir(parents=True, exist_ok=True)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for deployment in self.deployments.values():
+            if deployment.status not in FINISHED_STATES:
+                await self.cancel(deployment.id)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def active_for_cluster(self, cluster_id):
+        return next(
+            (d for d in self.deployments.values()
+             if d.cluster_id == cluster_id and d.status not in FINISHED_STATES),
+            None,
+        )
+
+    def submit(self, cluster_id):
+        if self.active_for_cluster(cluster_id):
+            raise ValueError(f"Deployment already running for cluster {cluster_id}")
+
+        self._prune()
+        deployment = Deployment(cluster_id=cluster_id)
+        deployment.stages = [StageResult(s.name) for s in build_stages(cluster_id, self.nextauth_url)]
+        self.deployments[deployment.id] = deployment
+        self._queue.put_nowait(deployment)
+        self._log(deployment, "📦 Deployment queued")
+        return deployment
+
+    async def cancel(self, deployment_id):
+        deployment = self.deployments[deployment_id]
+        if deployment.status in FINISHED_STATES:
+            return deployment
+
+        if deployment.task is None:
+            # Still waiting in the queue; the worker drops it when dequeued
+            self._finish(deployment, CANCELLED)
+        else:
+            deployment.task.cancel()
+            await asyncio.gather(deployment.task, return_exceptions=True)
+        return deployment
+
+    def logs(self, deployment_id, offset=0):
+        deployment = self.deployments[deployment_id]
+        skip = max(0, offset - deployment.log_offset)
+        lines = list(deployment.log)[skip:]
+        return lines, deployment.log_offset + len(deployment.log)
+
+    async def _worker(self):
+        while True:
+            deployment = await self._queue.get()
+            try:
+                if deployment.status == QUEUED:
+                    deployment.task = asyncio.create_task(self._run(deployment))
+                    await asyncio.gather(deployment.task, return_exceptions=True)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, deployment):
+        deployment.status = RUNNING
+        deployment.started_at = _now()
+        self._log(deployment, "🚀 Deployment started")
+
+        try:
+            stages = build_stages(deployment.cluster_id, self.nextauth_url, lambda: deployment.venv_dir)
+            for stage, result in zip(stages, deployment.stages):
+                returncode = await self._run_stage(deployment, stage, result)
+                if returncode != 0:
+                    self._finish(deployment, FAILED, f"Stage {stage.name} failed (code {returncode})")
+                    return
+                if stage.name == "venv":
+                    self._pin_venv(deployment)
+            self._finish(deployment, SUCCEEDED)
+        except asyncio.CancelledError:
+            self._finish(deployment, CANCELLED)
+            raise
+        except Exception as e:
+            self._finish(deployment, FAILED, str(e))
+
+    async def _run_stage(self, deployment, stage, result):
+        result.status = RUNNING
+        result.started_at = _now()
+        argv = stage.argv() if callable(stage.argv) else stage.argv
+        self._log(deployment, f"🧰 [{stage.name}] {' '.join(argv)}")
+
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            cwd=stage.cwd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
+            limit=STREAM_LIMIT,
+        )
+        try:
+            await asyncio.wait_for(self._pump(deployment, stage.name, proc), stage.timeout or None)
+        except asyncio.TimeoutError:
+            await self._kill(proc)
+            result.status = FAILED
+            result.returncode = proc.returncode
+            result.finished_at = _now()
+            self._log(deployment, f"⏱️ [{stage.name}] timed out after {stage.timeout}s")
+            return proc.returncode or -1
+        except asyncio.CancelledError:
+            await self._kill(proc)
+            result.status = CANCELLED
+            result.returncode = proc.returncode
+            result.finished_at = _now()
+            self._log(deployment, f"🛑 [{stage.name}] killed")
+            raise
+
+        result.returncode = proc.returncode
+        result.status = SUCCEEDED if proc.returncode == 0 else FAILED
+        result.finished_at = _now()
+        self._log(deployment, f"{'✅' if proc.returncode == 0 else '❌'} [{stage.name}] finished (code {proc.returncode})")
+        return proc.returncode
+
+    def _pin_venv(self, deployment):
+        """Hold a shared lock on the linked venv so venv_manager.py does not prune it while in use."""
+        venv_dir = (SCRIPTS_DIR / "venv").resolve()
+        lock = open(venv_dir.parent / f"{venv_dir.name}.lock", "w")
+        try:
+            # An exclusive holder is removing or rebuilding it right now
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise RuntimeError(f"Virtual environment {venv_dir.name} is being removed or rebuilt")
+        if not (venv_dir / "bin" / "python").exists():
+            lock.close()
+            raise RuntimeError(f"Virtual environment {venv_dir} is missing")
+        deployment.venv_dir = venv_dir
+        deployment.venv_lock = lock
+        self._log(deployment, f"📌 Using virtual environment {venv_dir.name}")
+
+    async def _pump(self, deployment, prefix, proc):
+        async for raw in proc.stdout:
+            self._log(deployment, f"[{prefix}] {raw.decode(errors='replace').rstrip()}")
+        await proc.wait()
+
+    @staticmethod
+    async def _kill(proc):
+        # Stages run in their own session so ansible's forks die with them;
+        # whatever ignores SIGTERM gets SIGKILL after KILL_GRACE seconds
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+            try:
+                await asyncio.wait_for(asyncio.shield(proc.wait()), KILL_GRACE)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    def _prune(self):
+        finished = sorted(
+            (d for d in self.deployments.values() if d.status in FINISHED_STATES),
+            key=lambda d: d.finished_at,
+        )
+        cutoff = _now().timestamp() - RETENTION
+        expired = [d for d in finished if d.finished_at.timestamp() < cutoff]
+        expired += finished[len(expired):max(len(expired), len(finished) - HISTORY)]
+        for deployment in expired:
+            del self.deployments[deployment.id]
+
+    def _finish(self, deployment, status, error=None):
+        deployment.status = status
+        deployment.error = error
+        deployment.finished_at = _now()
+        if status != SUCCEEDED:
+            # Stages after a failure never run; a cancel cancels them
+            for result in deployment.stages:
+                if result.status == QUEUED:
+                    result.status = CANCELLED if status == CANCELLED else SKIPPED
+        if deployment.venv_lock:
+            deployment.venv_lock.close()
+            deployment.venv_lock = None
+        self._log(deployment, f"🏁 Deployment {status}" + (f": {error}" if error else ""))
+        if deployment.log_file:
+            deployment.log_file.close()
+            deployment.log_file = None
+
+    def _log(self, deployment, line):
+        if len(deployment.log) == deployment.log.maxlen:
+            deployment.log_offset += 1
+        deployment.log.append(line)
+        if deployment.log_file is not None and os.fstat(deployment.log_file.fileno()).st_nlink == 0:
+            # The dashboard's "Clear Logs" removed the file
+            deployment.log_file.close()
+            deployment.log_file = None
+        if deployment.log_file is None:
+            deployment.log_file = open(LOGS_DIR / f"deploy-{deployment.cluster_id}.log", "a", buffering=1)
+        deployment.log_file.write(line + "\n")
@@ -1,8 +1,27 @@
-from fastapi import FastAPI
+import os
+import secrets
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
 import uvicorn
 
-app = FastAPI()
+from deploy import DeployEngine
+
+engine = DeployEngine(os.getenv("NEXTAUTH_URL", "http://localhost:3000"))
+# Shared with the dashboard; required to start or cancel deployments
+API_TOKEN = os.getenv("INTERNAL_API_TOKEN")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await engine.start()
+    yield
+    await engine.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -13,10 +32,65 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+class DeploymentRequest(BaseModel):
+    cluster_id: str
+
+
+def require_token(authorization: str = Header(None)):
+    if not API_TOKEN:
+        raise HTTPException(status_code=503, detail="INTERNAL_API_TOKEN is not set")
+    if not authorization or not secrets.compare_digest(authorization, f"Bearer {API_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Unauthorized", headers={"WWW-Authenticate": "Bearer"})
+
+
+def get_deployment(deployment_id):
+    deployment = engine.deployments.get(deployment_id)
+    if not deployment:
+        raise HTTPException(status_code=404, detail="Deployment not found")
+    return deployment
+
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the FastAPI application!"}
 
 
+@app.post("/deployments", status_code=202, dependencies=[Depends(require_token)])
+def create_deployment(body: DeploymentRequest):
+    try:
+        deployment = engine.submit(body.cluster_id)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return deployment.to_dict()
+
+
+@app.get("/deployments")
+def list_deployments(cluster_id: str = None):
+    return [
+        d.to_dict() for d in engine.deployments.values()
+        if cluster_id is None or d.cluster_id == cluster_id
+    ]
+
+
+@app.get("/deployments/{deployment_id}")
+def read_deployment(deployment_id: str):
+    return get_deployment(deployment_id).to_dict()
+
+
+@app.get("/deployments/{deployment_id}/logs")
+def read_deployment_logs(deployment_id: str, offset: int = 0):
+    deployment = get_deployment(deployment_id)
+    lines, next_offset = engine.logs(deployment_id, offset)
+    return {"lines": lines, "next_offset": next_offset, "status": deployment.status}
+
+
+@app.delete("/deployments/{deployment_id}", dependencies=[Depends(require_token)])
+async def cancel_deployment(deployment_id: str):
+    get_deployment(deployment_id)
+    deployment = await engine.cancel(deployment_id)
+    return deployment.to_dict()
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
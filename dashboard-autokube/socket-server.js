@@ -1,14 +1,39 @@
-const { spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs');
 
 const { Server } = require('socket.io');
 
 let io = null;
-const runningProcesses = {}; // { clusterId: { py, ansible, app } }
+const followers = {}; // { clusterId: deploymentId } whose logs are relayed to the room
 
 require('dotenv').config({ path: path.resolve(__dirname, '../dashboard-autokube/.env') });
 
+// Deployments run in the FastAPI backend (backend/cmd/app/deploy.py); this
+// server only starts, cancels and relays them
+const BACKEND_URL = (process.env.AUTOKUBE_BACKEND_URL || 'http://localhost:8000').replace(/\/$/, '');
+const LOG_POLL_MS = 1000;
+const FINISHED_STATES = new Set(['succeeded', 'failed', 'cancelled']);
+
+async function backend(pathname, options = {}) {
+  const res = await fetch(`${BACKEND_URL}${pathname}`, {
+    ...options,
+    headers: {
+      'Content-Type': 'application/json',
+      Authorization: `Bearer ${process.env.INTERNAL_API_TOKEN}`,
+    },
+  });
+  const body = await res.json().catch(() => ({}));
+  if (!res.ok) {
+    throw new Error(body.detail || `${res.status} ${res.statusText}`);
+  }
+  return body;
+}
+
+async function activeDeployment(clusterId) {
+  const deployments = await backend(`/deployments?cluster_id=${encodeURIComponent(clusterId)}`);
+  return deployments.find((d) => !FINISHED_STATES.has(d.status));
+}
+
 function initializeSocket(server) {
   if (io) return io;
 
@@ -25,33 +50,42 @@ function initializeSocket(server) {
     },
   });
 
-  function logAndEmit(clusterId, msg) {
-    const clean = msg.toString().replace(/\r?\n$/, '');
-    const logFilePath = path.join(__dirname, '..', 'logs', `deploy-${clusterId}.log`);
-    fs.mkdirSync(path.dirname(logFilePath), { recursive: true });
-    fs.appendFileSync(logFilePath, clean + '\n');
-    io.to(clusterId).emit('log', clean);
+  function logPath(clusterId) {
+    return path.join(__dirname, '..', 'logs', `deploy-${clusterId}.log`);
   }
 
-  function attachProcessListeners(clusterId, proc, prefix) {
-    if (proc.__listenersAttached) return;
-
-    proc.stdout.on('data', (data) => {
-      logAndEmit(clusterId, `[${prefix}] ${data}`);
-    });
-
-    proc.stderr.on('data', (data) => {
-      logAndEmit(clusterId, `[${prefix} stderr] ${data}`);
-    });
-
-    proc.__listenersAttached = true;
+  // The backend writes the log file; new lines are relayed from its log endpoint.
+  // A newer deployment of the cluster takes over from the one still followed.
+  async function follow(clusterId, deploymentId, offset) {
+    if (followers[clusterId] === deploymentId) return;
+    followers[clusterId] = deploymentId;
+
+    try {
+      let finished = false;
+      while (followers[clusterId] === deploymentId) {
+        const res = await backend(`/deployments/${deploymentId}/logs?offset=${offset}`);
+        if (followers[clusterId] !== deploymentId) break;
+        res.lines.forEach((line) => io.to(clusterId).emit('log', line));
+        offset = res.next_offset;
+        // One more read after the deployment finished picks up its last lines
+        if (finished) break;
+        finished = FINISHED_STATES.has(res.status);
+        await new Promise((resolve) => setTimeout(resolve, LOG_POLL_MS));
+      }
+    } catch (err) {
+      if (followers[clusterId] === deploymentId) {
+        io.to(clusterId).emit('log', `❌ Lost the deployment log: ${err.message}`);
+      }
+    } finally {
+      if (followers[clusterId] === deploymentId) delete followers[clusterId];
+    }
   }
 
   io.on('connection', (socket) => {
     console.log('✅ Client connected');
 
-    socket.on('request-logs', (clusterId) => {
-      const logFilePath = path.join(__dirname, '..', 'logs', `deploy-${clusterId}.log`);
+    socket.on('request-logs', async (clusterId) => {
+      const logFilePath = logPath(clusterId);
       if (fs.existsSync(logFilePath)) {
         const logs = fs.readFileSync(logFilePath, 'utf8').split('\n').filter(Boolean);
         logs.forEach((line) => socket.emit('log', line));
@@ -60,184 +94,48 @@ function initializeSocket(server) {
       socket.join(clusterId);
       socket.data.clusterId = clusterId;
 
-      const running = runningProcesses[clusterId];
-      if (running?.py) socket.emit('log', '📡 Re-attached to running Python script...');
-      if (running?.ansible) socket.emit('log', '📡 Re-attached to running Ansible...');
-      if (running?.app) socket.emit('log', '📡 Re-attached to running application...');
+      try {
+        const running = await activeDeployment(clusterId);
+        if (running) {
+          socket.emit('log', `📡 Re-attached to running deployment (${running.current_stage || running.status})...`);
+          // Continue from the end of what the file replay already sent
+          follow(clusterId, running.id, Number.MAX_SAFE_INTEGER);
+        }
+      } catch (err) {
+        socket.emit('log', `⚠️ Could not reach the deployment backend: ${err.message}`);
+      }
     });
 
-    socket.on('run-script', (clusterId) => {
+    socket.on('run-script', async (clusterId) => {
       if (!clusterId) return;
 
-      if (runningProcesses[clusterId]) {
-        socket.emit('log', `⚠️ Deployment already running for cluster ${clusterId}`);
-        return;
-      }
-
-      logAndEmit(clusterId, '📦 Starting deployment...');
-
-      const basePath = path.resolve(__dirname, '../scripts');
-      const venvPath = path.join(basePath, 'venv');
-      const pythonPath = fs.existsSync(path.join(venvPath, 'bin/python3'))
-        ? path.join(venvPath, 'bin/python3')
-        : path.join(venvPath, 'bin/python');
-      const pipPath = path.join(venvPath, 'bin/pip3');
-      const requirementsPath = path.join(basePath, 'kubespray/requirements.txt');
-
-      if (!fs.existsSync(venvPath)) {
-        logAndEmit(clusterId, '📦 Creating virtual environment...');
-        const venv = spawn('python3', ['-m', 'venv', venvPath]);
-        attachProcessListeners(clusterId, venv, 'venv');
-
-        venv.on('close', (code) => {
-          if (code !== 0) {
-            logAndEmit(clusterId, `❌ Failed to create venv (code ${code})`);
-            delete runningProcesses[clusterId];
-            return;
-          }
-          installDeps();
+      try {
+        const deployment = await backend('/deployments', {
+          method: 'POST',
+          body: JSON.stringify({ cluster_id: clusterId }),
         });
-      } else {
-        logAndEmit(clusterId, '✅ Virtual environment exists.');
-        installDeps();
+        follow(clusterId, deployment.id, 0);
+      } catch (err) {
+        socket.emit('log', `⚠️ ${err.message}`);
       }
+    });
 
-      function installDeps() {
-        if (!fs.existsSync(pipPath)) {
-          logAndEmit(clusterId, '⚠️ pip not found. Installing using ensurepip...');
-          const ensure = spawn(pythonPath, ['-m', 'ensurepip']);
-          attachProcessListeners(clusterId, ensure, 'ensurepip');
-
-          ensure.on('close', (code) => {
-            if (code !== 0) {
-              logAndEmit(clusterId, `❌ ensurepip failed (code ${code})`);
-              delete runningProcesses[clusterId];
-              return;
-            }
-
-            const upgrade = spawn(pipPath, ['install', '--upgrade', 'pip']);
-            attachProcessListeners(clusterId, upgrade, 'pip-upgrade');
-
-            upgrade.on('close', () => installDeps());
-          });
-
+    socket.on('kill-script', async (clusterId) => {
+      try {
+        const running = await activeDeployment(clusterId);
+        if (!running) {
+          socket.emit('log', `⚠️ No running script for cluster ${clusterId}`);
           return;
         }
-
-        const pip = spawn(pipPath, ['install', '-r', requirementsPath]);
-        attachProcessListeners(clusterId, pip, 'pip');
-
-        pip.on('close', (code) => {
-          if (code !== 0) {
-            logAndEmit(clusterId, `❌ Pip install failed (code ${code})`);
-            delete runningProcesses[clusterId];
-            return;
-          }
-
-          logAndEmit(clusterId, '📦 Dependencies installed.');
-          runPython();
-        });
-      }
-
-      function runPython() {
-        const pyScript = path.resolve(__dirname, '../scripts/myscript.py');
-        const nextAuthUrl = process.env.NEXTAUTH_URL;
-        const python = path.join(venvPath, 'bin/python');
-
-        const py = spawn(python, [pyScript, nextAuthUrl, clusterId]);
-        runningProcesses[clusterId] = { py };
-
-        attachProcessListeners(clusterId, py, 'python');
-        logAndEmit(clusterId, `🐍 Python script started: ${python} ${pyScript}`);
-
-        py.on('error', (err) => {
-          logAndEmit(clusterId, `❌ Failed to start Python process: ${err.message}`);
-          delete runningProcesses[clusterId];
-        });
-
-        py.on('close', (code) => {
-          logAndEmit(clusterId, `🐍 Python script finished (code ${code})`);
-          runAnsible();
-        });
-      }
-
-      function runAnsible() {
-        logAndEmit(clusterId, `🧰 Starting Ansible...`);
-
-        const ansiblePlaybookPath = path.join(venvPath, 'bin/ansible-playbook');
-        const inventoryPath = path.join('inventory', clusterId, 'hosts.yaml');
-        const playbookPath = 'cluster.yml';
-        const workingDir = path.join(basePath, 'kubespray');
-
-        const ansible = spawn(
-          ansiblePlaybookPath,
-          ['-i', inventoryPath, playbookPath, '-b', '-v'],
-          {
-            cwd: workingDir,
-          },
-        );
-
-        runningProcesses[clusterId].ansible = ansible;
-        attachProcessListeners(clusterId, ansible, 'ansible');
-
-        ansible.on('error', (err) => {
-          logAndEmit(clusterId, `❌ Failed to start Ansible: ${err.message}`);
-        });
-
-        ansible.on('close', (code) => {
-          logAndEmit(clusterId, `✅ Ansible finished (code ${code})`);
-          runInstallApp();
-        });
-      }
-
-      function runInstallApp() {
-        logAndEmit(clusterId, `🧰 Starting Install Application Script...`);
-
-        const appScript = path.resolve(__dirname, '../scripts/application.py');
-        const python = path.join(venvPath, 'bin/python');
-        const app = spawn(python, [appScript, process.env.NEXTAUTH_URL, clusterId]);
-
-        runningProcesses[clusterId].app = app;
-        attachProcessListeners(clusterId, app, 'python');
-
-        app.on('error', (err) => {
-          logAndEmit(clusterId, `❌ Failed to start App installer: ${err.message}`);
-        });
-
-        app.on('close', (code) => {
-          logAndEmit(clusterId, `🐍 Application installer finished (code ${code})`);
-          delete runningProcesses[clusterId];
-        });
-      }
-    });
-
-    socket.on('kill-script', (clusterId) => {
-      const processes = runningProcesses[clusterId];
-      if (!processes) {
-        socket.emit('log', `⚠️ No running script for cluster ${clusterId}`);
-        return;
-      }
-
-      if (processes.py && !processes.py.killed) {
-        processes.py.kill();
-        socket.emit('log', `🛑 Python script killed`);
-      }
-
-      if (processes.ansible && !processes.ansible.killed) {
-        processes.ansible.kill();
-        socket.emit('log', `🛑 Ansible process killed`);
-      }
-
-      if (processes.app && !processes.app.killed) {
-        processes.app.kill();
-        socket.emit('log', `🛑 App installer killed`);
+        await backend(`/deployments/${running.id}`, { method: 'DELETE' });
+        socket.emit('log', `🛑 Deployment cancelled`);
+      } catch (err) {
+        socket.emit('log', `❌ Failed to cancel the deployment: ${err.message}`);
       }
-
-      delete runningProcesses[clusterId];
     });
 
     socket.on('clear-logs', (clusterId) => {
-      const logFilePath = path.join(__dirname, '..', 'logs', `deploy-${clusterId}.log`);
+      const logFilePath = logPath(clusterId);
       try {
         if (fs.existsSync(logFilePath)) {
           fs.unlinkSync(logFilePath);
@@ -3,6 +3,7 @@ import { prisma } from '@/lib/server';
 import { AuthType, ContainerRuntime, NodeRole } from "@prisma/client";
 import { getServerSession } from "next-auth";
 import { decodeBase64SSHKey, encryptSSHKey , decryptSSHKey } from "@/utils";
+import { createHash } from "crypto";
 
 export async function GET(req: NextRequest) {
     try {
@@ -18,14 +19,17 @@ export async function GET(req: NextRequest) {
 
         const { searchParams } = new URL(req.url);
         const clusterId = searchParams.get("id");
+        // 🎯 Optional relation filter, e.g. ?fields=nodes,clusterApp (scalars are always returned)
+        const fields = searchParams.get("fields")?.split(",").map((f) => f.trim());
+        const wants = (relation: string) => !fields || fields.includes(relation);
 
         // 🔍 If ID is provided, fetch one cluster
         if (clusterId) {
             const cluster = await prisma.clusterProfile.findFirst({
                 where: { id: clusterId },
                 include: {
-                    nodes: true,
-                    clusterConfig: {
+                    nodes: wants("nodes"),
+                    clusterConfig: wants("clusterConfig") ? {
                         include: {
                             helm: true,
                             registry: true,
@@ -34,12 +38,12 @@ export async function GET(req: NextRequest) {
                             k8sCluster: true,
                             globalCluster: true
                         }
-                    },
-                    clusterApp : {
+                    } : false,
+                    clusterApp : wants("clusterApp") ? {
                         include : {
                             kubesphere : true
                         }
-                    }
+                    } : false
                 }
             });
 
@@ -63,7 +67,17 @@ export async function GET(req: NextRequest) {
                 );
             }
 
-            return NextResponse.json(cluster, { status: 200 });
+            // 🏷️ ETag lets the dynamic inventory revalidate its cache cheaply
+            const body = JSON.stringify(cluster);
+            const etag = `"${createHash("sha1").update(body).digest("hex")}"`;
+            if (req.headers.get("if-none-match") === etag) {
+                return new NextResponse(null, { status: 304, headers: { ETag: etag } });
+            }
+
+            return new NextResponse(body, {
+                status: 200,
+                headers: { "Content-Type": "application/json", ETag: etag },
+            });
         }
 
         // 🧾 Otherwise, fetch all clusters
@@ -0,0 +1,225 @@
+"""
+Pluggable Helm application installer used by application.py.
+
+Each ClusterApp relation the dashboard knows about maps to an AppSpec.
+Charts are fetched once into a local content-addressed cache, copied to
+the master only when it does not already hold that digest, installed
+without ``helm --wait`` and then watched with ``kubectl rollout status``
+so progress is streamed instead of blocking silently.
+"""
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+import ssh_mux
+
+CHART_CACHE_DIR = Path(os.getenv("AUTOKUBE_CHART_CACHE", Path(__file__).resolve().parent / ".chart-cache"))
+REMOTE_CHART_DIR = ".autokube/charts"
+KUBECONFIG = "$HOME/.kube/config"
+LINE_LIMIT = 8192
+TAIL_LINES = int(os.getenv("APP_LOG_TAIL_LINES", "50"))
+
+
+@dataclass(frozen=True)
+class AppSpec:
+    name: str
+    release: str
+    namespace: str
+    chart_url: str
+    # Workloads whose rollout marks the app as ready
+    workloads: tuple
+    helm_args: tuple = ()
+
+
+# Keyed by the ClusterApp relation name returned by /api/clusters
+APPS = {
+    "kubesphere": AppSpec(
+        name="KubeSphere",
+        release="ks-core",
+        namespace="kubesphere-system",
+        chart_url="https://charts.kubesphere.io/main/ks-core-1.1.4.tgz",
+        workloads=("deployment/ks-apiserver", "deployment/ks-console", "deployment/ks-controller-manager"),
+    ),
+}
+
+
+def enabled_apps(cluster_app):
+    cluster_app = cluster_app or {}
+    return [(key, spec) for key, spec in APPS.items() if (cluster_app.get(key) or {}).get("enabled")]
+
+
+def stream(argv, prefix, timeout=None):
+    """
+    Run argv and print its combined output as it arrives, timestamped.
+
+    Lines are read through a fixed-size buffer (longer ones are split) and
+    only the last TAIL_LINES are kept, so memory stays constant however
+    verbose the command is. Returns (exit code, tail).
+    """
+    tail = deque(maxlen=TAIL_LINES)
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    timer = threading.Timer(timeout, proc.kill) if timeout else None
+    if timer:
+        timer.start()
+    try:
+        while chunk := proc.stdout.readline(LINE_LIMIT):
+            line = chunk.decode(errors="replace").rstrip("\r\n")
+            tail.append(line)
+            print(f"{datetime.now():%H:%M:%S} [{prefix}] {line}", flush=True)
+        return proc.wait(), tail
+    finally:
+        if timer:
+            timer.cancel()
+
+
+def report_failure(prefix, message, tail):
+    # Output of concurrent installs interleaves; repeat this one's tail in one block
+    print(f"[{prefix}] ❌ {message}. Last {len(tail)} lines:", flush=True)
+    for line in tail:
+        print(f"[{prefix}]    {line}", flush=True)
+
+
+class RemoteHost:
+    def __init__(self, cluster_id, ip, user, password=None, key_path=None):
+        self.cluster_id = cluster_id
+        self.target = f"{user}@{ip}"
+        self.password = password
+        self.key_path = key_path
+
+    def _opts(self):
+        opts = ["-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null",
+                *ssh_mux.control_options(self.cluster_id)]
+        if self.key_path:
+            opts += ["-i", str(self.key_path)]
+        return opts
+
+    def _wrap(self, argv):
+        return ["sshpass", "-p", self.password, *argv] if self.password else argv
+
+    def ssh_argv(self, command):
+        return self._wrap(["ssh", *self._opts(), self.target, command])
+
+    def scp_argv(self, local, remote):
+        return self._wrap(["scp", "-q", *self._opts(), str(local), f"{self.target}:{remote}"])
+
+    def sudo(self, command):
+        # command is expanded by the login user's shell before sudo runs it
+        if self.password:
+            return f"echo {shlex.quote(self.password)} | sudo -S {command}"
+        return f"sudo {command}"
+
+    def run(self, command, prefix, timeout=None):
+        return stream(self.ssh_argv(command), prefix, timeout)
+
+    def check(self, command):
+        return subprocess.run(self.ssh_argv(command), capture_output=True).returncode == 0
+
+    def copy(self, local, remote):
+        subprocess.run(self.scp_argv(local, remote), check=True, capture_output=True)
+
+
+class ChartCache:
+    """Charts stored as sha256/<digest>.tgz with a URL -> digest index."""
+
+    def __init__(self, root=CHART_CACHE_DIR):
+        self.root = Path(root)
+        self.blobs = self.root / "sha256"
+        self.index_path = self.root / "index.json"
+        self._lock = threading.Lock()
+
+    def _index(self):
+        try:
+            return json.loads(self.index_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def path(self, digest):
+        return self.blobs / f"{digest}.tgz"
+
+    def get(self, url):
+        """Return (digest, local path), downloading the chart on a cache miss."""
+        with self._lock:
+            digest = self._index().get(url)
+            if digest and self.path(digest).exists():
+                return digest, self.path(digest)
+
+            self.blobs.mkdir(parents=True, exist_ok=True)
+            sha = hashlib.sha256()
+            fd, tmp = tempfile.mkstemp(dir=self.blobs, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f, requests.get(url, stream=True, timeout=(5, 60)) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size=1 << 16):
+                        sha.update(chunk)
+                        f.write(chunk)
+                digest = sha.hexdigest()
+                os.replace(tmp, self.path(digest))
+            except BaseException:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+
+            index = self._index()
+            index[url] = digest
+            tmp_index = self.index_path.with_name("index.json.tmp")
+            tmp_index.write_text(json.dumps(index, indent=2, sort_keys=True))
+            os.replace(tmp_index, self.index_path)
+            return digest, self.path(digest)
+
+
+def stage_chart(host, cache, url):
+    """Make the chart available on the host, copying it only if missing."""
+    digest, local = cache.get(url)
+    remote = f"{REMOTE_CHART_DIR}/{digest}.tgz"
+    if host.check(f"echo '{digest}  {remote}' | sha256sum -c --status"):
+        return remote, False
+    host.check(f"mkdir -p {REMOTE_CHART_DIR}")
+    host.copy(local, remote)
+    return remote, True
+
+
+def prepare_kubeconfig(host):
+    code, tail = host.run(
+        "mkdir -p $HOME/.kube && "
+        + host.sudo(f"install -m 600 -o $(id -u) -g $(id -g) /etc/kubernetes/admin.conf {KUBECONFIG}"),
+        "kubeconfig",
+    )
+    if code != 0:
+        report_failure("kubeconfig", "Copying admin.conf failed", tail)
+    return code == 0
+
+
+def install_app(host, cache, spec, timeout):
+    prefix = spec.release
+    remote_chart, copied = stage_chart(host, cache, spec.chart_url)
+    print(f"[{prefix}] 📦 Chart {'copied to' if copied else 'already on'} master: {remote_chart}", flush=True)
+
+    helm_cmd = " ".join([
+        f"KUBECONFIG={KUBECONFIG}", "helm", "upgrade", "--install", spec.release, remote_chart,
+        "-n", spec.namespace, "--create-namespace", "--debug", *map(shlex.quote, spec.helm_args),
+    ])
+    code, tail = host.run(helm_cmd, prefix, timeout)
+    if code != 0:
+        report_failure(prefix, f"helm upgrade --install failed (code {code})", tail)
+        return False
+
+    rollout_cmd = " && ".join(
+        f"KUBECONFIG={KUBECONFIG} kubectl -n {spec.namespace} rollout status {workload} --timeout={timeout}s"
+        for workload in spec.workloads
+    )
+    code, tail = host.run(rollout_cmd, prefix, timeout + 30)
+    if code != 0:
+        report_failure(prefix, f"{spec.name} did not become ready within {timeout}s", tail)
+        return False
+
+    print(f"[{prefix}] ✅ {spec.name} is ready", flush=True)
+    return True
@@ -1,10 +1,12 @@
 import sys
-import requests
 import os
-import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from pathlib import Path
 
+from app_installer import ChartCache, RemoteHost, enabled_apps, install_app, prepare_kubeconfig
+from api_client import APPLICATION_FIELDS, DashboardClient
+
 # Load env
 env_path = Path(__file__).resolve().parent.parent / "dashboard-autokube" / ".env"
 load_dotenv(dotenv_path=env_path)
@@ -24,60 +26,42 @@ cluster_id = sys.argv[2]
 
 print(f"🚀 Application Installer for cluster {cluster_id}", flush=True)
 
+api = DashboardClient(nextauth_url, api_token)
+
 # Fetch cluster data
 try:
-    headers = { "Authorization": f"Bearer {api_token}" }
-    res = requests.get(f"{nextauth_url}/api/clusters/?id={cluster_id}", headers=headers)
-    res.raise_for_status()
-    cluster_data = res.json()
+    cluster_data = api.get_cluster(cluster_id, fields=APPLICATION_FIELDS)
     print(f"📦 Cluster info fetched", flush=True)
 except Exception as e:
     print(f"❌ Failed to fetch cluster info: {e}", flush=True)
     sys.exit(1)
 
-# Check if KubeSphere is enabled
-app_config = cluster_data.get("clusterApp", {}).get("kubesphere", {})
-if not app_config.get("enabled"):
-    print("ℹ️ KubeSphere is not enabled for this cluster. Skipping...", flush=True)
+# Collect enabled applications
+apps = enabled_apps(cluster_data.get("clusterApp"))
+if not apps:
+    print("ℹ️ No applications are enabled for this cluster. Skipping...", flush=True)
     sys.exit(0)
 
+print(f"🧩 Applications to install: {', '.join(spec.name for _, spec in apps)}", flush=True)
+
 # Get first MASTER node
 nodes = cluster_data.get("nodes", [])
 master_node = next((n for n in nodes if n["role"] == "MASTER"), None)
 
 if not master_node:
-    print("❌ No MASTER node found to install KubeSphere.", flush=True)
+    print("❌ No MASTER node found to install applications.", flush=True)
     sys.exit(1)
 
 ip = master_node["ipAddress"]
 user = master_node["username"]
 auth_type = master_node["authType"]
 password = master_node.get("password")
+key_path = None
 
-# Helm command as single string (for proper remote shell execution)
-helm_cmd = (
-    "mkdir -p $HOME/.kube && "
-    "sudo -S cp -f /etc/kubernetes/admin.conf $HOME/.kube/config && "
-    "sudo chown $(id -u):$(id -g) $HOME/.kube/config && "
-    "KUBECONFIG=$HOME/.kube/config helm upgrade --install -n kubesphere-system "
-    "--create-namespace ks-core https://charts.kubesphere.io/main/ks-core-1.1.4.tgz "
-    "--debug --wait"
-)
-
-# Build full SSH command
 if auth_type == "PASSWORD":
     if not password:
         print("❌ No password provided for SSH", flush=True)
         sys.exit(1)
-
-    ssh_cmd = [
-        "sshpass", "-p", password,
-        "ssh", "-tt",
-        "-o", "StrictHostKeyChecking=no",
-        "-o", "UserKnownHostsFile=/dev/null",
-        f"{user}@{ip}",
-        f"echo '{password}' | sudo -S bash -c \"{helm_cmd}\""
-    ]
 elif auth_type == "SSH_KEY":
     ssh_key = master_node.get("sshKey")
     if not ssh_key:
@@ -88,40 +72,45 @@ elif auth_type == "SSH_KEY":
     with open(key_path, "w") as f:
         f.write(ssh_key)
     os.chmod(key_path, 0o600)
-
-    ssh_cmd = [
-        "ssh", "-tt",
-        "-i", str(key_path),
-        "-o", "StrictHostKeyChecking=no",
-        "-o", "UserKnownHostsFile=/dev/null",
-        f"{user}@{ip}",
-        f"bash -c \"{helm_cmd}\""
-    ]
+    password = None
 else:
     print(f"❌ Unsupported auth type: {auth_type}", flush=True)
     sys.exit(1)
 
-# Run it
-print(f"🚀 Running KubeSphere install on {ip}...", flush=True)
+host = RemoteHost(cluster_id, ip, user, password=password, key_path=key_path)
+chart_cache = ChartCache()
+install_timeout = int(os.getenv("APP_INSTALL_TIMEOUT", "600"))
 
-try:
-    result = subprocess.run(ssh_cmd, check=True, capture_output=True, text=True, timeout=300)
-    combined_output = result.stdout.strip() + "\n" + result.stderr.strip()
-    print(f"✅ KubeSphere installed successfully:\n{combined_output}", flush=True)
-    # Update cluster status to ready
-    try:
-        print("🔄 Marking cluster as ready...", flush=True)
-        res = requests.put(
-            f"{nextauth_url}/api/clusters/?id={cluster_id}",
-            headers={"Authorization": f"Bearer {api_token}"}
-        )
-        res.raise_for_status()
-        print("✅ Cluster status updated to ready", flush=True)
-    except Exception as e:
-        print(f"❌ Failed to update cluster status: {e}", flush=True)
-        sys.exit(1)
+print(f"🔑 Preparing kubeconfig on {ip}...", flush=True)
+if not prepare_kubeconfig(host):
+    print("❌ Failed to prepare kubeconfig on MASTER node", flush=True)
+    sys.exit(1)
+
+# Independent apps install concurrently
+print(f"🚀 Installing {len(apps)} application(s) on {ip}...", flush=True)
+results = {}
+with ThreadPoolExecutor(max_workers=len(apps)) as pool:
+    futures = {pool.submit(install_app, host, chart_cache, spec, install_timeout): spec for _, spec in apps}
+    for future in as_completed(futures):
+        spec = futures[future]
+        try:
+            results[spec.name] = future.result()
+        except Exception as e:
+            print(f"❌ {spec.name} installation failed: {e}", flush=True)
+            results[spec.name] = False
+
+failed = [name for name, ok in results.items() if not ok]
+if failed:
+    print(f"❌ Application installation failed: {', '.join(failed)}", flush=True)
+    sys.exit(1)
 
+print("✅ All applications installed successfully", flush=True)
 
-except subprocess.CalledProcessError as e:
-    print(f"❌ KubeSphere installation failed:\n{e.stderr.strip()}", flush=True)
+# Update cluster status to ready
+try:
+    print("🔄 Marking cluster as ready...", flush=True)
+    api.mark_ready(cluster_id)
+    print("✅ Cluster status updated to ready", flush=True)
+except Exception as e:
+    print(f"❌ Failed to update cluster status: {e}", flush=True)
     sys.exit(1)
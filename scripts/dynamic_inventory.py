@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Ansible dynamic inventory backed by the dashboard API.
+
+Builds the same inventory as myscript.py straight from
+/api/clusters/?id=<cluster>, without writing hosts.yaml. --list returns
+_meta.hostvars so Ansible never calls --host per node. The API response is
+cached in the cluster's inventory directory for INVENTORY_CACHE_TTL seconds
+and revalidated with its ETag afterwards.
+
+myscript.py links it into every cluster as inventory/<cluster_id>/inventory.py,
+so Ansible still picks up that cluster's group_vars and the cluster ID is
+taken from the link's directory (AUTOKUBE_CLUSTER_ID overrides it). Run it
+with the deploy venv's python3 on PATH:
+    ansible-playbook -i inventory/<cluster_id>/inventory.py scale.yml -b
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import requests
+from dotenv import load_dotenv
+
+import ssh_mux
+from api_client import NODE_FIELDS, DashboardClient
+from inventory import InventoryError, NodeRecord, build_inventory, write_keys
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+CACHE_NAME = ".inventory-cache.json"
+
+load_dotenv(dotenv_path=SCRIPTS_DIR.parent / "dashboard-autokube" / ".env")
+
+
+def log(msg):
+    # stdout is reserved for the inventory JSON
+    print(msg, file=sys.stderr, flush=True)
+
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_cache(path, cache):
+    tmp = path.with_name(path.name + ".tmp")
+    # The payload holds node credentials
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+
+def fetch_cluster(api, cluster_id, cache_path, ttl):
+    cache = load_cache(cache_path)
+    if cache and time.time() - cache["fetched_at"] < ttl:
+        return cache["data"]
+
+    try:
+        data, etag = api.revalidate_cluster(cluster_id, cache and cache.get("etag"), fields=NODE_FIELDS)
+    except requests.RequestException as e:
+        if not cache:
+            raise
+        log(f"⚠️ Failed to refresh cluster data, using cached copy: {e}")
+        return cache["data"]
+
+    if data is None:
+        cache["fetched_at"] = time.time()
+    else:
+        cache = {"fetched_at": time.time(), "etag": etag, "data": data}
+    save_cache(cache_path, cache)
+    return cache["data"]
+
+
+def to_dynamic(inventory):
+    """Convert a hosts.yaml-shaped inventory to the script inventory format."""
+    root = inventory["all"]
+    result = {
+        "_meta": {"hostvars": root["hosts"]},
+        "all": {"children": sorted(root["children"]), "vars": root.get("vars", {})},
+    }
+    for group, spec in root["children"].items():
+        result[group] = {
+            "hosts": sorted(spec.get("hosts") or {}),
+            "children": sorted(spec.get("children") or {}),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AutoKube dynamic inventory")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--list", action="store_true")
+    group.add_argument("--host")
+    args = parser.parse_args()
+
+    invoked_from = Path(__file__).absolute().parent
+    cluster_id = os.getenv("AUTOKUBE_CLUSTER_ID") or (invoked_from.name if invoked_from != SCRIPTS_DIR else None)
+    nextauth_url = os.getenv("NEXTAUTH_URL", "").rstrip("/")
+    api_token = os.getenv("INTERNAL_API_TOKEN")
+    if not (cluster_id and nextauth_url and api_token):
+        log("❌ AUTOKUBE_CLUSTER_ID, NEXTAUTH_URL and INTERNAL_API_TOKEN must be set")
+        sys.exit(1)
+
+    inventory_dir = SCRIPTS_DIR / "kubespray" / "inventory" / cluster_id
+    ssh_key_dir = inventory_dir / "keys"
+    ssh_key_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        with DashboardClient(nextauth_url, api_token) as api:
+            cluster_data = fetch_cluster(
+                api, cluster_id, inventory_dir / CACHE_NAME, int(os.getenv("INVENTORY_CACHE_TTL", "300")),
+            )
+        nodes = [NodeRecord.from_api(node) for node in cluster_data.get("nodes", [])]
+        inventory = build_inventory(nodes, ssh_key_dir, all_vars=ssh_mux.ansible_vars(cluster_id))
+    except (requests.RequestException, InventoryError, KeyError) as e:
+        log(f"❌ Failed to build inventory: {e}")
+        sys.exit(1)
+
+    if args.list:
+        write_keys(nodes, ssh_key_dir)
+        json.dump(to_dynamic(inventory), sys.stdout)
+    else:
+        json.dump(inventory["all"]["hosts"].get(args.host, {}), sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
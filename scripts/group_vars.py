@@ -0,0 +1,133 @@
+"""
+Incremental materialization of a cluster's group_vars from inventory/local.
+
+A manifest next to the cluster's hosts.yaml records, per file, the content
+hash of its source, the hash of the overrides applied to it and the hash of
+what was written. On re-deploys only files whose inputs changed are
+rewritten; files without overrides are hardlinked to the shared defaults
+instead of copied.
+"""
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+MANIFEST_NAME = ".group_vars.manifest.json"
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def overrides_digest(updates):
+    encoded = json.dumps(updates, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_manifest(path, manifest):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def link_or_copy(src, dest):
+    tmp = dest.with_name(f".{dest.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        # Cross-device or filesystem without hardlinks
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+
+def is_linked(src, dest):
+    try:
+        return os.path.samefile(src, dest)
+    except FileNotFoundError:
+        return False
+
+
+def sync_group_vars(src_dir, dest_dir, overrides, apply_patches):
+    """
+    Bring dest_dir in line with src_dir plus per-file overrides.
+
+    ``overrides`` maps paths relative to src_dir to the updates for that
+    file. The private copies that need them are patched in one batch with
+    ``apply_patches({path: updates})`` (``YamlOverrides.apply_all``).
+    Returns the relative paths that were (re)written or relinked.
+    """
+    src_dir, dest_dir = Path(src_dir), Path(dest_dir)
+    manifest_path = dest_dir.parent / MANIFEST_NAME
+    previous = load_manifest(manifest_path)
+    manifest = {}
+    changed = []
+    patches = {}
+
+    sources = {
+        str(p.relative_to(src_dir)): p
+        for p in sorted(src_dir.rglob("*")) if p.is_file()
+    }
+
+    for rel, src in sources.items():
+        dest = dest_dir / rel
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        entry = {"src": file_digest(src)}
+        updates = overrides.get(rel)
+
+        if updates is None:
+            if not is_linked(src, dest) and not (dest.exists() and previous.get(rel) == entry):
+                link_or_copy(src, dest)
+                changed.append(rel)
+        else:
+            entry["overrides"] = overrides_digest(updates)
+            old = previous.get(rel, {})
+            up_to_date = (
+                dest.exists()
+                and not is_linked(src, dest)
+                and old.get("src") == entry["src"]
+                and old.get("overrides") == entry["overrides"]
+                and old.get("out") == file_digest(dest)
+            )
+            if up_to_date:
+                entry["out"] = old["out"]
+            else:
+                # Never write through a hardlink into the shared defaults
+                dest.unlink(missing_ok=True)
+                shutil.copy2(src, dest)
+                patches[rel] = updates
+                changed.append(rel)
+
+        manifest[rel] = entry
+
+    if patches:
+        apply_patches({dest_dir / rel: updates for rel, updates in patches.items()})
+        for rel in patches:
+            manifest[rel]["out"] = file_digest(dest_dir / rel)
+
+    for rel in overrides.keys() - sources.keys():
+        print(f"⚠️ {src_dir / rel} not found, skipping update", flush=True)
+
+    # Drop files that no longer exist in the source tree
+    if dest_dir.exists():
+        for dest in sorted(dest_dir.rglob("*"), reverse=True):
+            rel = str(dest.relative_to(dest_dir))
+            if dest.is_file() and rel not in sources:
+                dest.unlink()
+                changed.append(rel)
+            elif dest.is_dir() and not any(dest.iterdir()):
+                dest.rmdir()
+
+    write_manifest(manifest_path, manifest)
+    return changed
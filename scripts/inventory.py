@@ -0,0 +1,206 @@
+"""
+Kubespray inventory builder for AutoKube clusters.
+
+Turns the dashboard's node records into a kubespray inventory, validating
+them on the way, and writes it either as hosts.yaml or as hosts.json. The
+JSON form is loaded by Ansible's yaml inventory plugin with the plain json
+parser, which is much faster than YAML for large inventories.
+
+Benchmark:
+    python3 inventory.py --benchmark 1000
+"""
+import argparse
+import json
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import yaml
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+# Groups each NodeRole belongs to; database/storage nodes are workers
+# with their own group and node label so workloads can be pinned to them
+ROLE_GROUPS = {
+    "MASTER": ("kube_control_plane", "etcd"),
+    "WORKER": ("kube_node",),
+    "DATABASE": ("kube_node", "database"),
+    "STORAGE": ("kube_node", "storage"),
+}
+ROLE_LABELS = {
+    "DATABASE": {"node-role.autokube.io/database": ""},
+    "STORAGE": {"node-role.autokube.io/storage": ""},
+}
+AUTH_TYPES = ("PASSWORD", "SSH_KEY")
+FORMATS = {"yaml": "hosts.yaml", "json": "hosts.json"}
+
+
+class InventoryError(Exception):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class NodeRecord:
+    hostname: str
+    ip: str
+    user: str
+    role: str
+    auth_type: str
+    password: str = None
+    ssh_key: str = None
+
+    @classmethod
+    def from_api(cls, node):
+        return cls(
+            hostname=node["hostname"],
+            ip=node["ipAddress"],
+            user=node["username"],
+            role=(node.get("role") or "WORKER").upper(),
+            auth_type=node.get("authType"),
+            password=node.get("password"),
+            ssh_key=node.get("sshKey"),
+        )
+
+    def key_path(self, key_dir):
+        return Path(key_dir) / f"{self.hostname}_id_rsa"
+
+
+def validate(nodes):
+    errors = []
+    seen_hosts, seen_ips = set(), set()
+
+    for node in nodes:
+        if node.hostname in seen_hosts:
+            errors.append(f"duplicate hostname '{node.hostname}'")
+        if node.ip in seen_ips:
+            errors.append(f"duplicate IP '{node.ip}' ({node.hostname})")
+        seen_hosts.add(node.hostname)
+        seen_ips.add(node.ip)
+
+        if node.role not in ROLE_GROUPS:
+            errors.append(f"unknown role '{node.role}' for node {node.hostname}")
+        if node.auth_type not in AUTH_TYPES:
+            errors.append(f"unknown authType '{node.auth_type}' for node {node.hostname}")
+        elif node.auth_type == "PASSWORD" and not node.password:
+            errors.append(f"missing password for node {node.hostname}")
+        elif node.auth_type == "SSH_KEY" and not node.ssh_key:
+            errors.append(f"missing sshKey for node {node.hostname}")
+
+    if nodes and not any(n.role == "MASTER" for n in nodes):
+        errors.append("no MASTER node")
+
+    if errors:
+        raise InventoryError("; ".join(errors))
+
+
+def host_vars(node, key_dir):
+    entry = {
+        "ip": node.ip,
+        "access_ip": node.ip,
+        "ansible_host": node.ip,
+        "ansible_user": node.user,
+    }
+    if node.auth_type == "PASSWORD":
+        entry["ansible_ssh_pass"] = node.password
+        entry["ansible_become_password"] = node.password
+    else:
+        entry["ansible_ssh_private_key_file"] = str(node.key_path(key_dir))
+        entry["ansible_become"] = True
+    if node.role in ROLE_LABELS:
+        entry["node_labels"] = ROLE_LABELS[node.role]
+    return entry
+
+
+def write_keys(nodes, key_dir):
+    for node in nodes:
+        if node.auth_type != "SSH_KEY":
+            continue
+        key_path = node.key_path(key_dir)
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as kf:
+            kf.write(node.ssh_key)
+        os.chmod(key_path, 0o600)
+
+
+def build_inventory(nodes, key_dir, all_vars=None):
+    validate(nodes)
+
+    groups = {group: {} for groups in ROLE_GROUPS.values() for group in groups}
+    groups["calico_rr"] = {}
+    all_hosts = {}
+
+    for node in nodes:
+        all_hosts[node.hostname] = host_vars(node, key_dir)
+        for group in ROLE_GROUPS[node.role]:
+            groups[group][node.hostname] = None
+
+    children = {group: {"hosts": hosts} for group, hosts in groups.items()}
+    children["k8s_cluster"] = {"children": {"kube_control_plane": {}, "kube_node": {}}}
+
+    inventory = {"all": {"hosts": all_hosts, "children": children}}
+    if all_vars:
+        inventory["all"]["vars"] = all_vars
+    return inventory
+
+
+def write_inventory(inventory, inventory_dir, fmt="yaml"):
+    if fmt not in FORMATS:
+        raise InventoryError(f"unknown inventory format '{fmt}'")
+
+    inventory_dir = Path(inventory_dir)
+    path = inventory_dir / FORMATS[fmt]
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        if fmt == "json":
+            json.dump(inventory, f, separators=(",", ":"))
+        else:
+            yaml.dump(inventory, f, Dumper=SafeDumper, default_flow_style=False)
+    os.replace(tmp, path)
+
+    # Only one inventory file per cluster so the pipeline can't pick a stale one
+    for other in FORMATS.values():
+        if other != path.name:
+            (inventory_dir / other).unlink(missing_ok=True)
+    return path
+
+
+def benchmark(count):
+    roles = list(ROLE_GROUPS)
+    nodes = [
+        NodeRecord(
+            hostname=f"node{i}",
+            ip=f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+            user="ubuntu",
+            role="MASTER" if i < 3 else roles[1 + i % 3],
+            auth_type="PASSWORD",
+            password="secret",
+        )
+        for i in range(count)
+    ]
+
+    started = time.perf_counter()
+    inventory = build_inventory(nodes, "/tmp/keys")
+    built = time.perf_counter() - started
+    print(f"build:     {built * 1000:8.2f} ms ({count} nodes)")
+
+    for fmt in FORMATS:
+        started = time.perf_counter()
+        text = (json.dumps(inventory, separators=(",", ":")) if fmt == "json"
+                else yaml.dump(inventory, Dumper=SafeDumper, default_flow_style=False))
+        dumped = time.perf_counter() - started
+
+        started = time.perf_counter()
+        # Ansible's DataLoader tries json.loads before falling back to YAML
+        json.loads(text) if fmt == "json" else yaml.safe_load(text)
+        loaded = time.perf_counter() - started
+        print(f"{fmt:<5} dump {dumped * 1000:8.2f} ms, load {loaded * 1000:8.2f} ms, {len(text) / 1024:8.1f} KiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark inventory generation")
+    parser.add_argument("--benchmark", type=int, metavar="NODES", default=1000)
+    benchmark(parser.parse_args().benchmark)
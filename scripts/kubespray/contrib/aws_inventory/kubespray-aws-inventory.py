@@ -1,22 +1,37 @@
 #!/usr/bin/env python
 
+##Dynamic inventory for instances tagged with kubespray-role.
+##
+##All groups come from a single paginated DescribeInstances call, and the
+##result is cached for AWS_INVENTORY_CACHE_TTL seconds (300 by default, 0
+##disables the cache), so the --host calls Ansible makes are served from the
+##cache. Set AWS_ENDPOINT_URL to run it against a local EC2 stub such as
+##moto_server.
+
 from __future__ import print_function
 import boto3
 import os
 import argparse
+import hashlib
 import json
+import tempfile
+import time
+
+GROUPS = ["kube_control_plane", "kube_node", "etcd"]
+ROLE_TAG = "kubespray-role"
 
 class SearchEC2Tags(object):
 
-  def __init__(self):
-    self.parse_args()
+  def __init__(self, argv=None, client=None):
+    self.client = client
+    self.parse_args(argv)
     if self.args.list:
-      self.search_tags()
+      print(json.dumps(self.inventory(), sort_keys=True, indent=2))
     if self.args.host:
-      data = {}
+      data = self.inventory()['_meta']['hostvars'].get(self.args.host, {})
       print(json.dumps(data, indent=2))
 
-  def parse_args(self):
+  def parse_args(self, argv=None):
 
     ##Check if VPC_VISIBILITY is set, if not default to private
     if "VPC_VISIBILITY" in os.environ:
@@ -24,58 +39,123 @@ class SearchEC2Tags(object):
     else:
       self.vpc_visibility = "private"
 
-    ##Support --list and --host flags. We largely ignore the host one.
+    default_cache = os.environ.get('AWS_INVENTORY_CACHE',
+                                   os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                                'kubespray', 'aws-inventory.json'))
+
+    ##Support --list and --host flags.
     parser = argparse.ArgumentParser()
     parser.add_argument('--list', action='store_true', default=False, help='List instances')
-    parser.add_argument('--host', action='store_true', help='Get all the variables about a specific instance')
-    self.args = parser.parse_args()
+    parser.add_argument('--host', help='Get all the variables about a specific instance')
+    parser.add_argument('--cache', default=default_cache, help='File caching the inventory')
+    parser.add_argument('--cache-ttl', type=int, default=int(os.environ.get('AWS_INVENTORY_CACHE_TTL', 300)),
+                        help='Seconds the cached inventory is used for, 0 disables the cache')
+    parser.add_argument('--refresh-cache', action='store_true', help='Query EC2 even if the cache is fresh')
+    self.args = parser.parse_args(argv)
+
+  def cache_key(self):
+    ##The inventory depends on these, a cache written for other values is ignored.
+    ##Only cheap inputs are used, resolving credentials can wait on the instance
+    ##metadata service: the profile and access key from the environment, which
+    ##are only stored hashed, the credentials file's mtime and the endpoint of a
+    ##stub like moto_server.
+    credentials_file = os.environ.get('AWS_SHARED_CREDENTIALS_FILE', os.path.expanduser('~/.aws/credentials'))
+    try:
+      credentials_mtime = os.stat(credentials_file).st_mtime
+    except OSError:
+      credentials_mtime = None
+    identity = [os.getenv('AWS_PROFILE') or os.getenv('AWS_DEFAULT_PROFILE'), os.getenv('AWS_ACCESS_KEY_ID'),
+                credentials_mtime, os.getenv('AWS_ENDPOINT_URL_EC2') or os.getenv('AWS_ENDPOINT_URL')]
+    return [os.environ['AWS_REGION'], os.getenv('CLUSTER_NAME', ''), self.vpc_visibility,
+            hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()]
+
+  def load_cache(self):
+    if self.args.cache_ttl <= 0 or self.args.refresh_cache:
+      return None
+    try:
+      with open(self.args.cache) as cache_file:
+        cache = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+      return None
+    if cache.get('key') != self.cache_key() or time.time() - cache.get('fetched_at', 0) >= self.args.cache_ttl:
+      return None
+    return cache['inventory']
+
+  def save_cache(self, inventory):
+    if self.args.cache_ttl <= 0:
+      return
+    try:
+      cache_dir = os.path.dirname(os.path.abspath(self.args.cache))
+      if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      fd, tmp = tempfile.mkstemp(dir=cache_dir)
+      with os.fdopen(fd, 'w') as cache_file:
+        json.dump({'key': self.cache_key(), 'fetched_at': time.time(), 'inventory': inventory}, cache_file)
+      os.replace(tmp, self.args.cache)
+    except (IOError, OSError):
+      pass  ##The cache is only an optimisation
+
+  def inventory(self):
+    inventory = self.load_cache()
+    if inventory is None:
+      inventory = self.search_tags()
+      self.save_cache(inventory)
+    return inventory
+
+  def describe_instances(self):
+    ##One query for every group, the groups are assigned from the tags afterwards
+    client = self.client or boto3.client('ec2', os.environ['AWS_REGION'])
+    filters = [
+      {'Name': 'tag:'+ROLE_TAG, 'Values': ["*"+group+"*" for group in GROUPS]},
+      {'Name': 'instance-state-name', 'Values': ['running']},
+    ]
+    cluster_name = os.getenv('CLUSTER_NAME')
+    if cluster_name:
+      filters.append({'Name': 'tag-key', 'Values': ['kubernetes.io/cluster/'+cluster_name]})
+
+    for page in client.get_paginator('describe_instances').paginate(Filters=filters):
+      for reservation in page['Reservations']:
+        for instance in reservation['Instances']:
+          yield instance
 
   def search_tags(self):
     hosts = {}
     hosts['_meta'] = { 'hostvars': {} }
-
-    ##Search ec2 three times to find nodes of each group type. Relies on kubespray-role key/value.
-    for group in ["kube_control_plane", "kube_node", "etcd"]:
+    for group in GROUPS:
       hosts[group] = []
-      tag_key = "kubespray-role"
-      tag_value = ["*"+group+"*"]
-      region = os.environ['AWS_REGION']
-
-      ec2 = boto3.resource('ec2', region)
-      filters = [{'Name': 'tag:'+tag_key, 'Values': tag_value}, {'Name': 'instance-state-name', 'Values': ['running']}]
-      cluster_name = os.getenv('CLUSTER_NAME')
-      if cluster_name:
-        filters.append({'Name': 'tag-key', 'Values': ['kubernetes.io/cluster/'+cluster_name]})
-      instances = ec2.instances.filter(Filters=filters)
-      for instance in instances:
-
-        ##Suppose default vpc_visibility is private
-        dns_name = instance.private_dns_name
+
+    for instance in self.describe_instances():
+      tags = dict((tag['Key'], tag['Value']) for tag in instance.get('Tags', []))
+
+      ##Suppose default vpc_visibility is private
+      dns_name = instance.get('PrivateDnsName')
+      ansible_host = {
+        'ansible_ssh_host': instance.get('PrivateIpAddress')
+      }
+
+      ##Override when vpc_visibility actually is public
+      if self.vpc_visibility == "public":
+        dns_name = instance.get('PublicDnsName')
         ansible_host = {
-          'ansible_ssh_host': instance.private_ip_address
+          'ansible_ssh_host': instance.get('PublicIpAddress')
         }
 
-        ##Override when vpc_visibility actually is public
-        if self.vpc_visibility == "public":
-          dns_name = instance.public_dns_name
-          ansible_host = {
-            'ansible_ssh_host': instance.public_ip_address
-          }
-
-        ##Set when instance actually has node_labels
-        node_labels_tag = list(filter(lambda t: t['Key'] == 'kubespray-node-labels', instance.tags))
-        if node_labels_tag:
-          ansible_host['node_labels'] = dict([ label.strip().split('=') for label in node_labels_tag[0]['Value'].split(',') ])
+      ##Set when instance actually has node_labels
+      if 'kubespray-node-labels' in tags:
+        ansible_host['node_labels'] = dict([ label.strip().split('=') for label in tags['kubespray-node-labels'].split(',') ])
 
-        ##Set when instance actually has node_taints
-        node_taints_tag = list(filter(lambda t: t['Key'] == 'kubespray-node-taints', instance.tags))
-        if node_taints_tag:
-          ansible_host['node_taints'] = list([ taint.strip() for taint in node_taints_tag[0]['Value'].split(',') ])
+      ##Set when instance actually has node_taints
+      if 'kubespray-node-taints' in tags:
+        ansible_host['node_taints'] = list([ taint.strip() for taint in tags['kubespray-node-taints'].split(',') ])
 
-        hosts[group].append(dns_name)
-        hosts['_meta']['hostvars'][dns_name] = ansible_host
+      ##Roles can be shared, e.g. "kube_control_plane, etcd"
+      for group in GROUPS:
+        if group in tags[ROLE_TAG]:
+          hosts[group].append(dns_name)
+      hosts['_meta']['hostvars'][dns_name] = ansible_host
 
     hosts['k8s_cluster'] = {'children':['kube_control_plane', 'kube_node']}
-    print(json.dumps(hosts, sort_keys=True, indent=2))
+    return hosts
 
-SearchEC2Tags()
+if __name__ == '__main__':
+  SearchEC2Tags()
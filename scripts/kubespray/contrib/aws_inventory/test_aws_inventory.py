@@ -0,0 +1,123 @@
+"""kubespray-aws-inventory.py with a stub EC2 client passed as client=."""
+
+import importlib.util
+import json
+import os
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+  'aws_inventory', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kubespray-aws-inventory.py'))
+aws_inventory = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(aws_inventory)
+
+
+def instance(n, role, **tags):
+  tags = dict(tags, **{'kubespray-role': role})
+  return {
+    'PrivateDnsName': 'ip-10-0-0-%d.ec2.internal' % n, 'PrivateIpAddress': '10.0.0.%d' % n,
+    'PublicDnsName': 'ec2-%d.compute.amazonaws.com' % n, 'PublicIpAddress': '54.0.0.%d' % n,
+    'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()],
+  }
+
+
+class StubEC2(object):
+  """Answers DescribeInstances like moto does, two reservations per page."""
+
+  def __init__(self, instances):
+    self.instances = instances
+    self.calls = []
+
+  def get_paginator(self, operation):
+    assert operation == 'describe_instances'
+    return self
+
+  def paginate(self, Filters):
+    self.calls.append(Filters)
+    for start in range(0, len(self.instances), 2):
+      yield {'Reservations': [{'Instances': [i]} for i in self.instances[start:start + 2]]}
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+  for name in ('CLUSTER_NAME', 'VPC_VISIBILITY', 'AWS_PROFILE', 'AWS_DEFAULT_PROFILE', 'AWS_ACCESS_KEY_ID',
+               'AWS_ENDPOINT_URL', 'AWS_ENDPOINT_URL_EC2'):
+    monkeypatch.delenv(name, raising=False)
+  monkeypatch.setenv('AWS_REGION', 'eu-west-1')
+  return StubEC2([
+    instance(1, 'kube_control_plane, etcd'),
+    instance(2, 'kube_node', **{'kubespray-node-labels': 'a=b, c=d',
+                                'kubespray-node-taints': 'x=:NoSchedule, y=z:NoExecute'}),
+    instance(3, 'kube_node'),
+  ])
+
+
+def run(ec2, capsys, *argv):
+  aws_inventory.SearchEC2Tags(list(argv), client=ec2)
+  return json.loads(capsys.readouterr().out)
+
+
+def test_list(ec2, capsys, tmp_path):
+  inventory = run(ec2, capsys, '--list', '--cache-ttl', '0')
+  assert inventory['kube_control_plane'] == ['ip-10-0-0-1.ec2.internal']
+  assert inventory['etcd'] == ['ip-10-0-0-1.ec2.internal']
+  assert inventory['kube_node'] == ['ip-10-0-0-2.ec2.internal', 'ip-10-0-0-3.ec2.internal']
+  assert inventory['k8s_cluster'] == {'children': ['kube_control_plane', 'kube_node']}
+  assert inventory['_meta']['hostvars']['ip-10-0-0-2.ec2.internal'] == {
+    'ansible_ssh_host': '10.0.0.2',
+    'node_labels': {'a': 'b', 'c': 'd'},
+    'node_taints': ['x=:NoSchedule', 'y=z:NoExecute'],
+  }
+  assert len(ec2.calls) == 1
+
+
+def test_public_visibility_and_cluster_filter(ec2, capsys, monkeypatch):
+  monkeypatch.setenv('VPC_VISIBILITY', 'public')
+  monkeypatch.setenv('CLUSTER_NAME', 'c1')
+  inventory = run(ec2, capsys, '--list', '--cache-ttl', '0')
+  assert inventory['_meta']['hostvars']['ec2-1.compute.amazonaws.com'] == {'ansible_ssh_host': '54.0.0.1'}
+  assert {'Name': 'tag-key', 'Values': ['kubernetes.io/cluster/c1']} in ec2.calls[0]
+
+
+def test_host_is_served_from_the_cache(ec2, capsys, tmp_path, monkeypatch):
+  cache = str(tmp_path / 'inventory.json')
+  inventory = run(ec2, capsys, '--list', '--cache', cache)
+
+  def no_session(*args, **kwargs):
+    raise AssertionError('credentials resolved on a cache hit')
+  monkeypatch.setattr(aws_inventory.boto3.session, 'Session', no_session)
+
+  host = run(ec2, capsys, '--host', 'ip-10-0-0-3.ec2.internal', '--cache', cache)
+  assert host == inventory['_meta']['hostvars']['ip-10-0-0-3.ec2.internal']
+  assert run(ec2, capsys, '--host', 'unknown', '--cache', cache) == {}
+  assert len(ec2.calls) == 1
+
+
+@pytest.mark.parametrize('name, value', [
+  ('CLUSTER_NAME', 'c2'),
+  ('AWS_PROFILE', 'other'),
+  ('AWS_ACCESS_KEY_ID', 'AKIAOTHER'),
+  ('AWS_ENDPOINT_URL', 'http://localhost:5000'),
+])
+def test_cache_is_keyed_by_cluster_and_account(ec2, capsys, tmp_path, monkeypatch, name, value):
+  cache = str(tmp_path / 'inventory.json')
+  run(ec2, capsys, '--list', '--cache', cache)
+  monkeypatch.setenv(name, value)
+  run(ec2, capsys, '--list', '--cache', cache)
+  assert len(ec2.calls) == 2
+  assert value not in (tmp_path / 'inventory.json').read_text() or name == 'CLUSTER_NAME'
+
+
+def test_refresh_and_expiry(ec2, capsys, tmp_path):
+  cache = str(tmp_path / 'inventory.json')
+  run(ec2, capsys, '--list', '--cache', cache)
+  run(ec2, capsys, '--list', '--cache', cache, '--refresh-cache')
+  assert len(ec2.calls) == 2
+
+  with open(cache) as f:
+    data = json.load(f)
+  data['fetched_at'] -= 301
+  with open(cache, 'w') as f:
+    json.dump(data, f)
+  run(ec2, capsys, '--list', '--cache', cache)
+  assert len(ec2.calls) == 3
@@ -17,23 +17,51 @@
 # original: https://github.com/CiscoCloud/terraform.py
 
 """\
-Dynamic inventory for Terraform - finds all `.tfstate` files below the working
-directory and generates an inventory based on them.
+Dynamic inventory for Terraform - finds all `.tfstate` files below
+contrib/terraform (or TERRAFORM_STATE_ROOT, or --root) and generates an
+inventory based on them.
+
+Parsed hosts are cached per state file (keyed by path, mtime and size), so
+repeated calls only re-read the state files that changed.
+
+Version 4 states are read as nested JSON by the resources that have a native
+parser; the others go through the flattened version 3 form. Compare both
+paths with:
+    python3 terraform.py --benchmark 2000
+
+Version 4 states above TERRAFORM_STREAM_THRESHOLD bytes (32 MiB by default)
+are streamed: only the instance attributes the parsers read are decoded.
 """
 import argparse
 from collections import defaultdict
-import random
 from functools import wraps
+import hashlib
+import itertools
 import json
 import os
 import re
+import tempfile
+import time
 
 VERSION = '0.4.0pre'
+CACHE_VERSION = 3
+# The provider directories terraform is run in; symlinks to this script are
+# resolved so a copy linked into inventory/<cluster> searches the same place
+DEFAULT_ROOT = os.environ.get('TERRAFORM_STATE_ROOT', os.path.dirname(os.path.realpath(__file__)))
+# Directories that never hold the states we are after (.git, .terraform, ...
+# are skipped as well), so a root set to the whole checkout stays cheap to walk
+SKIP_DIRS = {'node_modules', '__pycache__', 'roles', 'inventory', 'playbooks', 'docs',
+             'tests', 'test-infra', 'library', 'plugins', 'templates'}
+# Version 4 states of at least this many bytes are streamed instead of
+# loaded whole (0 streams every state)
+STREAM_THRESHOLD = int(os.environ.get('TERRAFORM_STREAM_THRESHOLD', 32 << 20))
+STREAM_CHUNK = 1 << 20
 
 
 def tfstates(root=None):
-    root = root or os.getcwd()
-    for dirpath, _, filenames in os.walk(root):
+    root = root or DEFAULT_ROOT
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.') and d not in SKIP_DIRS]
         for name in filenames:
             if os.path.splitext(name)[-1] == '.tfstate':
                 yield os.path.join(dirpath, name)
@@ -42,13 +70,14 @@ def convert_to_v3_structure(attributes, prefix=''):
     """ Convert the attributes from v4 to v3
     Receives a dict and return a dictionary """
     result = {}
-    if isinstance(attributes, str):
-        # In the case when we receive a string (e.g. values for security_groups)
-        return {'{}{}'.format(prefix, random.randint(1,10**10)): attributes}
+    if not isinstance(attributes, dict):
+        # A list item that is a plain value (e.g. security_groups): it is
+        # stored under its index, like version 3 does
+        return {prefix[:-1]: attributes}
     for key, value in attributes.items():
         if isinstance(value, list):
             if len(value):
-                result['{}{}.#'.format(prefix, key, hash)] = len(value)
+                result['{}{}.#'.format(prefix, key)] = len(value)
             for i, v in enumerate(value):
                 result.update(convert_to_v3_structure(v, '{}{}.{}.'.format(prefix, key, i)))
         elif isinstance(value, dict):
@@ -59,40 +88,248 @@ def convert_to_v3_structure(attributes, prefix=''):
             result['{}{}'.format(prefix, key)] = value
     return result
 
-def iterresources(filenames):
+def v3_resource(resource):
+    '''the version 3 form of a version 4 resource, with flattened attributes'''
+    attributes = resource['attributes']
+    primary = {'attributes': convert_to_v3_structure(attributes)}
+    if 'id' in attributes:
+        primary['id'] = attributes['id']
+    primary['meta'] = attributes.get('meta', {})
+    return {
+        'type': resource['type'],
+        'provider': resource['provider'],
+        'depends_on': resource['depends_on'],
+        'primary': primary,
+    }
+
+class JsonStream(object):
+    '''Incremental reader for one JSON document.
+
+    The caller walks the document with members() and items() and takes each
+    value with value(), or drops it with skip(). Skipped values are scanned
+    without being decoded, and the buffer only holds the value being read,
+    so memory does not depend on the size of the file.'''
+
+    WHITESPACE = re.compile(r'\s*')
+    STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*')
+    STRUCTURE = re.compile(r'["{}\[\]]')
+    SCALAR = re.compile(r'[^,}\]\s]*')
+
+    def __init__(self, stream, chunk_size=STREAM_CHUNK):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.mark = None
+
+    def _fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            return False
+        keep = self.pos if self.mark is None else self.mark
+        self.buf = self.buf[keep:] + chunk
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark = 0
+        return True
+
+    def _match(self, pattern):
+        '''advance over pattern, reading on while it reaches the buffer end'''
+        while True:
+            self.pos = pattern.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._fill():
+                return
+
+    def peek(self):
+        self._match(self.WHITESPACE)
+        if self.pos == len(self.buf):
+            raise ValueError('unexpected end of JSON document')
+        return self.buf[self.pos]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected %r at %r' % (char, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def _skip_string(self):
+        self.pos += 1
+        while True:
+            self._match(self.STRING_BODY)
+            if self.pos == len(self.buf):
+                raise ValueError('unterminated JSON string')
+            if self.buf[self.pos] == '"':
+                self.pos += 1
+                return
+            # an escape split over two chunks
+            if self.pos + 1 == len(self.buf) and not self._fill():
+                raise ValueError('unterminated JSON string')
+
+    def skip(self):
+        char = self.peek()
+        if char == '"':
+            self._skip_string()
+        elif char in '{[':
+            depth = 0
+            while True:
+                match = self.STRUCTURE.search(self.buf, self.pos)
+                if match is None:
+                    self.pos = len(self.buf)
+                    if not self._fill():
+                        raise ValueError('unexpected end of JSON document')
+                    continue
+                self.pos = match.start()
+                char = match.group()
+                if char == '"':
+                    self._skip_string()
+                    continue
+                self.pos += 1
+                depth += 1 if char in '{[' else -1
+                if not depth:
+                    return
+        else:
+            self._match(self.SCALAR)
+
+    def value(self):
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip()
+            return json.loads(self.buf[self.mark:self.pos])
+        finally:
+            self.mark = None
+
+    def _entries(self, opening, closing):
+        self.expect(opening)
+        if self.peek() == closing:
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == closing:
+                return
+            if char != ',':
+                raise ValueError('expected %r or %r, got %r' % (',', closing, char))
+
+    def members(self):
+        '''yield the keys of an object; each value has to be consumed'''
+        for _ in self._entries('{', '}'):
+            key = self.value()
+            self.expect(':')
+            yield key
+
+    def items(self):
+        '''yield once per array item; each item has to be consumed'''
+        return self._entries('[', ']')
+
+
+class NotStreamable(Exception):
+    pass
+
+
+def _wanted_attributes(resource_type):
+    '''attribute names the parsers read for resource_type, None for all'''
+    if resource_type in V4_PARSERS:
+        return V4_ATTRIBUTES.get(resource_type)
+    if resource_type == 'openstack_networking_floatingip_associate_v2':
+        return FLOATING_IP_ATTRIBUTES
+    if resource_type in PARSERS:
+        return None
+    return frozenset()
+
+
+def stream_instances(json_file):
+    '''yield the (resource, instance) pairs of a version 4 state, keeping
+    only the instance attributes a parser reads'''
+    reader = JsonStream(json_file)
+    for key in reader.members():
+        if key == 'version':
+            # terraform writes the version first, before any resource
+            tf_version = reader.value()
+            if tf_version != 4:
+                raise NotStreamable(tf_version)
+        elif key == 'resources':
+            for _ in reader.items():
+                resource = {}
+                for resource_key in reader.members():
+                    if resource_key != 'instances':
+                        resource[resource_key] = reader.value()
+                        continue
+                    wanted = _wanted_attributes(resource['type']) if 'type' in resource else None
+                    for _ in reader.items():
+                        instance = {}
+                        for instance_key in reader.members():
+                            if instance_key in ('index_key', 'depends_on'):
+                                instance[instance_key] = reader.value()
+                            elif instance_key == 'attributes':
+                                instance['attributes'] = attributes = {}
+                                for name in reader.members():
+                                    if wanted is None or name in wanted:
+                                        attributes[name] = reader.value()
+                                    else:
+                                        reader.skip()
+                            else:
+                                reader.skip()
+                        yield resource, instance
+        else:
+            reader.skip()
+
+
+def iterresources(filenames, native=True):
+    '''yield (module name, key, resource) for every resource; version 4
+    resources keep their nested attributes unless native is False'''
     for filename in filenames:
         with open(filename, 'r') as json_file:
-            state = json.load(json_file)
-            tf_version = state['version']
-            if tf_version == 3:
-                for module in state['modules']:
-                    name = module['path'][-1]
-                    for key, resource in module['resources'].items():
-                        yield name, key, resource
-            elif tf_version == 4:
-                # In version 4 the structure changes so we need to iterate
-                # each instance inside the resource branch.
-                for resource in state['resources']:
-                    name = resource['provider'].split('.')[-1]
-                    for instance in resource['instances']:
-                        key = "{}.{}".format(resource['type'], resource['name'])
-                        if 'index_key' in instance:
-                           key = "{}.{}".format(key, instance['index_key'])
-                        data = {}
-                        data['type'] = resource['type']
-                        data['provider'] = resource['provider']
-                        data['depends_on'] = instance.get('depends_on', [])
-                        data['primary'] = {'attributes': convert_to_v3_structure(instance['attributes'])}
-                        if 'id' in instance['attributes']:
-                           data['primary']['id'] = instance['attributes']['id']
-                        data['primary']['meta'] = instance['attributes'].get('meta',{})
-                        yield name, key, data
-            else:
-                raise KeyError('tfstate version %d not supported' % tf_version)
+            instances = None
+            if native and os.path.getsize(filename) >= STREAM_THRESHOLD:
+                try:
+                    instances = stream_instances(json_file)
+                    first = next(instances, None)
+                    if first is not None:
+                        instances = itertools.chain([first], instances)
+                except NotStreamable:
+                    json_file.seek(0)
+                    instances = None
+
+            if instances is None:
+                state = json.load(json_file)
+                tf_version = state['version']
+                if tf_version == 3:
+                    for module in state['modules']:
+                        name = module['path'][-1]
+                        for key, resource in module['resources'].items():
+                            yield name, key, resource
+                    continue
+                elif tf_version != 4:
+                    raise KeyError('tfstate version %d not supported' % tf_version)
+                instances = ((resource, instance)
+                             for resource in state['resources']
+                             for instance in resource['instances'])
+
+            # In version 4 the structure changes so we need to iterate
+            # each instance inside the resource branch.
+            for resource, instance in instances:
+                name = resource['provider'].split('.')[-1]
+                key = "{}.{}".format(resource['type'], resource['name'])
+                if 'index_key' in instance:
+                   key = "{}.{}".format(key, instance['index_key'])
+                data = {
+                    'type': resource['type'],
+                    'provider': resource['provider'],
+                    'depends_on': instance.get('depends_on', []),
+                    'attributes': instance['attributes'],
+                }
+                yield name, key, data if native else v3_resource(data)
 
 
 ## READ RESOURCES
 PARSERS = {}
+# parsers reading the nested attributes of version 4 resources, and the
+# attributes they read when a state is streamed
+V4_PARSERS = {}
+V4_ATTRIBUTES = {}
+FLOATING_IP_ATTRIBUTES = frozenset(['port_id', 'floating_ip'])
 
 
 def _clean_dc(dcname):
@@ -101,29 +338,146 @@ def _clean_dc(dcname):
     return re.sub(r'[^\w_\-]', '-', dcname)
 
 
-def iterhosts(resources):
-    '''yield host tuples of (name, attributes, groups)'''
-    for module_name, key, resource in resources:
+def parse_state(filename, native=True):
+    '''return the host tuples of (name, attributes, groups) and the floating
+    IPs as {port_id: ip} of one state file, reading it once'''
+    hosts, ips = [], {}
+    for module_name, key, resource in iterresources([filename], native):
         resource_type, name = key.split('.', 1)
+        if 'primary' not in resource and resource_type in V4_PARSERS:
+            hosts.append(V4_PARSERS[resource_type](resource, module_name))
+        elif resource_type in PARSERS:
+            if 'primary' not in resource:
+                resource = v3_resource(resource)
+            hosts.append(PARSERS[resource_type](resource, module_name))
+        elif resource_type == 'openstack_networking_floatingip_associate_v2':
+            port_id, ip = openstack_floating_ips(resource)
+            ips[port_id] = ip
+
+    return hosts, ips
+
+
+class ParseCache(object):
+    '''parse_state results per state file, stored as JSON between runs.
+
+    The hostvars of each set of state files are kept by host name in a
+    separate index file, so --host only reads that index.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.loaded = False
+        self.entries = {}
+        # index key -> signature of the hostvars in its index file
+        self.indexes = {}
+        self.pending = {}
+        self.dirty = False
+
+    @staticmethod
+    def _read(path):
         try:
-            parser = PARSERS[resource_type]
-        except KeyError:
-            continue
-
-        yield parser(resource, module_name)
+            with open(path) as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        return cache if isinstance(cache, dict) and cache.get('version') == CACHE_VERSION else None
+
+    @staticmethod
+    def _write(path, cache):
+        cache_dir = os.path.dirname(path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(dict(cache, version=CACHE_VERSION), cache_file)
+        os.replace(tmp, path)
+
+    def _load(self):
+        if not self.loaded:
+            self.loaded = True
+            cache = self._read(self.path)
+            if cache:
+                self.entries, self.indexes = cache['files'], cache['indexes']
+
+    @staticmethod
+    def _signature(filenames):
+        '''(index key, [[path, mtime, size], ...]) of a set of state files'''
+        signature = []
+        for filename in sorted(os.path.abspath(f) for f in filenames):
+            stat = os.stat(filename)
+            signature.append([filename, stat.st_mtime_ns, stat.st_size])
+        return os.pathsep.join(f for f, _, _ in signature), signature
+
+    def _index_path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return '%s-hosts-%s.json' % (os.path.splitext(self.path)[0], digest)
+
+    def hostvars(self, filenames):
+        '''the hostvars by host name indexed for filenames, None when any of
+        them changed since'''
+        key, signature = self._signature(filenames)
+        index = self._read(self._index_path(key))
+        if index and index['signature'] == signature:
+            return index['hostvars']
+        return None
+
+    def index(self, filenames, hostvars):
+        self._load()
+        key, signature = self._signature(filenames)
+        # parsing is deterministic, the same files give the same hostvars
+        if self.indexes.get(key) != signature or not os.path.exists(self._index_path(key)):
+            self.indexes[key] = signature
+            self.pending[self._index_path(key)] = {'signature': signature, 'hostvars': hostvars}
+            self.dirty = True
+
+    def parse(self, filename):
+        self._load()
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        entry = self.entries.get(filename)
+        if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry['hosts'], entry['ips']
+
+        hosts, ips = parse_state(filename)
+        # stored as JSON right away, so hits and misses look the same
+        self.entries[filename] = json.loads(json.dumps({
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'hosts': hosts,
+            'ips': ips,
+        }))
+        self.dirty = True
+        return hosts, ips
+
+    def save(self):
+        self._load()
+        # the cache may be shared by several roots, only forget removed states
+        for filename in [f for f in self.entries if not os.path.exists(f)]:
+            del self.entries[filename]
+            self.dirty = True
+        for key in [k for k, signature in self.indexes.items()
+                    if not all(os.path.exists(f) for f, _, _ in signature)]:
+            del self.indexes[key]
+            try:
+                os.remove(self._index_path(key))
+            except OSError:
+                pass
+            self.dirty = True
+        if not self.dirty:
+            return
 
-
-def iterips(resources):
-    '''yield ip tuples of (port_id, ip)'''
-    for module_name, key, resource in resources:
-        resource_type, name = key.split('.', 1)
-        if resource_type == 'openstack_networking_floatingip_associate_v2':
-            yield openstack_floating_ips(resource)
+        try:
+            for path, index in self.pending.items():
+                self._write(path, index)
+            self._write(self.path, {'files': self.entries, 'indexes': self.indexes})
+        except (IOError, OSError):
+            pass  # the cache is only an optimisation
 
 
-def parses(prefix):
+def parses(prefix, version=3, attributes=None):
     def inner(func):
-        PARSERS[prefix] = func
+        (V4_PARSERS if version == 4 else PARSERS)[prefix] = func
+        if attributes is not None:
+            V4_ATTRIBUTES[prefix] = frozenset(attributes)
         return func
 
     return inner
@@ -205,13 +559,32 @@ def sanitize_groups(groups):
     groups.clear()
     groups.extend(_groups)
 
+def _equinix_metal_host(attrs):
+    name = attrs['hostname']
+    groups = []
+
+    if attrs['operating_system'] == 'flatcar_stable':
+        # For Flatcar set the ssh_user to core
+        attrs.update({'ansible_ssh_user': 'core'})
+
+    # add groups based on attrs
+    groups.append('equinix_metal_operating_system_%s' % attrs['operating_system'])
+    groups.append('equinix_metal_locked_%s' % attrs['locked'])
+    groups.append('equinix_metal_state_%s' % attrs['state'])
+    groups.append('equinix_metal_plan_%s' % attrs['plan'])
+
+    # groups specific to kubespray
+    groups = groups + attrs['tags']
+    sanitize_groups(groups)
+
+    return name, attrs, groups
+
+
 @parses('equinix_metal_device')
 def equinix_metal_device(resource, tfvars=None):
     raw_attrs = resource['primary']['attributes']
-    name = raw_attrs['hostname']
-    groups = []
 
-    attrs = {
+    return _equinix_metal_host({
         'id': raw_attrs['id'],
         'facilities': parse_list(raw_attrs, 'facilities'),
         'hostname': raw_attrs['hostname'],
@@ -231,23 +604,37 @@ def equinix_metal_device(resource, tfvars=None):
         'public_ipv6': raw_attrs['network.1.address'],
         'private_ipv4': raw_attrs['network.2.address'],
         'provider': 'equinix',
-    }
+    })
 
-    if raw_attrs['operating_system'] == 'flatcar_stable':
-        # For Flatcar set the ssh_user to core
-        attrs.update({'ansible_ssh_user': 'core'})
 
-    # add groups based on attrs
-    groups.append('equinix_metal_operating_system_%s' % attrs['operating_system'])
-    groups.append('equinix_metal_locked_%s' % attrs['locked'])
-    groups.append('equinix_metal_state_%s' % attrs['state'])
-    groups.append('equinix_metal_plan_%s' % attrs['plan'])
-
-    # groups specific to kubespray
-    groups = groups + attrs['tags']
-    sanitize_groups(groups)
+@parses('equinix_metal_device', version=4, attributes=[
+    'id', 'facilities', 'hostname', 'operating_system', 'locked', 'tags', 'plan', 'project_id', 'state',
+    'network'])
+def equinix_metal_device_v4(resource, tfvars=None):
+    raw_attrs = resource['attributes']
+    network = raw_attrs['network']
 
-    return name, attrs, groups
+    return _equinix_metal_host({
+        'id': raw_attrs['id'],
+        'facilities': list(raw_attrs.get('facilities') or []),
+        'hostname': raw_attrs['hostname'],
+        'operating_system': raw_attrs['operating_system'],
+        'locked': parse_bool(raw_attrs['locked']),
+        'tags': list(raw_attrs.get('tags') or []),
+        'plan': raw_attrs['plan'],
+        'project_id': raw_attrs['project_id'],
+        'state': raw_attrs['state'],
+        # ansible
+        'ansible_host': network[0]['address'],
+        'ansible_ssh_user': 'root',  # Use root by default in metal
+        # generic
+        'ipv4_address': network[0]['address'],
+        'public_ipv4': network[0]['address'],
+        'ipv6_address': network[1]['address'],
+        'public_ipv6': network[1]['address'],
+        'private_ipv4': network[2]['address'],
+        'provider': 'equinix',
+    })
 
 
 def openstack_floating_ips(resource):
@@ -259,58 +646,29 @@ def openstack_floating_ips(resource):
     return attrs
 
 def openstack_floating_ips(resource):
-    raw_attrs = resource['primary']['attributes']
+    # both are plain values, named the same in version 3 and 4 states
+    raw_attrs = resource['primary']['attributes'] if 'primary' in resource else resource['attributes']
     return raw_attrs['port_id'], raw_attrs['floating_ip']
 
-@parses('openstack_compute_instance_v2')
-@calculate_mantl_vars
-def openstack_host(resource, module_name):
-    raw_attrs = resource['primary']['attributes']
-    name = raw_attrs['name']
+def _openstack_host(name, attrs, volume_devices, has_floating_ip):
     groups = []
+    metadata = attrs['metadata']
 
-    attrs = {
-        'access_ip_v4': raw_attrs['access_ip_v4'],
-        'access_ip_v6': raw_attrs['access_ip_v6'],
-        'access_ip': raw_attrs['access_ip_v4'],
-        'access_ip6': raw_attrs['access_ip_v6'],
-        'ip': raw_attrs['network.0.fixed_ip_v4'],
-        'flavor': parse_dict(raw_attrs, 'flavor',
-                             sep='_'),
-        'id': raw_attrs['id'],
-        'image': parse_dict(raw_attrs, 'image',
-                            sep='_'),
-        'key_pair': raw_attrs['key_pair'],
-        'metadata': parse_dict(raw_attrs, 'metadata'),
-        'network': parse_attr_list(raw_attrs, 'network'),
-        'region': raw_attrs.get('region', ''),
-        'security_groups': parse_list(raw_attrs, 'security_groups'),
-        # workaround for an OpenStack bug where hosts have a different domain
-        # after they're restarted
-        'host_domain': 'novalocal',
-        'use_host_domain': True,
-        # generic
-        'public_ipv4': raw_attrs['access_ip_v4'],
-        'private_ipv4': raw_attrs['access_ip_v4'],
-        'port_id' : raw_attrs['network.0.port'],
-        'provider': 'openstack',
-    }
-
-    if 'floating_ip' in raw_attrs:
-        attrs['private_ipv4'] = raw_attrs['network.0.fixed_ip_v4']
+    if has_floating_ip:
+        attrs['private_ipv4'] = attrs['ip']
 
-    if 'metadata.use_access_ip' in raw_attrs and raw_attrs['metadata.use_access_ip'] == "0":
+    if metadata.get('use_access_ip') == "0":
         attrs.pop('access_ip')
 
     try:
-        if 'metadata.prefer_ipv6' in raw_attrs and raw_attrs['metadata.prefer_ipv6'] == "1":
+        if metadata.get('prefer_ipv6') == "1":
             attrs.update({
-                'ansible_host': re.sub(r"[\[\]]", "", raw_attrs['access_ip_v6']),
+                'ansible_host': re.sub(r"[\[\]]", "", attrs['access_ip_v6']),
                 'publicly_routable': True,
             })
         else:
             attrs.update({
-                'ansible_host': raw_attrs['access_ip_v4'],
+                'ansible_host': attrs['access_ip_v4'],
                 'publicly_routable': True,
             })
     except (KeyError, ValueError):
@@ -319,34 +677,28 @@ def openstack_host(resource, module_name):
     # Handling of floating IPs has changed: https://github.com/terraform-providers/terraform-provider-openstack/blob/master/CHANGELOG.md#010-june-21-2017
 
     # attrs specific to Ansible
-    if 'metadata.ssh_user' in raw_attrs:
-        attrs['ansible_user'] = raw_attrs['metadata.ssh_user']
-    if 'metadata.ssh_port' in raw_attrs:
-        attrs['ansible_port'] = raw_attrs['metadata.ssh_port']
-
-    if 'volume.#' in list(raw_attrs.keys()) and int(raw_attrs['volume.#']) > 0:
-        device_index = 1
-        for key, value in list(raw_attrs.items()):
-            match = re.search("^volume.*.device$", key)
-            if match:
-                attrs['disk_volume_device_'+str(device_index)] = value
-                device_index += 1
+    if 'ssh_user' in metadata:
+        attrs['ansible_user'] = metadata['ssh_user']
+    if 'ssh_port' in metadata:
+        attrs['ansible_port'] = metadata['ssh_port']
 
+    for device_index, device in enumerate(volume_devices, 1):
+        attrs['disk_volume_device_'+str(device_index)] = device
 
     # attrs specific to Mantl
     attrs.update({
-        'role': attrs['metadata'].get('role', 'none')
+        'role': metadata.get('role', 'none')
     })
 
     # add groups based on attrs
     groups.append('os_image=' + str(attrs['image']['id']))
     groups.append('os_flavor=' + str(attrs['flavor']['name']))
     groups.extend('os_metadata_%s=%s' % item
-                  for item in list(attrs['metadata'].items()))
+                  for item in list(metadata.items()))
     groups.append('os_region=' + str(attrs['region']))
 
     # groups specific to kubespray
-    for group in attrs['metadata'].get('kubespray_groups', "").split(","):
+    for group in metadata.get('kubespray_groups', "").split(","):
         groups.append(group)
 
     sanitize_groups(groups)
@@ -354,34 +706,134 @@ def openstack_host(resource, module_name):
     return name, attrs, groups
 
 
+@parses('openstack_compute_instance_v2')
+@calculate_mantl_vars
+def openstack_host(resource, module_name):
+    raw_attrs = resource['primary']['attributes']
+
+    volume_devices = []
+    if 'volume.#' in list(raw_attrs.keys()) and int(raw_attrs['volume.#']) > 0:
+        volume_devices = [value for key, value in list(raw_attrs.items())
+                          if re.search("^volume.*.device$", key)]
+
+    return _openstack_host(raw_attrs['name'], {
+        'access_ip_v4': raw_attrs['access_ip_v4'],
+        'access_ip_v6': raw_attrs['access_ip_v6'],
+        'access_ip': raw_attrs['access_ip_v4'],
+        'access_ip6': raw_attrs['access_ip_v6'],
+        'ip': raw_attrs['network.0.fixed_ip_v4'],
+        'flavor': parse_dict(raw_attrs, 'flavor',
+                             sep='_'),
+        'id': raw_attrs['id'],
+        'image': parse_dict(raw_attrs, 'image',
+                            sep='_'),
+        'key_pair': raw_attrs['key_pair'],
+        'metadata': parse_dict(raw_attrs, 'metadata'),
+        'network': parse_attr_list(raw_attrs, 'network'),
+        'region': raw_attrs.get('region', ''),
+        'security_groups': parse_list(raw_attrs, 'security_groups'),
+        # workaround for an OpenStack bug where hosts have a different domain
+        # after they're restarted
+        'host_domain': 'novalocal',
+        'use_host_domain': True,
+        # generic
+        'public_ipv4': raw_attrs['access_ip_v4'],
+        'private_ipv4': raw_attrs['access_ip_v4'],
+        'port_id' : raw_attrs['network.0.port'],
+        'provider': 'openstack',
+    }, volume_devices, 'floating_ip' in raw_attrs)
+
+
+@parses('openstack_compute_instance_v2', version=4, attributes=[
+    'name', 'id', 'access_ip_v4', 'access_ip_v6', 'flavor_id', 'flavor_name', 'image_id', 'image_name',
+    'key_pair', 'metadata', 'network', 'region', 'security_groups', 'floating_ip', 'volume'])
+@calculate_mantl_vars
+def openstack_host_v4(resource, module_name):
+    raw_attrs = resource['attributes']
+    network = [dict(item) for item in raw_attrs.get('network') or []]
+    volume_devices = [volume['device'] for volume in raw_attrs.get('volume') or []
+                      if 'device' in volume]
+
+    return _openstack_host(raw_attrs['name'], {
+        'access_ip_v4': raw_attrs['access_ip_v4'],
+        'access_ip_v6': raw_attrs['access_ip_v6'],
+        'access_ip': raw_attrs['access_ip_v4'],
+        'access_ip6': raw_attrs['access_ip_v6'],
+        'ip': network[0]['fixed_ip_v4'],
+        # flavor_id and flavor_name are top level attributes in both versions
+        'flavor': parse_dict(raw_attrs, 'flavor',
+                             sep='_'),
+        'id': raw_attrs['id'],
+        'image': parse_dict(raw_attrs, 'image',
+                            sep='_'),
+        'key_pair': raw_attrs['key_pair'],
+        'metadata': dict(raw_attrs.get('metadata') or {}),
+        'network': network,
+        'region': raw_attrs.get('region', ''),
+        'security_groups': list(raw_attrs.get('security_groups') or []),
+        # workaround for an OpenStack bug where hosts have a different domain
+        # after they're restarted
+        'host_domain': 'novalocal',
+        'use_host_domain': True,
+        # generic
+        'public_ipv4': raw_attrs['access_ip_v4'],
+        'private_ipv4': raw_attrs['access_ip_v4'],
+        'port_id' : network[0]['port'],
+        'provider': 'openstack',
+    }, volume_devices, 'floating_ip' in raw_attrs)
+
+
 def iter_host_ips(hosts, ips):
     '''Update hosts that have an entry in the floating IP list'''
-    for host in hosts:
-        port_id = host[1]['port_id']
+    for name, attrs, groups in hosts:
+        # a copy, the parsed attrs may be held by the cache
+        attrs = dict(attrs)
+        port_id = attrs.get('port_id')
 
         if port_id in ips:
             ip = ips[port_id]
 
-            host[1].update({
+            attrs.update({
                 'access_ip_v4': ip,
                 'access_ip': ip,
                 'public_ipv4': ip,
                 'ansible_host': ip,
             })
 
-        if 'use_access_ip' in host[1]['metadata'] and host[1]['metadata']['use_access_ip'] == "0" and 'access_ip' in host[1]:
-                host[1].pop('access_ip')
+        if 'use_access_ip' in attrs.get('metadata', {}) and attrs['metadata']['use_access_ip'] == "0" and 'access_ip' in attrs:
+                attrs.pop('access_ip')
 
-        yield host
+        yield name, attrs, groups
 
 
-## QUERY TYPES
-def query_host(hosts, target):
+def load_hosts(filenames, cache=None):
+    '''host tuples of all state files, with the floating IPs applied'''
+    hosts, ips = [], {}
+    for filename in filenames:
+        file_hosts, file_ips = cache.parse(filename) if cache else parse_state(filename)
+        hosts.extend(file_hosts)
+        ips.update(file_ips)
+
+    if ips:
+        hosts = list(iter_host_ips(hosts, ips))
+
+    if cache:
+        cache.index(filenames, index_hosts(hosts))
+        cache.save()
+    return hosts
+
+
+def index_hosts(hosts):
+    '''hostvars by host name; the first host wins when names repeat'''
+    hostvars = {}
     for name, attrs, _ in hosts:
-        if name == target:
-            return attrs
+        hostvars.setdefault(name, attrs)
+    return hostvars
 
-    return {}
+
+## QUERY TYPES
+def query_host(hostvars, target):
+    return hostvars.get(target, {})
 
 
 def query_list(hosts):
@@ -414,6 +866,108 @@ def query_hostfile(hosts):
     return '\n'.join(out)
 
 
+## BENCHMARK
+def synthetic_state(count):
+    '''a version 4 state with count openstack instances, some floating IPs,
+    equinix devices and a large unrelated resource'''
+    provider = 'provider["registry.terraform.io/terraform-provider-openstack/openstack"]'
+    instances = [{
+        'index_key': i,
+        'attributes': {
+            'id': 'instance-%d' % i,
+            'name': 'k8s-node-%d' % i,
+            'access_ip_v4': '10.0.%d.%d' % (i // 250, i % 250 + 1),
+            'access_ip_v6': '',
+            'flavor_id': 'flavor-1',
+            'flavor_name': 'm1.large',
+            'image_id': 'image-1',
+            'image_name': 'ubuntu-22.04',
+            'key_pair': 'kubespray',
+            'region': 'RegionOne',
+            'metadata': {
+                'ssh_user': 'ubuntu',
+                'depends_on': '',
+                'use_access_ip': '0' if i % 7 == 0 else '1',
+                'kubespray_groups': 'kube_control_plane,etcd,k8s_cluster' if i < 3 else 'kube_node,k8s_cluster',
+            },
+            'network': [{
+                'uuid': 'network-1', 'name': 'internal', 'port': 'port-%d' % i, 'mac': 'fa:16:3e:00:00:01',
+                'fixed_ip_v4': '192.168.%d.%d' % (i // 250, i % 250 + 1), 'fixed_ip_v6': '',
+                'floating_ip': '', 'access_network': False,
+            }],
+            'security_groups': ['default', 'k8s-%d' % (i % 3)],
+            'volume': [{'id': 'volume-%d' % i, 'volume_id': 'volume-%d' % i, 'device': '/dev/vdb'}] if i % 2 else [],
+            'block_device': [{'uuid': 'image-1', 'source_type': 'image', 'boot_index': 0,
+                              'delete_on_termination': True}],
+            'user_data': 'x' * 2048,
+        },
+    } for i in range(count)]
+    floating_ips = [{
+        'index_key': i,
+        'attributes': {'id': 'fip-%d' % i, 'floating_ip': '172.24.4.%d' % (i % 250), 'port_id': 'port-%d' % i},
+    } for i in range(0, count, 4)]
+    devices = [{
+        'attributes': {
+            'id': 'device-%d' % i, 'hostname': 'metal-%d' % i, 'facilities': ['ams1'],
+            'operating_system': 'flatcar_stable' if i % 2 else 'ubuntu_22_04', 'locked': False,
+            'tags': ['kube_node', 'k8s_cluster'], 'plan': 'c3.small.x86', 'project_id': 'project',
+            'state': 'active',
+            'network': [{'address': '147.75.0.%d' % i, 'public': True},
+                        {'address': '2604:1380::%d' % i, 'public': True},
+                        {'address': '10.1.0.%d' % i, 'public': False}],
+        },
+    } for i in range(max(count // 100, 1))]
+
+    return {
+        'version': 4,
+        'terraform_version': '1.5.7',
+        'resources': [
+            {'mode': 'managed', 'type': 'openstack_compute_instance_v2', 'name': 'k8s_node',
+             'provider': provider, 'instances': instances},
+            {'mode': 'managed', 'type': 'openstack_networking_floatingip_associate_v2', 'name': 'k8s_node',
+             'provider': provider, 'instances': floating_ips},
+            {'mode': 'managed', 'type': 'equinix_metal_device', 'name': 'k8s_node',
+             'provider': 'provider["registry.terraform.io/equinix/equinix"]', 'instances': devices},
+            {'mode': 'managed', 'type': 'tls_private_key', 'name': 'ssh',
+             'provider': 'provider["registry.terraform.io/hashicorp/tls"]',
+             'instances': [{'attributes': {'id': 'key', 'private_key_pem': 'k' * 65536}}]},
+        ],
+    }
+
+
+def _without_flatmap_counts(hosts):
+    # the flattened path reads the `metadata.%` count as a metadata key
+    # (and group), the native one does not
+    for name, attrs, groups in hosts:
+        if 'metadata' in attrs:
+            attrs = dict(attrs, metadata={k: v for k, v in attrs['metadata'].items() if k != '%'})
+        yield name, attrs, [g for g in groups if not g.startswith('os_metadata_%_')]
+
+
+def benchmark(count, rounds=3):
+    fd, filename = tempfile.mkstemp(suffix='.tfstate')
+    try:
+        with os.fdopen(fd, 'w') as state_file:
+            json.dump(synthetic_state(count), state_file)
+
+        results = {}
+        for label, native in (('flattened', False), ('native', True)):
+            timings = []
+            for _ in range(rounds):
+                started = time.perf_counter()
+                results[label] = parse_state(filename, native)
+                timings.append(time.perf_counter() - started)
+            print('%-9s %8.2f ms (best of %d, %d instances)' % (label, min(timings) * 1000, rounds, count))
+    finally:
+        os.remove(filename)
+
+    flattened_hosts, flattened_ips = results['flattened']
+    native_hosts, native_ips = results['native']
+    if list(_without_flatmap_counts(flattened_hosts)) != native_hosts or flattened_ips != native_ips:
+        raise SystemExit('native and flattened parsers disagree')
+    print('native and flattened parsers agree')
+
+
 def main():
     parser = argparse.ArgumentParser(
         __file__, __doc__,
@@ -429,18 +983,28 @@ def main():
     modes.add_argument('--hostfile',
                        action='store_true',
                        help='print hosts as a /etc/hosts snippet')
+    modes.add_argument('--benchmark',
+                       type=int,
+                       metavar='INSTANCES',
+                       help='time the native and flattened version 4 parsers on a synthetic state')
     parser.add_argument('--pretty',
                         action='store_true',
                         help='pretty-print output JSON')
     parser.add_argument('--nometa',
                         action='store_true',
                         help='with --list, exclude hostvars')
-    default_root = os.environ.get('TERRAFORM_STATE_ROOT',
-                                  os.path.abspath(os.path.join(os.path.dirname(__file__),
-                                                               '..', '..', )))
     parser.add_argument('--root',
-                        default=default_root,
-                        help='custom root to search for `.tfstate`s in')
+                        default=DEFAULT_ROOT,
+                        help='custom root to search for `.tfstate`s in (default: %(default)s)')
+    default_cache = os.environ.get('TERRAFORM_INVENTORY_CACHE',
+                                   os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                                'kubespray', 'terraform-inventory.json'))
+    parser.add_argument('--cache',
+                        default=default_cache,
+                        help='file caching the hosts parsed from each `.tfstate`')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='parse every `.tfstate` again')
 
     args = parser.parse_args()
 
@@ -448,22 +1012,28 @@ def main():
         print('%s %s' % (__file__, VERSION))
         parser.exit()
 
-    hosts = iterhosts(iterresources(tfstates(args.root)))
+    if args.benchmark:
+        benchmark(args.benchmark)
+        parser.exit()
 
-    # Perform a second pass on the file to pick up floating_ip entries to update the ip address of referenced hosts
-    ips = dict(iterips(iterresources(tfstates(args.root))))
+    filenames = list(tfstates(args.root))
+    cache = None if args.no_cache else ParseCache(args.cache)
 
-    if ips:
-        hosts = iter_host_ips(hosts, ips)
+    if args.host:
+        # served from the cache as long as no state file changed
+        hostvars = cache and cache.hostvars(filenames)
+        if hostvars is None:
+            hostvars = index_hosts(load_hosts(filenames, cache))
+        print(json.dumps(query_host(hostvars, args.host), indent=4 if args.pretty else None))
+        parser.exit()
+
+    hosts = load_hosts(filenames, cache)
 
     if args.list:
         output = query_list(hosts)
         if args.nometa:
             del output['_meta']
         print(json.dumps(output, indent=4 if args.pretty else None))
-    elif args.host:
-        output = query_host(hosts, args.host)
-        print(json.dumps(output, indent=4 if args.pretty else None))
     elif args.hostfile:
         output = query_hostfile(hosts)
         print(output)
@@ -6,7 +6,7 @@ DOCUMENTATION = """
 module: kube
 short_description: Manage Kubernetes Cluster
 description:
-  - Create, replace, remove, and stop resources within a Kubernetes Cluster
+  - Create, replace, remove, and scale resources within a Kubernetes Cluster
 version_added: "2.0"
 options:
   name:
@@ -55,7 +55,8 @@ options:
     required: false
     default: false
     description:
-      - A flag to indicate to force delete, replace, or stop.
+      - A flag to indicate to force delete or replace. With server-side apply
+        it takes over fields owned by other field managers (--force-conflicts).
   wait:
     required: false
     default: false
@@ -65,7 +66,7 @@ options:
     required: false
     default: false
     description:
-      - A flag to indicate delete all, stop all, or all namespaces when checking exists.
+      - A flag to indicate delete all, scale all, or all namespaces when checking exists.
   log_level:
     required: false
     default: 0
@@ -73,14 +74,21 @@ options:
       - Indicates the level of verbosity of logging by kubectl.
   state:
     required: false
-    choices: ['present', 'absent', 'latest', 'reloaded', 'stopped']
+    choices: ['present', 'absent', 'latest', 'reloaded', 'stopped', 'scaled', 'exists']
     default: present
     description:
       - present handles checking existence or creating if definition file provided,
         absent handles deleting resource(s) based on other options,
         latest handles creating or updating based on existence,
         reloaded handles updating resource(s) definition using definition file,
-        stopped handles stopping resource(s) based on other options.
+        scaled sets replicas on the resource(s) selected by the other options,
+        stopped scales the selected resource(s) to 0 replicas.
+  replicas:
+    required: false
+    default: null
+    description:
+      - Replica count for state=scaled. Objects already at this count are
+        left alone and reported as unchanged.
   recursive:
     required: false
     default: false
@@ -88,8 +96,63 @@ options:
       - Process the directory used in -f, --filename recursively.
         Useful when you want to manage related manifests organized
         within the same directory.
+  server_side:
+    required: false
+    default: false
+    description:
+      - Apply with server-side apply. All files given in filename are sent
+        in a single kubectl call and the result lists every object applied.
+  field_manager:
+    required: false
+    default: kubespray
+    description:
+      - Field manager recorded for server-side apply.
+  cache_dir:
+    required: false
+    default: null
+    description:
+      - Discovery cache directory passed to kubectl. Sharing one directory
+        across tasks lets kubectl skip API discovery on every call.
+        The api backend keeps its own discovery cache below it.
+  backend:
+    required: false
+    default: kubectl
+    choices: ['kubectl', 'api']
+    description:
+      - kubectl runs kubectl for every operation. api talks to the API server
+        directly using the kubeconfig (or server), keeps one connection open
+        for the whole task and always applies with server-side apply.
+        The api backend does not support manifest URLs.
+  wait_for:
+    required: false
+    default: null
+    choices: ['ready', 'rollout']
+    description:
+      - After applying, watch the objects in filename until they are ready
+        (Deployment available, DaemonSet/StatefulSet pods ready, Pod ready,
+        Job complete) or fully rolled out (all replicas updated and available,
+        like kubectl rollout status). Other kinds only need to exist.
+        The result has a wait entry with the status of every object.
+  wait_timeout:
+    required: false
+    default: 300
+    description:
+      - Seconds to wait for wait_for before failing.
+notes:
+  - changed is only reported when something actually changes. The kubectl
+    backend applies with a single kubectl call and compares the objects it
+    returns (without status) with the last apply of the same files, recorded
+    below cache_dir, so the first apply after that record is lost reports
+    changed. The api backend compares a dryRun apply with the live objects
+    and writes nothing for objects that are already up to date.
+  - Check mode runs kubectl diff (a server-side dry-run) with the kubectl
+    backend, or the dryRun comparison when the diff command is missing and
+    with the api backend.
+  - Apply states return digest, a sha256 of the applied objects as the
+    server stores them.
 requirements:
   - kubectl
+  - PyYAML (backend=api, wait_for, and check mode without the diff command)
 author: "Kenny Jones (@kenjones-cisco)"
 """
 
@@ -100,6 +163,14 @@ EXAMPLES = """
 - name: test nginx is stopped
   kube: name=nginx resource=rc state=stopped
 
+- name: scale down every addon deployment labelled for maintenance
+  kube:
+    namespace: kube-system
+    resource: deployments
+    label: maintenance.kubespray.io/scale-down=true
+    state: scaled
+    replicas: 0
+
 - name: test nginx is absent
   kube: name=nginx resource=rc state=absent
 
@@ -114,8 +185,515 @@ EXAMPLES = """
     files:
       - /tmp/nginx.yml
       - /tmp/postgresql.yml
+
+- name: apply all addon manifests in one server-side apply
+  kube:
+    kubectl: "{{ bin_dir }}/kubectl"
+    filename: "{{ addon_manifests.results | map(attribute='dest') | list }}"
+    server_side: true
+    cache_dir: /root/.kube/cache
+    state: latest
+
+- name: apply manifests without forking kubectl
+  kube:
+    kubeconfig: /etc/kubernetes/admin.conf
+    filename: /etc/kubernetes/addons/coredns.yml
+    backend: api
+    state: latest
+
+- name: apply and wait until the rollout finished
+  kube:
+    kubectl: "{{ bin_dir }}/kubectl"
+    filename: /etc/kubernetes/addons/coredns.yml
+    state: latest
+    wait_for: rollout
+    wait_timeout: 600
 """
 
+import base64
+import hashlib
+import json
+import os
+import socket
+import ssl
+import tempfile
+import time
+
+import http.client as httplib
+from urllib.parse import quote, urlencode, urlparse
+
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
+
+DISCOVERY_TTL = 600
+# Seconds before re-watching after a watch failed or ended without events, doubling up to the max
+WATCH_RETRY_DELAY = 0.5
+WATCH_RETRY_MAX = 5
+MANIFEST_EXTENSIONS = ('.json', '.yaml', '.yml')
+
+
+class KubeApiError(Exception):
+
+    def __init__(self, status, message):
+        super(KubeApiError, self).__init__('%s (HTTP %s)' % (message, status))
+        self.status = status
+
+
+# Failures of the api backend reported through fail_json
+API_ERRORS = (KubeApiError, httplib.HTTPException, OSError, ValueError) + ((yaml.YAMLError,) if HAS_YAML else ())
+
+
+def manifest_paths(filenames, recursive=False):
+    """Expand directories in filename to the manifest files kubectl -f would read."""
+    paths = []
+    for filename in filenames:
+        if not os.path.isdir(filename):
+            paths.append(filename)
+            continue
+        for root, dirs, files in os.walk(filename):
+            paths.extend(os.path.join(root, f) for f in sorted(files) if f.endswith(MANIFEST_EXTENSIONS))
+            if not recursive:
+                break
+            dirs.sort()
+    return paths
+
+
+def applied_digest(objects):
+    """sha256 over the objects as the server stores them; it only changes when one of them does."""
+    digest = hashlib.sha256()
+    for obj in objects:
+        digest.update(json.dumps(comparable(obj) if obj else None, sort_keys=True).encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+def comparable(obj):
+    """An object without the fields the server changes on every write."""
+    obj = dict(obj)
+    obj.pop('status', None)
+    metadata = obj['metadata'] = dict(obj.get('metadata') or {})
+    for key in ('managedFields', 'resourceVersion', 'generation', 'creationTimestamp'):
+        metadata.pop(key, None)
+    return obj
+
+
+def load_manifests(filenames, recursive=False):
+    """Return the objects defined in files or directories, like kubectl -f."""
+    objects = []
+    for path in manifest_paths(filenames, recursive):
+        with open(path) as f:
+            for doc in yaml.safe_load_all(f):
+                if not doc:
+                    continue
+                if doc.get('kind', '').endswith('List') and 'items' in doc:
+                    objects.extend(doc['items'])
+                else:
+                    objects.append(doc)
+    return objects
+
+
+def object_ref(obj):
+    """The kubectl-style "<kind>.<group>/<name>" used in results."""
+    group = obj['apiVersion'].rpartition('/')[0]
+    kind = obj['kind'].lower() + ('.' + group if group else '')
+    return '%s/%s' % (kind, obj['metadata'].get('name', ''))
+
+
+def object_status(kind, obj, mode):
+    """
+    Return (ready, reason) for an object; ready is None once it can no longer
+    become ready. mode is 'ready' (serving) or 'rollout' (fully updated), with
+    the same checks as kubectl rollout status. Kinds without a status are
+    ready as soon as they exist.
+    """
+    spec = obj.get('spec') or {}
+    status = obj.get('status') or {}
+    generation = obj['metadata'].get('generation')
+    conditions = dict((c['type'], c.get('status')) for c in status.get('conditions') or [])
+
+    if kind in ('Deployment', 'DaemonSet', 'StatefulSet') and generation \
+            and status.get('observedGeneration', 0) < generation:
+        return False, 'waiting for the controller to observe generation %d' % generation
+
+    if kind == 'Deployment':
+        replicas = spec.get('replicas', 1)
+        updated = status.get('updatedReplicas', 0)
+        available = status.get('availableReplicas', 0)
+        # the controller gave up on the rollout, waiting longer will not help
+        stalled = any(c['type'] == 'Progressing' and c.get('reason') == 'ProgressDeadlineExceeded'
+                      for c in status.get('conditions') or [])
+        if mode == 'rollout':
+            if stalled:
+                return None, 'progress deadline exceeded'
+            if updated < replicas:
+                return False, '%d of %d replicas updated' % (updated, replicas)
+            if status.get('replicas', 0) > updated:
+                return False, '%d old replicas pending termination' % (status['replicas'] - updated)
+        elif conditions.get('Available') == 'True':
+            return True, 'available'
+        elif stalled:
+            return None, 'progress deadline exceeded'
+        if available < replicas:
+            return False, '%d of %d replicas available' % (available, replicas)
+        return True, 'available'
+
+    if kind == 'DaemonSet':
+        desired = status.get('desiredNumberScheduled', 0)
+        if mode == 'rollout' and status.get('updatedNumberScheduled', 0) < desired:
+            return False, '%d of %d pods updated' % (status.get('updatedNumberScheduled', 0), desired)
+        ready = status.get('numberAvailable' if mode == 'rollout' else 'numberReady', 0)
+        if ready < desired:
+            return False, '%d of %d pods ready' % (ready, desired)
+        return True, 'ready'
+
+    if kind == 'StatefulSet':
+        replicas = spec.get('replicas', 1)
+        if mode == 'rollout':
+            if status.get('updatedReplicas', 0) < replicas:
+                return False, '%d of %d replicas updated' % (status.get('updatedReplicas', 0), replicas)
+            if status.get('currentRevision') != status.get('updateRevision'):
+                return False, 'waiting for revision %s' % status.get('updateRevision')
+        if status.get('readyReplicas', 0) < replicas:
+            return False, '%d of %d replicas ready' % (status.get('readyReplicas', 0), replicas)
+        return True, 'ready'
+
+    if kind == 'Pod':
+        if status.get('phase') == 'Succeeded' or conditions.get('Ready') == 'True':
+            return True, 'ready'
+        if status.get('phase') == 'Failed':
+            return None, 'failed'
+        return False, status.get('phase', 'Pending').lower()
+
+    if kind == 'Job':
+        if conditions.get('Complete') == 'True':
+            return True, 'complete'
+        if conditions.get('Failed') == 'True':
+            return None, 'failed'
+        return False, 'running'
+
+    return True, 'exists'
+
+
+def _named(entries, name):
+    for entry in entries or []:
+        if entry.get('name') == name:
+            return entry
+    return {}
+
+
+class KubeApi(object):
+    """
+    Minimal Kubernetes API client built from a kubeconfig.
+
+    All requests of a module run share one kept-alive connection, and API
+    discovery results are cached on disk for DISCOVERY_TTL seconds so a task
+    only pays for the requests that touch its own objects.
+    """
+
+    def __init__(self, kubeconfig=None, server=None, cache_dir=None, timeout=30):
+        path = kubeconfig or os.environ.get('KUBECONFIG', '').split(os.pathsep)[0] \
+            or os.path.expanduser('~/.kube/config')
+        config = {}
+        if kubeconfig or not server or os.path.exists(path):
+            with open(path) as f:
+                config = yaml.safe_load(f) or {}
+        base_dir = os.path.dirname(os.path.abspath(path))
+
+        context = _named(config.get('contexts'), config.get('current-context')).get('context', {})
+        cluster = _named(config.get('clusters'), context.get('cluster')).get('cluster', {})
+        user = _named(config.get('users'), context.get('user')).get('user', {})
+
+        self.default_namespace = context.get('namespace') or 'default'
+        url = urlparse(server or cluster.get('server') or 'http://localhost:8080')
+        self.secure = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port or (443 if self.secure else 80)
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.headers = {'Accept': 'application/json', 'User-Agent': 'kubespray-kube-module'}
+        self.ssl_context = self._ssl_context(cluster, user, base_dir) if self.secure else None
+
+        token = user.get('token')
+        if not token and user.get('tokenFile'):
+            with open(os.path.join(base_dir, user['tokenFile'])) as f:
+                token = f.read().strip()
+        if token:
+            self.headers['Authorization'] = 'Bearer ' + token
+
+        cache_root = cache_dir or os.path.expanduser('~/.kube/cache')
+        server_key = hashlib.sha1(url.geturl().encode('utf-8')).hexdigest()[:16]
+        self.cache_path = os.path.join(cache_root, 'kubespray-discovery', server_key + '.json')
+        self._discovery = None
+        self._conn = None
+
+    @staticmethod
+    def _ssl_context(cluster, user, base_dir):
+        ctx = ssl.create_default_context()
+        if cluster.get('insecure-skip-tls-verify'):
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        elif cluster.get('certificate-authority-data'):
+            ctx.load_verify_locations(cadata=base64.b64decode(cluster['certificate-authority-data']).decode('ascii'))
+        elif cluster.get('certificate-authority'):
+            ctx.load_verify_locations(cafile=os.path.join(base_dir, cluster['certificate-authority']))
+
+        if user.get('client-certificate-data'):
+            # ssl only loads client certificates from files
+            paths = []
+            try:
+                for key in ('client-certificate-data', 'client-key-data'):
+                    fd, tmp = tempfile.mkstemp()
+                    paths.append(tmp)
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(base64.b64decode(user[key]))
+                ctx.load_cert_chain(paths[0], paths[1])
+            finally:
+                for tmp in paths:
+                    os.unlink(tmp)
+        elif user.get('client-certificate'):
+            ctx.load_cert_chain(os.path.join(base_dir, user['client-certificate']),
+                                os.path.join(base_dir, user['client-key']))
+        return ctx
+
+    def _connect(self, timeout=None):
+        timeout = timeout or self.timeout
+        if self.secure:
+            return httplib.HTTPSConnection(self.host, self.port, timeout=timeout, context=self.ssl_context)
+        return httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def request(self, method, path, body=None, query=None, content_type='application/json'):
+        """Send one request and return (status, decoded JSON body)."""
+        url = self.prefix + path
+        if query:
+            url += '?' + urlencode(query)
+        headers = dict(self.headers)
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = content_type
+
+        for attempt in (0, 1):
+            if self._conn is None:
+                self._conn = self._connect()
+            try:
+                self._conn.request(method, url, data, headers)
+                response = self._conn.getresponse()
+                payload = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                # The server may have closed the kept-alive connection; retry once on a new one
+                self.close()
+                if attempt:
+                    raise
+
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+        try:
+            result = json.loads(payload.decode('utf-8')) if payload else None
+        except ValueError:
+            result = None
+        if response.status >= 400 and response.status != 404:
+            message = result.get('message') if isinstance(result, dict) else payload.decode('utf-8', 'replace')
+            raise KubeApiError(response.status, '%s %s failed: %s' % (method, path, message))
+        return response.status, result
+
+    def _load_discovery(self):
+        if self._discovery is None:
+            try:
+                with open(self.cache_path) as f:
+                    self._discovery = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._discovery = {}
+        return self._discovery
+
+    def _save_discovery(self):
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._discovery, f)
+            os.rename(tmp, self.cache_path)
+        except (IOError, OSError):
+            pass  # the cache is only an optimisation
+
+    def _discover(self, key, path, parse, refresh=False):
+        discovery = self._load_discovery()
+        entry = discovery.get(key)
+        if refresh or not entry or time.time() - entry['fetched'] > DISCOVERY_TTL:
+            status, data = self.request('GET', path)
+            if status == 404:
+                return None
+            entry = {'fetched': time.time(), 'data': parse(data)}
+            discovery[key] = entry
+            self._save_discovery()
+        return entry['data']
+
+    def resources(self, group_version, refresh=False):
+        path = '/api/v1' if group_version == 'v1' else '/apis/' + group_version
+        return self._discover(group_version, path, lambda data: [
+            {'name': r['name'], 'kind': r['kind'], 'namespaced': r['namespaced'],
+             'names': [r['name'], r.get('singularName') or r['kind'].lower()] + r.get('shortNames', [])}
+            for r in data.get('resources', []) if '/' not in r['name']
+        ], refresh) or []
+
+    def group_versions(self, refresh=False):
+        return self._discover('__groups__', '/apis', lambda data: ['v1'] + [
+            g['preferredVersion']['groupVersion'] for g in data.get('groups', [])
+        ], refresh) or ['v1']
+
+    def resource_for(self, api_version, kind):
+        """Resource info for an object's apiVersion/kind, rediscovering once on a miss."""
+        for refresh in (False, True):
+            for resource in self.resources(api_version, refresh):
+                if resource['kind'] == kind:
+                    return resource
+        raise KubeApiError(404, 'no resource for %s %s' % (api_version, kind))
+
+    def resolve(self, name):
+        """Resolve a kubectl resource argument (ds, deployment, deployments.apps) to (group_version, resource)."""
+        name, _, group = name.lower().partition('.')
+        for refresh in (False, True):
+            for group_version in self.group_versions(refresh):
+                if group and group_version.rpartition('/')[0] != group:
+                    continue
+                for resource in self.resources(group_version, refresh):
+                    if name in resource['names'] or name == resource['kind'].lower():
+                        return group_version, resource
+        raise KubeApiError(404, 'unknown resource type %s' % name)
+
+    def path(self, group_version, resource, namespace=None, name=None, subresource=None):
+        parts = ['/api/v1' if group_version == 'v1' else '/apis/' + group_version]
+        if resource['namespaced'] and namespace:
+            parts += ['namespaces', quote(namespace)]
+        parts.append(resource['name'])
+        if name:
+            parts.append(quote(name))
+            if subresource:
+                parts.append(subresource)
+        return '/'.join(parts)
+
+    def object_path(self, obj, namespace=None):
+        if not obj['metadata'].get('name'):
+            # e.g. generateName, which apply does not support either
+            raise KubeApiError(422, '%s without metadata.name cannot be applied' % obj['kind'])
+        resource = self.resource_for(obj['apiVersion'], obj['kind'])
+        namespace = obj['metadata'].get('namespace') or namespace or self.default_namespace
+        return self.path(obj['apiVersion'], resource, namespace, obj['metadata']['name'])
+
+    def apply(self, obj, field_manager, force=False, namespace=None, dry_run=False):
+        query = {'fieldManager': field_manager}
+        if force:
+            query['force'] = 'true'
+        if dry_run:
+            query['dryRun'] = 'All'
+        # JSON is valid YAML, so the object is sent as an apply patch as is
+        path = self.object_path(obj, namespace)
+        status, result = self.request('PATCH', path, obj, query, 'application/apply-patch+yaml')
+        if status == 404:
+            # only get and delete treat 404 as absent, here it is e.g. a missing namespace
+            message = result.get('message') if isinstance(result, dict) else 'not found'
+            raise KubeApiError(status, 'PATCH %s failed: %s' % (path, message))
+        return result
+
+    def get(self, path, query=None):
+        status, result = self.request('GET', path, query=query)
+        return None if status == 404 else result
+
+    def delete(self, path):
+        status, result = self.request('DELETE', path, {'propagationPolicy': 'Background'})
+        return status != 404
+
+    def watch(self, path, query, timeout):
+        """Yield watch events from a collection on a dedicated connection."""
+        query = dict(query, watch='true', timeoutSeconds=max(1, int(timeout)))
+        conn = self._connect(timeout + 5)
+        try:
+            conn.request('GET', '%s%s?%s' % (self.prefix, path, urlencode(query)), headers=self.headers)
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise KubeApiError(response.status, 'watch %s failed' % path)
+            for line in response:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            conn.close()
+
+    def wait(self, objects, mode, timeout, namespace=None):
+        """
+        Watch objects until each one is ready or the timeout expires.
+
+        Each object is listed and then watched from the list's resource
+        version, both narrowed to its name, so no object is ever polled and
+        unrelated events in the namespace are never read. A watch that fails
+        or ends without events is retried with a growing delay, and one whose
+        resource version expired (410 Gone) lists the object again.
+        Returns a status entry per object.
+        """
+        deadline = time.time() + timeout
+        results = []
+        for obj in objects:
+            resource = self.resource_for(obj['apiVersion'], obj['kind'])
+            collection = self.path(obj['apiVersion'], resource,
+                                   obj['metadata'].get('namespace') or namespace or self.default_namespace)
+            entry = {'object': object_ref(obj), 'kind': obj['kind'], 'ready': False, 'status': 'not found'}
+            results.append(entry)
+            query = {'fieldSelector': 'metadata.name=' + obj['metadata']['name']}
+            version = None
+            delay = WATCH_RETRY_DELAY
+            done = False
+            while not done and time.time() < deadline:
+                if version is None:
+                    listed = self.get(collection, query) or {}
+                    version = (listed.get('metadata') or {}).get('resourceVersion')
+                    for item in listed.get('items') or []:
+                        done = self._observe(entry, item, mode)
+                    if done:
+                        break
+                watch_query = dict(query, resourceVersion=version) if version else query
+                progressed = False
+                try:
+                    for event in self.watch(collection, watch_query, deadline - time.time()):
+                        if event['type'] == 'ERROR':
+                            if (event.get('object') or {}).get('code') == 410:
+                                version = None
+                            break
+                        progressed = True
+                        version = event['object']['metadata'].get('resourceVersion') or version
+                        if event['type'] == 'DELETED':
+                            entry['ready'], entry['status'] = False, 'deleted'
+                        elif self._observe(entry, event['object'], mode):
+                            done = True
+                            break
+                except KubeApiError as exc:
+                    if exc.status != 410:
+                        raise
+                    version = None
+                except socket.timeout:
+                    break
+                if progressed:
+                    delay = WATCH_RETRY_DELAY
+                elif not done:
+                    time.sleep(max(0, min(delay, deadline - time.time())))
+                    delay = min(delay * 2, WATCH_RETRY_MAX)
+        return results
+
+    @staticmethod
+    def _observe(entry, obj, mode):
+        """Update a wait entry from the object's status; True once waiting can stop."""
+        ready, entry['status'] = object_status(entry['kind'], obj, mode)
+        entry['ready'] = bool(ready)
+        return ready is not False
+
 
 class KubeManager(object):
 
@@ -125,7 +703,8 @@ class KubeManager(object):
 
         self.kubectl = module.params.get('kubectl')
         if self.kubectl is None:
-            self.kubectl =  module.get_bin_path('kubectl', True)
+            # the api backend never runs kubectl
+            self.kubectl = module.get_bin_path('kubectl', module.params.get('backend') == 'kubectl') or 'kubectl'
         self.base_cmd = [self.kubectl]
 
         if module.params.get('server'):
@@ -140,6 +719,8 @@ class KubeManager(object):
         if module.params.get('namespace'):
             self.base_cmd.append('--namespace=' + module.params.get('namespace'))
 
+        if module.params.get('cache_dir'):
+            self.base_cmd.append('--cache-dir=' + module.params.get('cache_dir'))
 
         self.all = module.params.get('all')
         self.force = module.params.get('force')
@@ -149,6 +730,30 @@ class KubeManager(object):
         self.resource = module.params.get('resource')
         self.label = module.params.get('label')
         self.recursive = module.params.get('recursive')
+        self.server_side = module.params.get('server_side')
+        self.field_manager = module.params.get('field_manager')
+        self.namespace = module.params.get('namespace')
+        self.objects = []
+        self.changed = False
+        self.diff = None
+        # the applied objects as the server stores them, for the digest
+        self.applied = None
+        self.api = None
+        self._manifests = None
+
+    def manifests(self):
+        if self._manifests is None:
+            self._manifests = load_manifests(self.filename, self.recursive)
+        return self._manifests
+
+    def _client(self):
+        """KubeApi used to read the objects in filename, None when they cannot be read here."""
+        if self.api is None:
+            if not HAS_YAML or any('://' in f for f in self.filename):
+                return None
+            self.api = KubeApi(self.module.params.get('kubeconfig'), self.module.params.get('server'),
+                               self.module.params.get('cache_dir'))
+        return self.api
 
     def _execute(self, cmd):
         args = self.base_cmd + cmd
@@ -162,6 +767,80 @@ class KubeManager(object):
                 msg='error running kubectl (%s) command: %s' % (' '.join(args), str(exc)))
         return out.splitlines()
 
+    @staticmethod
+    def _parse_applied(out):
+        """Objects printed by kubectl apply --output=json, as the server stores them."""
+        # one object, a List, or with some kubectl versions one document per object
+        decoder = json.JSONDecoder()
+        objects = []
+        pos = 0
+        out = out.strip()
+        while pos < len(out):
+            try:
+                doc, pos = decoder.raw_decode(out, pos)
+            except ValueError:
+                break
+            objects.extend(doc.get('items', []) if doc.get('kind') == 'List' else [doc])
+            while pos < len(out) and out[pos].isspace():
+                pos += 1
+        return [obj for obj in objects if isinstance(obj, dict) and obj.get('metadata')]
+
+    def _execute_apply(self, cmd):
+        args = self.base_cmd + cmd + ['--output=json']
+        try:
+            rc, out, err = self.module.run_command(args)
+        except Exception as exc:
+            self.module.fail_json(
+                msg='error running kubectl (%s) command: %s' % (' '.join(args), str(exc)))
+        applied = self._parse_applied(out)
+        if rc != 0:
+            # kubectl keeps applying the remaining objects, report which made it
+            self.module.fail_json(
+                msg='error running kubectl (%s) command (rc=%d), err=\'%s\'' % (' '.join(args), rc, err),
+                objects=[{'object': object_ref(obj), 'result': 'applied'} for obj in applied])
+        return applied
+
+    def _state_path(self):
+        # one record per set of files and cluster, next to kubectl's discovery cache
+        key = json.dumps([self.module.params.get('server'), self.module.params.get('kubeconfig'),
+                          self.namespace, self.filename, self.recursive])
+        root = self.module.params.get('cache_dir') or os.path.expanduser('~/.kube/cache')
+        return os.path.join(root, 'kubespray-applied', hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '.json')
+
+    def _record(self, applied):
+        """
+        Set changed and each object's result by comparing the applied objects
+        with the last apply of the same files, then store them for the next one.
+
+        Only a sha256 of each object without status and write bookkeeping is
+        kept, so status updates between runs do not count as changes.
+        """
+        path = self._state_path()
+        try:
+            with open(path) as f:
+                previous = json.load(f)
+        except (IOError, OSError, ValueError):
+            previous = {}
+
+        current = {}
+        for obj in applied:
+            uid = obj['metadata'].get('uid')
+            current[uid] = applied_digest([obj])
+            result = 'unchanged' if uid and previous.get(uid) == current[uid] else \
+                'serverside-applied' if self.server_side else 'configured'
+            self.changed = self.changed or result != 'unchanged'
+            self.objects.append({'object': object_ref(obj), 'result': result})
+
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(current, f)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass  # the next apply then reports its objects as changed
+
     def _execute_nofail(self, cmd):
         args = self.base_cmd + cmd
         rc, out, err = self.module.run_command(args)
@@ -169,13 +848,18 @@ class KubeManager(object):
             return None
         return out.splitlines()
 
-    def create(self, check=True, force=True):
-        if check and self.exists():
-            return []
-
+    def _apply_cmd(self, force, action):
         cmd = ['apply']
 
-        if force:
+        if self.server_side:
+            cmd.append('--server-side')
+            cmd.append('--field-manager=' + self.field_manager)
+            # --force (delete and re-create) is not allowed with server-side apply,
+            # and create/replace always pass force, so only the force option
+            # takes over fields owned by other managers
+            if self.force:
+                cmd.append('--force-conflicts')
+        elif force:
             cmd.append('--force')
 
         if self.wait:
@@ -185,34 +869,105 @@ class KubeManager(object):
             cmd.append('--recursive={}'.format(self.recursive))
 
         if not self.filename:
-            self.module.fail_json(msg='filename required to create')
+            self.module.fail_json(msg='filename required to ' + action)
 
         cmd.append('--filename=' + ','.join(self.filename))
+        return cmd
 
-        return self._execute(cmd)
+    def _diff_cmd(self):
+        cmd = ['diff']
 
-    def replace(self, force=True):
+        if self.server_side:
+            cmd.append('--server-side')
+            cmd.append('--field-manager=' + self.field_manager)
+            if self.force:
+                cmd.append('--force-conflicts')
 
-        cmd = ['apply']
+        if self.recursive:
+            cmd.append('--recursive={}'.format(self.recursive))
 
-        if force:
-            cmd.append('--force')
+        cmd.append('--filename=' + ','.join(self.filename))
+        return cmd
 
-        if self.wait:
-            cmd.append('--wait')
+    def _apply(self, force, action):
+        cmd = self._apply_cmd(force, action)
 
-        if self.recursive:
-            cmd.append('--recursive={}'.format(self.recursive))
+        if self.module.check_mode:
+            self._check()
+            return []
 
-        if not self.filename:
-            self.module.fail_json(msg='filename required to reload')
+        # kubectl prints serverside-applied even for no-op applies, so what
+        # changed is worked out from the objects it returns
+        self.applied = self._execute_apply(cmd)
+        self._record(self.applied)
+        return ['%(object)s %(result)s' % o for o in self.objects if o['result'] != 'unchanged']
+
+    def _check(self):
+        """Find out for check mode whether an apply would change anything, without writing."""
+        if self.module.get_bin_path('diff') or os.environ.get('KUBECTL_EXTERNAL_DIFF'):
+            # kubectl diff runs a server-side dry-run and exits 1 when anything would change
+            rc, out, err = self.module.run_command(self.base_cmd + self._diff_cmd())
+            if rc > 1:
+                self.module.fail_json(msg='error running kubectl diff (rc=%d), err=\'%s\'' % (rc, err))
+            self.changed = rc == 1
+            self.diff = out or None
+            return
+
+        api = self._client()
+        if api is None:
+            self.module.fail_json(msg='check mode needs the diff command or PyYAML to compare the manifests')
+        self._server_apply(api)
+
+    def _server_apply(self, api):
+        """Apply the objects in filename through api, skipping those a dry run shows are up to date."""
+        result = []
+        self.applied = []
+        for obj in self.manifests():
+            ref = object_ref(obj)
+            try:
+                path = api.object_path(obj, self.namespace)
+            except KubeApiError as exc:
+                if exc.status != 404 or not self.module.check_mode:
+                    raise
+                # a kind defined by a CRD that is applied along with it
+                self.changed = True
+                self.objects.append({'object': ref, 'result': 'serverside-applied (dry run)'})
+                continue
+            live = api.get(path)
+            if live is not None or self.module.check_mode:
+                # in check mode the dry run also reports what a real apply would fail on
+                merged = api.apply(obj, self.field_manager, self.force, self.namespace, dry_run=True)
+                if live is not None and comparable(merged) == comparable(live):
+                    self.objects.append({'object': ref, 'result': 'unchanged'})
+                    self.applied.append(live)
+                    continue
+
+            self.changed = True
+            if self.module.check_mode:
+                applied = 'serverside-applied (dry run)'
+                self.applied.append(merged)
+            else:
+                applied = 'serverside-applied'
+                self.applied.append(api.apply(obj, self.field_manager, self.force, self.namespace))
+            self.objects.append({'object': ref, 'result': applied})
+            result.append('%s %s' % (ref, applied))
+        return result
 
-        cmd.append('--filename=' + ','.join(self.filename))
+    def create(self, check=True, force=True):
+        if check and self.exists():
+            return []
 
-        return self._execute(cmd)
+        return self._apply(force, 'create')
+
+    def replace(self, force=True):
+        return self._apply(force, 'reload')
 
     def delete(self):
 
+        if self.module.check_mode:
+            self.changed = self.exists()
+            return []
+
         if not self.force and not self.exists():
             return []
 
@@ -243,7 +998,9 @@ class KubeManager(object):
             if self.recursive:
                 cmd.append('--recursive={}'.format(self.recursive))
 
-        return self._execute(cmd)
+        result = self._execute(cmd)
+        self.changed = bool(result)
+        return result
 
     def exists(self):
         cmd = ['get']
@@ -274,13 +1031,20 @@ class KubeManager(object):
             return False
         return True
 
-    # TODO: This is currently unused, perhaps convert to 'scale' with a replicas param?
-    def stop(self):
+    def wait_until(self, mode, timeout):
+        if not HAS_YAML:
+            self.module.fail_json(msg='PyYAML is required for wait_for')
+        if not self.filename:
+            self.module.fail_json(msg='filename required for wait_for')
 
-        if not self.force and not self.exists():
-            return []
+        api = self._client()
+        if api is None:
+            self.module.fail_json(msg='wait_for does not support manifest URLs')
+        return api.wait(self.manifests(), mode, timeout, self.namespace)
 
-        cmd = ['stop']
+    def scale(self, replicas):
+        """Scale the selected objects that are not at replicas yet, one kubectl call per namespace."""
+        cmd = ['get']
 
         if self.filename:
             cmd.append('--filename=' + ','.join(self.filename))
@@ -288,7 +1052,9 @@ class KubeManager(object):
                 cmd.append('--recursive={}'.format(self.recursive))
         else:
             if not self.resource:
-                self.module.fail_json(msg='resource required to stop without filename')
+                self.module.fail_json(msg='resource required to scale without filename')
+            if not (self.name or self.label or self.all):
+                self.module.fail_json(msg='name, label or all required to scale %s' % self.resource)
 
             cmd.append(self.resource)
 
@@ -298,13 +1064,147 @@ class KubeManager(object):
             if self.label:
                 cmd.append('--selector=' + self.label)
 
-            if self.all:
-                cmd.append('--all')
+        cmd.append('--ignore-not-found')
+        cmd.append('--output=json')
+
+        output = '\n'.join(self._execute(cmd))
+        listing = json.loads(output) if output.strip() else {'items': []}
+        pending = {}
+        for item in listing.get('items', [listing]):
+            ref = object_ref(item)
+            if item.get('spec', {}).get('replicas') == replicas:
+                self.objects.append({'object': ref, 'result': 'unchanged'})
+            else:
+                pending.setdefault(item['metadata'].get('namespace'), []).append(ref)
+                self.objects.append({'object': ref, 'result': 'scaled'})
+
+        self.changed = bool(pending)
+        if self.module.check_mode:
+            return []
 
-            if self.force:
-                cmd.append('--ignore-not-found')
+        result = []
+        for namespace, refs in sorted(pending.items()):
+            cmd = ['scale', '--replicas=%d' % replicas] + refs
+            if namespace:
+                cmd.append('--namespace=' + namespace)
+            result.extend(self._execute(cmd))
+        return result
+
+
+class KubeApiManager(KubeManager):
+    """KubeManager that talks to the API server directly instead of running kubectl."""
+
+    def __init__(self, module):
+        super(KubeApiManager, self).__init__(module)
+        self.api = KubeApi(module.params.get('kubeconfig'), module.params.get('server'),
+                           module.params.get('cache_dir'))
+
+    def _matching(self, action, all_namespaces=False, limit=None):
+        """Objects selected by resource/name/label, as (group_version, resource, items)."""
+        if not self.resource:
+            self.module.fail_json(msg='resource required to %s without filename' % action)
+
+        group_version, resource = self.api.resolve(self.resource)
+        namespace = None if all_namespaces else self.namespace or self.api.default_namespace
+        if self.name and namespace:
+            item = self.api.get(self.api.path(group_version, resource, namespace, self.name))
+            return group_version, resource, [item] if item else []
+
+        query = {}
+        if self.name:
+            query['fieldSelector'] = 'metadata.name=' + self.name
+        if self.label:
+            query['labelSelector'] = self.label
+        if limit:
+            query['limit'] = limit
+        items = self.api.get(self.api.path(group_version, resource, namespace), query) or {}
+        return group_version, resource, items.get('items', [])
+
+    def _apply(self, force, action):
+        if not self.filename:
+            self.module.fail_json(msg='filename required to ' + action)
+
+        return self._server_apply(self.api)
+
+    def create(self, check=True, force=True):
+        if check and self.exists():
+            return []
 
-        return self._execute(cmd)
+        return self._apply(force, 'create')
+
+    def replace(self, force=True):
+        return self._apply(force, 'reload')
+
+    def delete(self):
+        if self.module.check_mode:
+            self.changed = self.exists()
+            return []
+
+        deleted = self._delete()
+        self.changed = bool(deleted)
+        return deleted
+
+    def _delete(self):
+        deleted = []
+        if self.filename:
+            for obj in self.manifests():
+                if self.api.delete(self.api.object_path(obj, self.namespace)):
+                    deleted.append(object_ref(obj) + ' deleted')
+            return deleted
+
+        if not (self.name or self.label or self.all):
+            self.module.fail_json(msg='name, label or all required to delete %s' % self.resource)
+
+        group_version, resource, items = self._matching('delete')
+        for item in items:
+            metadata = item['metadata']
+            path = self.api.path(group_version, resource, metadata.get('namespace'), metadata['name'])
+            if self.api.delete(path):
+                ref = object_ref({'apiVersion': group_version, 'kind': resource['kind'], 'metadata': metadata})
+                deleted.append(ref + ' deleted')
+        return deleted
+
+    def exists(self):
+        if self.filename:
+            return all(self.api.get(self.api.object_path(obj, self.namespace)) is not None
+                       for obj in self.manifests())
+
+        return bool(self._matching('check', all_namespaces=self.all, limit=1)[2])
+
+    def scale(self, replicas):
+        targets = []
+        if self.filename:
+            for obj in self.manifests():
+                resource = self.api.resource_for(obj['apiVersion'], obj['kind'])
+                path = self.api.object_path(obj, self.namespace)
+                item = self.api.get(path)
+                if item is not None:
+                    targets.append((obj['apiVersion'], resource, path, item))
+        else:
+            if not (self.name or self.label or self.all):
+                self.module.fail_json(msg='name, label or all required to scale %s' % self.resource)
+            group_version, resource, items = self._matching('scale')
+            for item in items:
+                item.update(apiVersion=group_version, kind=resource['kind'])
+                path = self.api.path(group_version, resource, item['metadata'].get('namespace'),
+                                     item['metadata']['name'])
+                targets.append((group_version, resource, path, item))
+
+        result = []
+        for group_version, resource, path, item in targets:
+            ref = object_ref(item)
+            if item.get('spec', {}).get('replicas') == replicas:
+                self.objects.append({'object': ref, 'result': 'unchanged'})
+                continue
+            self.changed = True
+            if not self.module.check_mode:
+                status, _ = self.api.request('PATCH', path + '/scale', {'spec': {'replicas': replicas}},
+                                             content_type='application/merge-patch+json')
+                if status == 404:
+                    raise KubeApiError(status, '%s has no scale subresource' % ref)
+            self.objects.append({'object': ref, 'result': 'scaled'})
+            result.append(ref + ' scaled')
+        return result
 
 
 def main():
@@ -323,15 +1223,59 @@ def main():
             wait=dict(default=False, type='bool'),
             all=dict(default=False, type='bool'),
             log_level=dict(default=0, type='int'),
-            state=dict(default='present', choices=['present', 'absent', 'latest', 'reloaded', 'stopped', 'exists']),
+            state=dict(default='present', choices=['present', 'absent', 'latest', 'reloaded', 'stopped', 'scaled', 'exists']),
+            replicas=dict(type='int'),
             recursive=dict(default=False, type='bool'),
+            server_side=dict(default=False, type='bool'),
+            field_manager=dict(default='kubespray'),
+            cache_dir=dict(type='path'),
+            backend=dict(default='kubectl', choices=['kubectl', 'api']),
+            wait_for=dict(choices=['ready', 'rollout']),
+            wait_timeout=dict(default=300, type='int'),
             ),
-            mutually_exclusive=[['filename', 'list']]
+            mutually_exclusive=[['filename', 'list']],
+            required_if=[['state', 'scaled', ['replicas']]],
+            supports_check_mode=True
         )
 
-    changed = False
+    manager = None
+    try:
+        if module.params.get('backend') == 'api':
+            if not HAS_YAML:
+                module.fail_json(msg='PyYAML is required for backend=api')
+            manager = KubeApiManager(module)
+        else:
+            manager = KubeManager(module)
+        result = run_state(module, manager)
+
+        wait = digest = None
+        if manager.applied is not None:
+            digest = applied_digest(manager.applied)
+        if module.params.get('state') in ('present', 'latest', 'reloaded'):
+            if module.params.get('wait_for') and not module.check_mode:
+                wait = manager.wait_until(module.params.get('wait_for'), module.params.get('wait_timeout'))
+    except API_ERRORS as exc:
+        module.fail_json(msg=str(exc), objects=manager.objects if manager else [])
+
+    if wait and not all(w['ready'] for w in wait):
+        module.fail_json(msg='not %s: %s' % (module.params.get('wait_for'), ', '.join(
+                             '%(object)s (%(status)s)' % w for w in wait if not w['ready'])),
+                         objects=manager.objects, wait=wait)
+
+    extra = {}
+    if module._diff and manager.diff:
+        extra['diff'] = {'prepared': manager.diff}
+
+    module.exit_json(changed=manager.changed,
+                     msg='success: %s' % (' '.join(result)),
+                     objects=manager.objects,
+                     wait=wait,
+                     digest=digest,
+                     **extra
+                     )
+
 
-    manager = KubeManager(module)
+def run_state(module, manager):
     state = module.params.get('state')
     if state == 'present':
         result = manager.create(check=False)
@@ -342,23 +1286,24 @@ def main():
     elif state == 'reloaded':
         result = manager.replace()
 
+    elif state == 'scaled':
+        result = manager.scale(module.params.get('replicas'))
+
     elif state == 'stopped':
-        result = manager.stop()
+        result = manager.scale(0)
 
     elif state == 'latest':
         result = manager.replace()
 
     elif state == 'exists':
         result = manager.exists()
-        module.exit_json(changed=changed,
+        module.exit_json(changed=False,
                      msg='%s' % result)
 
     else:
         module.fail_json(msg='Unrecognized state %s.' % state)
 
-    module.exit_json(changed=changed,
-                     msg='success: %s' % (' '.join(result))
-                     )
+    return result
 
 
 from ansible.module_utils.basic import *  # noqa
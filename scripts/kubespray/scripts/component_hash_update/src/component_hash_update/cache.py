@@ -0,0 +1,47 @@
+"""
+Persistent key/value cache for the hash updater, stored as JSON lines.
+"""
+
+import json
+import threading
+from pathlib import Path
+from typing import Any
+
+
+class JsonLinesCache:
+    """
+    Append-only store: every put adds one line and the last line for a key
+    wins when the file is loaded. A line torn by an interrupted run is
+    skipped. Safe to share between the hash workers.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._data = {}
+        if self.path.exists():
+            with open(self.path) as cache_file:
+                for line in cache_file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._data[record["key"]] = record["value"]
+
+    @staticmethod
+    def _key(key: tuple) -> str:
+        return json.dumps([str(part) for part in key])
+
+    def get(self, key: tuple) -> Any:
+        with self._lock:
+            return self._data.get(self._key(key))
+
+    def put(self, key: tuple, value: Any) -> None:
+        record = {"key": self._key(key), "value": value}
+        with self._lock:
+            if self._data.get(record["key"]) == value:
+                return
+            self._data[record["key"]] = value
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a") as cache_file:
+                cache_file.write(json.dumps(record) + "\n")
@@ -11,11 +11,11 @@ import subprocess
 
 from itertools import groupby, chain
 from more_itertools import partition
-from functools import cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
-import requests
 import hashlib
-from datetime import datetime
+import json
+import time
 from ruamel.yaml import YAML
 from packaging.version import Version, InvalidVersion
 from importlib.resources import files
@@ -24,8 +24,17 @@ from pathlib import Path
 from typing import Optional, Any
 
 from . import components
+from .cache import JsonLinesCache
+from .fetch import Fetcher
 
 CHECKSUMS_YML = Path("roles/kubespray-defaults/defaults/main/checksums.yml")
+DEFAULT_CONCURRENCY = 16
+DEFAULT_LISTING_TTL = 600
+DEFAULT_CACHE = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "kubespray"
+    / "component_hash_update.jsonl"
+)
 
 logger = logging.getLogger(__name__)
 
@@ -59,10 +68,15 @@ arch_alt_name = {
 # noarch support -> k8s manifests, helm charts
 # different checksum format (needs download role changes)
 # different verification methods (gpg, cosign) ( needs download role changes) (or verify the sig in this script and only use the checksum in the playbook)
-# perf improvements (async)
 
 
-def download_hash(downloads: {str: {str: Any}}) -> None:
+def download_hash(
+    downloads: {str: {str: Any}},
+    concurrency: int = DEFAULT_CONCURRENCY,
+    cache: Optional[JsonLinesCache] = None,
+    offline: bool = False,
+    listing_ttl: int = DEFAULT_LISTING_TTL,
+) -> None:
     # Handle file with multiples hashes, with various formats.
     # the lambda is expected to produce a dictionary of hashes indexed by arch name
     download_hash_extract = {
@@ -112,20 +126,30 @@ def download_hash(downloads: {str: {str: Any}}) -> None:
     )
     logger.info("Opening checksums file %s...", checksums_file)
     data, yaml = open_yaml(checksums_file)
-    s = requests.Session()
+    fetcher = Fetcher(concurrency)
+
+    # Released artifacts never change, so a cached hash is reused as is
+    def cached(key: tuple, compute):
+        if cache is not None and (value := cache.get(key)) is not None:
+            return value
+        if offline:
+            raise LookupError(
+                f"{' '.join(map(str, key[1:-1]))} is not cached, run without --offline first"
+            )
+        value = compute()
+        if cache is not None:
+            cache.put(key, value)
+        return value
 
-    @cache
     def _get_hash_by_arch(download: str, version: str) -> {str: str}:
-
-        hash_file = s.get(
-            downloads[download]["url"].format(
-                version=version,
-                os="linux",
-            ),
-            allow_redirects=True,
+        url = downloads[download]["url"].format(
+            version=version,
+            os="linux",
+        )
+        return cached(
+            ("hashes", download, version, url),
+            lambda: download_hash_extract[download](fetcher.get(url).content.decode()),
         )
-        hash_file.raise_for_status()
-        return download_hash_extract[download](hash_file.content.decode())
 
     releases, tags = map(
         dict, partition(lambda r: r[1].get("tags", False), downloads.items())
@@ -134,24 +158,37 @@ def download_hash(downloads: {str: {str: Any}}) -> None:
         "with_releases": [r["graphql_id"] for r in releases.values()],
         "with_tags": [t["graphql_id"] for t in tags.values()],
     }
-    response = s.post(
-        "https://api.github.com/graphql",
-        json={
-            "query": files(__package__).joinpath("list_releases.graphql").read_text(),
-            "variables": repos,
-        },
-        headers={
-            "Authorization": f"Bearer {os.environ['API_KEY']}",
-        },
+    query = files(__package__).joinpath("list_releases.graphql").read_text()
+    listing_key = (
+        "releases",
+        hashlib.sha256(json.dumps([query, repos]).encode()).hexdigest(),
     )
-    if "x-ratelimit-used" in response.headers._store:
-        logger.info(
-            "Github graphQL API ratelimit status: used %s of %s. Next reset at %s",
-            response.headers["X-RateLimit-Used"],
-            response.headers["X-RateLimit-Limit"],
-            datetime.fromtimestamp(int(response.headers["X-RateLimit-Reset"])),
+    listing = cache.get(listing_key) if cache is not None else None
+    if offline:
+        if listing is None:
+            raise LookupError(
+                "release listing is not cached, run without --offline first"
+            )
+    # GitHub's GraphQL endpoint never answers 304, so the listing is only
+    # reused while it is younger than listing_ttl
+    elif listing is None or time.time() - listing.get("fetched_at", 0) >= listing_ttl:
+        response = fetcher.post(
+            "https://api.github.com/graphql",
+            json={
+                "query": query,
+                "variables": repos,
+            },
+            headers={
+                "Authorization": f"Bearer {os.environ['API_KEY']}",
+            },
         )
-    response.raise_for_status()
+        fetcher.log_rate_limit(response)
+        listing = {
+            "fetched_at": time.time(),
+            "data": response.json()["data"],
+        }
+        if cache is not None:
+            cache.put(listing_key, listing)
 
     def valid_version(possible_version: str) -> Optional[Version]:
         try:
@@ -159,7 +196,7 @@ def download_hash(downloads: {str: {str: Any}}) -> None:
         except InvalidVersion:
             return None
 
-    repos = response.json()["data"]
+    repos = listing["data"]
     github_versions = dict(
         zip(
             chain(releases.keys(), tags.keys()),
@@ -229,35 +266,56 @@ def download_hash(downloads: {str: {str: Any}}) -> None:
         if (c := component.removesuffix("_checksums")) in downloads.keys()
     }
 
-    def get_hash(component: str, version: Version, arch: str):
-        if component in download_hash_extract:
-            hashes = _get_hash_by_arch(component, version)
-            return hashes[arch]
-        else:
-            hash_file = s.get(
-                downloads[component]["url"].format(
-                    version=version,
-                    os="linux",
-                    arch=arch,
-                    alt_arch=arch_alt_name[arch],
-                ),
-                allow_redirects=True,
-            )
-            hash_file.raise_for_status()
+    def get_hash(component: str, version: Version, arch: str) -> {str: str}:
+        url = downloads[component]["url"].format(
+            version=version,
+            os="linux",
+            arch=arch,
+            alt_arch=arch_alt_name[arch],
+        )
+
+        def compute() -> str:
             if downloads[component].get("binary", False):
-                return hashlib.new(
-                    downloads[component].get("hashtype", "sha256"), hash_file.content
-                ).hexdigest()
-            return hash_file.content.decode().split()[0]
+                hashtype = downloads[component].get("hashtype", "sha256")
+                return fetcher.digest(url, hashtype, cache)
+            return fetcher.get(url).content.decode().split()[0]
 
-    for component, versions in chain(new_versions.items(), hash_set_to_0.items()):
-        c = component + "_checksums"
-        for arch in components_supported_arch[component]:
+        return {arch: cached(("hash", component, version, arch, url), compute)}
+
+    wanted = {
+        component: new_versions.get(component, set())
+        | hash_set_to_0.get(component, set())
+        for component in chain(new_versions.keys(), hash_set_to_0.keys())
+    }
+
+    # Files listing every arch are fetched once per version, the others once per arch
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        jobs = {}
+        for component, versions in wanted.items():
+            archs = components_supported_arch[component]
             for version in versions:
-                data[c][arch][
-                    str(version)
-                ] = f"{downloads[component].get('hashtype', 'sha256')}:{get_hash(component, version, arch)}"
+                if component in download_hash_extract:
+                    future = executor.submit(_get_hash_by_arch, component, version)
+                    jobs[future] = (component, version, archs)
+                else:
+                    for arch in archs:
+                        future = executor.submit(get_hash, component, version, arch)
+                        jobs[future] = (component, version, [arch])
 
+        try:
+            for future in as_completed(jobs):
+                component, version, archs = jobs[future]
+                hashes = future.result()
+                for arch in archs:
+                    data[component + "_checksums"][arch][
+                        str(version)
+                    ] = f"{downloads[component].get('hashtype', 'sha256')}:{hashes[arch]}"
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    for component in wanted:
+        c = component + "_checksums"
         data[c] = {
             arch: {
                 v: versions[v]
@@ -328,8 +386,47 @@ def main():
         help="do not obtain hashes for this component",
         default=[],
     )
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        help=f"number of downloads to run in parallel (default: {DEFAULT_CONCURRENCY})",
+        default=DEFAULT_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        help=f"JSON lines file keeping computed hashes and the release listing between runs (default: {DEFAULT_CACHE})",
+        default=DEFAULT_CACHE,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="neither read nor write the cache",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="rebuild the checksums from the cache only, without any network access",
+    )
+    parser.add_argument(
+        "--listing-ttl",
+        type=int,
+        help=f"seconds a cached release listing is reused for, 0 always fetches it (default: {DEFAULT_LISTING_TTL})",
+        default=DEFAULT_LISTING_TTL,
+    )
 
     args = parser.parse_args()
-    download_hash(
-        {k: components.infos[k] for k in (set(args.only) - set(args.exclude))}
-    )
+    if args.offline and args.no_cache:
+        parser.error("--offline needs the cache")
+    try:
+        download_hash(
+            {k: components.infos[k] for k in (set(args.only) - set(args.exclude))},
+            concurrency=args.concurrency,
+            cache=None if args.no_cache else JsonLinesCache(args.cache),
+            offline=args.offline,
+            listing_ttl=args.listing_ttl,
+        )
+    except LookupError as err:
+        # only raised by --offline for something missing from the cache
+        sys.exit(f"error: {err}")
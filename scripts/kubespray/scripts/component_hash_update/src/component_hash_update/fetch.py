@@ -0,0 +1,161 @@
+"""
+HTTP client shared by the concurrent hash workers.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .cache import JsonLinesCache
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = (10, 60)
+CHUNK_SIZE = 1 << 20
+# A rate limited request is retried at most MAX_RATE_LIMIT_RETRIES times and
+# gives up instead of pausing past MAX_RATE_LIMIT_WAIT seconds from its start
+MAX_RATE_LIMIT_RETRIES = 5
+MAX_RATE_LIMIT_WAIT = 900
+
+
+def _retry_after(value: str) -> Optional[float]:
+    """Epoch time a Retry-After header (seconds or HTTP-date) points to, None if unparseable."""
+    try:
+        return time.time() + int(value)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    # HTTP-dates are always GMT
+    return (date if date.tzinfo else date.replace(tzinfo=timezone.utc)).timestamp()
+
+
+class Fetcher:
+    """
+    One pooled requests.Session for all workers.
+
+    Connections are kept per host (github.com, the release asset CDN,
+    storage.googleapis.com, ...) and sized for the number of workers.
+    When a response says the rate limit is exhausted, every worker holds
+    off until the advertised reset time instead of hammering the API.
+    """
+
+    def __init__(self, concurrency: int):
+        retry = Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=("GET", "HEAD"),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=8, pool_maxsize=concurrency, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def _wait_for_rate_limit(self, give_up_at: float) -> bool:
+        """Sleep until the rate limit resets; False, without sleeping, when that is after give_up_at."""
+        with self._lock:
+            resume_at = self._resume_at
+        if resume_at > give_up_at:
+            return False
+        delay = resume_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def _observe(self, response: requests.Response) -> bool:
+        """Record rate limit headers; returns True when the request must be retried."""
+        limited = response.status_code in (403, 429)
+        retry_after = _retry_after(response.headers.get("Retry-After") or "")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if limited and retry_after is not None:
+            resume_at = retry_after
+        elif response.headers.get("X-RateLimit-Remaining") == "0" and reset:
+            resume_at = int(reset)
+        else:
+            return False
+
+        with self._lock:
+            if resume_at > self._resume_at:
+                logger.warning(
+                    "Rate limited by %s, pausing until %s",
+                    response.url,
+                    datetime.fromtimestamp(resume_at),
+                )
+                self._resume_at = resume_at
+        return limited
+
+    @staticmethod
+    def log_rate_limit(response: requests.Response) -> None:
+        if "X-RateLimit-Used" in response.headers:
+            logger.info(
+                "Github graphQL API ratelimit status: used %s of %s. Next reset at %s",
+                response.headers["X-RateLimit-Used"],
+                response.headers["X-RateLimit-Limit"],
+                datetime.fromtimestamp(int(response.headers["X-RateLimit-Reset"])),
+            )
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        give_up_at = time.time() + MAX_RATE_LIMIT_WAIT
+        response = None
+        for _ in range(MAX_RATE_LIMIT_RETRIES + 1):
+            if not self._wait_for_rate_limit(give_up_at):
+                break
+            response = self.session.request(
+                method, url, allow_redirects=True, timeout=TIMEOUT, **kwargs
+            )
+            if not self._observe(response):
+                response.raise_for_status()
+                return response
+            response.close()
+        raise requests.HTTPError(
+            f"{method} {url} is still rate limited, giving up", response=response
+        )
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def digest(
+        self, url: str, hashtype: str, cache: Optional[JsonLinesCache] = None
+    ) -> str:
+        """
+        Hash a download CHUNK_SIZE bytes at a time, so memory use does not
+        depend on the artifact size. With a cache, a HEAD request checks the
+        ETag first and the download is skipped when it was hashed before.
+        """
+        etag = None
+        if cache is not None:
+            try:
+                etag = self.request("HEAD", url).headers.get("ETag")
+            except requests.HTTPError:
+                pass  # not every server answers HEAD, hash the download instead
+            if etag and (digest := cache.get(("artifact", url, etag, hashtype))):
+                return digest
+
+        hasher = hashlib.new(hashtype)
+        with self.get(url, stream=True) as response:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                hasher.update(chunk)
+            etag = etag or response.headers.get("ETag")
+
+        digest = hasher.hexdigest()
+        if cache is not None and etag:
+            cache.put(("artifact", url, etag, hashtype), digest)
+        return digest
@@ -0,0 +1,204 @@
+"""download_hash with a fake Fetcher, against a checksums file in a scratch git repository."""
+
+import json
+import subprocess
+import sys
+import time
+
+import pytest
+
+from component_hash_update import download
+from component_hash_update.cache import JsonLinesCache
+
+DOWNLOADS = {
+    "crictl": {
+        "url": "https://example.com/v{version}/crictl-v{version}-{os}-{arch}.tar.gz.sha256",
+        "graphql_id": "R_crictl",
+    },
+}
+
+CHECKSUMS = """---
+crictl_checksums:
+  amd64:
+    1.30.0: 0a1b
+    1.29.0: 0
+"""
+
+LISTING = {
+    "with_releases": [
+        {
+            "releases": {
+                "nodes": [
+                    {"tagName": "v1.30.1", "isPrerelease": False},
+                    {"tagName": "v1.30.0", "isPrerelease": False},
+                ]
+            }
+        }
+    ],
+    "with_tags": [],
+}
+
+
+class FakeResponse:
+    def __init__(self, url, content=b"", data=None):
+        self.url = url
+        self.content = content
+        self.headers = {}
+        self._data = data
+
+    def json(self):
+        return {"data": self._data}
+
+
+class FakeFetcher:
+    """Answers the release listing and checksum files, counting requests."""
+
+    requests = []
+    online = True
+
+    def __init__(self, concurrency):
+        pass
+
+    def _record(self, method, url):
+        if not self.online:
+            raise AssertionError(f"{method} {url} while offline")
+        self.requests.append((method, url))
+
+    def post(self, url, **kwargs):
+        self._record("POST", url)
+        return FakeResponse(url, data=LISTING)
+
+    def get(self, url, **kwargs):
+        self._record("GET", url)
+        version = url.split("/")[3]
+        return FakeResponse(url, f"{version.encode().hex()}  crictl.tar.gz\n".encode())
+
+    @staticmethod
+    def log_rate_limit(response):
+        pass
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    subprocess.run(["git", "init", "-q", str(tmp_path)], check=True)
+    checksums = tmp_path / download.CHECKSUMS_YML
+    checksums.parent.mkdir(parents=True)
+    checksums.write_text(CHECKSUMS)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("API_KEY", "token")
+    monkeypatch.setattr(download, "Fetcher", FakeFetcher)
+    monkeypatch.setattr(FakeFetcher, "requests", [])
+    monkeypatch.setattr(FakeFetcher, "online", True)
+    return checksums
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return JsonLinesCache(tmp_path / "cache" / "hashes.jsonl")
+
+
+def reset(checksums):
+    checksums.write_text(CHECKSUMS)
+    FakeFetcher.requests.clear()
+
+
+def test_fills_in_new_and_zeroed_versions(repo, cache):
+    download.download_hash(DOWNLOADS, cache=cache)
+
+    text = repo.read_text()
+    assert "1.30.1: sha256:" + b"v1.30.1".hex() in text
+    assert "1.29.0: sha256:" + b"v1.29.0".hex() in text
+    assert [m for m, _ in FakeFetcher.requests] == ["POST", "GET", "GET"]
+
+
+def test_cached_hashes_are_not_fetched_again(repo, cache):
+    download.download_hash(DOWNLOADS, cache=cache)
+    first = repo.read_text()
+    reset(repo)
+
+    download.download_hash(DOWNLOADS, cache=JsonLinesCache(cache.path))
+    assert FakeFetcher.requests == []
+    assert repo.read_text() == first
+
+
+def test_without_cache_everything_is_fetched(repo):
+    download.download_hash(DOWNLOADS)
+    reset(repo)
+
+    download.download_hash(DOWNLOADS)
+    assert [m for m, _ in FakeFetcher.requests] == ["POST", "GET", "GET"]
+
+
+def test_listing_is_fetched_again_once_expired(repo, cache):
+    download.download_hash(DOWNLOADS, cache=cache, listing_ttl=600)
+    reset(repo)
+
+    download.download_hash(DOWNLOADS, cache=cache, listing_ttl=0)
+    assert FakeFetcher.requests == [("POST", "https://api.github.com/graphql")]
+
+
+def test_listing_age_is_taken_from_the_cache(repo, cache, monkeypatch):
+    download.download_hash(DOWNLOADS, cache=cache, listing_ttl=600)
+    reset(repo)
+
+    now = time.time()
+    monkeypatch.setattr(download.time, "time", lambda: now + 599)
+    download.download_hash(DOWNLOADS, cache=cache, listing_ttl=600)
+    assert FakeFetcher.requests == []
+
+    monkeypatch.setattr(download.time, "time", lambda: now + 601)
+    download.download_hash(DOWNLOADS, cache=cache, listing_ttl=600)
+    assert [m for m, _ in FakeFetcher.requests] == ["POST"]
+
+
+def test_offline_runs_from_the_cache(repo, cache):
+    download.download_hash(DOWNLOADS, cache=cache)
+    first = repo.read_text()
+    reset(repo)
+
+    FakeFetcher.online = False
+    download.download_hash(DOWNLOADS, cache=cache, offline=True, listing_ttl=0)
+    assert repo.read_text() == first
+
+
+def test_offline_without_listing_raises(repo, cache):
+    FakeFetcher.online = False
+    with pytest.raises(LookupError, match="release listing is not cached"):
+        download.download_hash(DOWNLOADS, cache=cache, offline=True)
+
+
+def test_offline_with_missing_hash_raises(repo, cache):
+    download.download_hash(DOWNLOADS, cache=cache)
+    reset(repo)
+    # Drop the computed hashes, keep the listing
+    lines = cache.path.read_text().splitlines()
+    cache.path.write_text(
+        "".join(f"{line}\n" for line in lines if json.loads(line)["key"].startswith('["releases"'))
+    )
+
+    FakeFetcher.online = False
+    with pytest.raises(LookupError, match=r"crictl 1\.(29\.0|30\.1) amd64 is not cached"):
+        download.download_hash(DOWNLOADS, cache=JsonLinesCache(cache.path), offline=True)
+    assert repo.read_text() == CHECKSUMS
+
+
+def test_main_reports_offline_miss_without_traceback(repo, tmp_path, monkeypatch):
+    FakeFetcher.online = False
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["update-hashes", "--offline", "--cache", str(tmp_path / "empty.jsonl"), "crictl"],
+    )
+    with pytest.raises(SystemExit) as exit_info:
+        download.main()
+    assert exit_info.value.code == (
+        "error: release listing is not cached, run without --offline first"
+    )
+
+
+def test_main_rejects_offline_without_cache(repo, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["update-hashes", "--offline", "--no-cache"])
+    with pytest.raises(SystemExit) as exit_info:
+        download.main()
+    assert exit_info.value.code == 2
+    assert "--offline needs the cache" in capsys.readouterr().err
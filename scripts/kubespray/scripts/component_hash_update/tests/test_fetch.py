@@ -0,0 +1,77 @@
+"""Fetcher rate limit handling with a fake session."""
+
+import io
+import time
+
+import pytest
+import requests
+
+from component_hash_update import fetch
+
+
+class FakeSession:
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        status, headers = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response.url = url
+        response.raw = io.BytesIO()
+        return response
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(fetch.time, "sleep", slept.append)
+    return slept
+
+
+def fetcher(session):
+    f = fetch.Fetcher(1)
+    f.session = session
+    return f
+
+
+def test_retries_after_retry_after(sleeps):
+    session = FakeSession((429, {"Retry-After": "0"}), (200, {}))
+    assert fetcher(session).get("https://example.com/a").status_code == 200
+    assert session.calls == 2
+
+
+def test_gives_up_after_max_retries(sleeps):
+    session = FakeSession((429, {"Retry-After": "0"}))
+    with pytest.raises(requests.HTTPError, match="still rate limited") as err:
+        fetcher(session).get("https://example.com/a")
+    assert session.calls == fetch.MAX_RATE_LIMIT_RETRIES + 1
+    assert err.value.response.status_code == 429
+
+
+def test_gives_up_instead_of_waiting_too_long(sleeps):
+    wait = str(fetch.MAX_RATE_LIMIT_WAIT + 60)
+    session = FakeSession((403, {"Retry-After": wait}))
+    with pytest.raises(requests.HTTPError):
+        fetcher(session).get("https://example.com/a")
+    assert session.calls == 1
+    assert sleeps == []
+
+
+def test_other_workers_do_not_wait_past_the_limit(sleeps):
+    f = fetcher(FakeSession((200, {})))
+    f._resume_at = time.time() + fetch.MAX_RATE_LIMIT_WAIT + 60
+    with pytest.raises(requests.HTTPError) as err:
+        f.get("https://example.com/a")
+    assert err.value.response is None
+    assert f.session.calls == 0
+
+
+def test_errors_without_retry_after_are_raised(sleeps):
+    session = FakeSession((404, {}))
+    with pytest.raises(requests.HTTPError):
+        fetcher(session).get("https://example.com/a")
+    assert session.calls == 1
@@ -0,0 +1,263 @@
+"""KubeApi against a fake API server serving a ConfigMap and a Deployment."""
+import importlib.util
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "kube", Path(__file__).resolve().parents[4] / "plugins" / "modules" / "kube.py")
+kube = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(kube)
+
+DISCOVERY = {
+    "/api/v1": {"resources": [
+        {"name": "configmaps", "kind": "ConfigMap", "namespaced": True, "shortNames": ["cm"]},
+    ]},
+    "/apis": {"groups": [{"name": "apps", "preferredVersion": {"groupVersion": "apps/v1"}}]},
+    "/apis/apps/v1": {"resources": [
+        {"name": "deployments", "kind": "Deployment", "namespaced": True, "shortNames": ["deploy"]},
+        {"name": "deployments/status", "kind": "Deployment", "namespaced": True},
+    ]},
+}
+
+CONFIGMAP = {
+    "apiVersion": "v1", "kind": "ConfigMap",
+    "metadata": {"name": "cm1", "namespace": "kube-system"},
+    "data": {"a": "1"},
+}
+
+DEPLOYMENT = {
+    "apiVersion": "apps/v1", "kind": "Deployment",
+    "metadata": {"name": "web", "namespace": "kube-system"},
+    "spec": {"replicas": 2},
+}
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.objects = {}
+        self.requests = []
+        # Status the fake controller reports for Deployments, in watch order
+        self.rollout = []
+        # Error events sent instead, one per watch request
+        self.watch_errors = []
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _not_found(self):
+        self._send(404, {"kind": "Status", "message": "not found", "code": 404})
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append(("GET", url.path, query))
+        if url.path in DISCOVERY:
+            return self._send(200, DISCOVERY[url.path])
+        if "watch" in query:
+            return self._watch(url.path, query)
+        if "fieldSelector" in query:
+            return self._list(url.path, query)
+        if url.path in self.server.objects:
+            return self._send(200, self.server.objects[url.path])
+        self._not_found()
+
+    def do_PATCH(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append(("PATCH", url.path, query))
+        assert self.headers["Content-Type"] == "application/apply-patch+yaml"
+        obj = self._body()
+        live = self.server.objects.get(url.path)
+        if live and all(live.get(k) == v for k, v in obj.items() if k != "metadata"):
+            return self._send(200, live)
+        obj["metadata"] = dict(obj["metadata"], resourceVersion=str(len(self.server.requests)),
+                               managedFields=[{"manager": query["fieldManager"][0]}])
+        if "dryRun" not in query:
+            self.server.objects[url.path] = obj
+        self._send(201 if live is None else 200, obj)
+
+    def do_DELETE(self):
+        self._body()
+        self.server.requests.append(("DELETE", self.path, {}))
+        if self.server.objects.pop(self.path, None) is None:
+            return self._not_found()
+        self._send(200, {"kind": "Status", "status": "Success"})
+
+    def _selected(self, collection, query):
+        name = query["fieldSelector"][0].partition("=")[2]
+        return self.server.objects.get("%s/%s" % (collection, name))
+
+    def _list(self, collection, query):
+        obj = self._selected(collection, query)
+        self._send(200, {"kind": "List", "metadata": {"resourceVersion": str(len(self.server.requests))},
+                         "items": [obj] if obj else []})
+
+    def _watch(self, collection, query):
+        obj = self._selected(collection, query)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        if self.server.watch_errors:
+            event = {"type": "ERROR", "object": self.server.watch_errors.pop(0)}
+            self.wfile.write(json.dumps(event).encode() + b"\n")
+        elif obj is not None:
+            for status in self.server.rollout or [{}]:
+                event = {"type": "MODIFIED", "object": dict(obj, status=status)}
+                self.wfile.write(json.dumps(event).encode() + b"\n")
+        self.close_connection = True
+
+
+@pytest.fixture
+def server():
+    httpd = FakeApiServer()
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def api(server, tmp_path):
+    client = kube.KubeApi(server="http://127.0.0.1:%d" % server.server_port, cache_dir=str(tmp_path))
+    yield client
+    client.close()
+
+
+def test_apply_get_and_delete(server, api):
+    applied = api.apply(CONFIGMAP, "kubespray")
+    path = "/api/v1/namespaces/kube-system/configmaps/cm1"
+    assert server.requests[-1][:2] == ("PATCH", path)
+    assert server.requests[-1][2]["fieldManager"] == ["kubespray"]
+    assert api.get(path) == applied
+
+    assert api.delete(path) is True
+    assert api.get(path) is None
+    assert api.delete(path) is False
+
+
+def test_apply_dry_run_leaves_objects_alone(server, api):
+    api.apply(CONFIGMAP, "kubespray", dry_run=True)
+    assert server.requests[-1][2]["dryRun"] == ["All"]
+    assert server.objects == {}
+
+
+def test_discovery_is_cached(server, api, tmp_path):
+    api.apply(CONFIGMAP, "kubespray")
+    api.apply(DEPLOYMENT, "kubespray")
+
+    other = kube.KubeApi(server="http://127.0.0.1:%d" % server.server_port, cache_dir=str(tmp_path))
+    count = len(server.requests)
+    other.apply(CONFIGMAP, "kubespray")
+    other.close()
+    assert [r[0] for r in server.requests[count:]] == ["PATCH"]
+
+
+def test_resolve_short_names(api):
+    group_version, resource = api.resolve("deploy")
+    assert group_version == "apps/v1"
+    assert resource["name"] == "deployments"
+
+
+def test_apply_missing_kind_raises(api):
+    with pytest.raises(kube.KubeApiError) as exc:
+        api.apply(dict(CONFIGMAP, apiVersion="example.com/v1", kind="Widget"), "kubespray")
+    assert exc.value.status == 404
+
+
+def test_server_manager_reports_unchanged(server, api):
+    manager = kube.KubeManager.__new__(kube.KubeManager)
+    manager.module = type("Module", (), {"check_mode": False})()
+    manager.namespace = None
+    manager.force = False
+    manager.field_manager = "kubespray"
+    manager.changed = False
+    manager.objects = []
+    manager._manifests = [CONFIGMAP, DEPLOYMENT]
+
+    assert len(manager._server_apply(api)) == 2
+    assert manager.changed
+
+    manager.changed = False
+    manager.objects = []
+    assert manager._server_apply(api) == []
+    assert not manager.changed
+    assert [o["result"] for o in manager.objects] == ["unchanged", "unchanged"]
+
+
+def test_wait_for_rollout(server, api):
+    api.apply(DEPLOYMENT, "kubespray")
+    server.rollout = [
+        {"observedGeneration": 1, "replicas": 2, "updatedReplicas": 1, "availableReplicas": 1},
+        {"observedGeneration": 1, "replicas": 2, "updatedReplicas": 2, "availableReplicas": 2},
+    ]
+    [result] = api.wait([DEPLOYMENT], "rollout", timeout=5)
+    assert result == {"object": "deployment.apps/web", "kind": "Deployment",
+                      "ready": True, "status": "available"}
+
+
+def test_wait_reports_stalled_rollout(server, api):
+    api.apply(DEPLOYMENT, "kubespray")
+    server.rollout = [{"conditions": [{"type": "Progressing", "status": "False",
+                                       "reason": "ProgressDeadlineExceeded"}]}]
+    [result] = api.wait([DEPLOYMENT], "rollout", timeout=5)
+    assert result["ready"] is False
+    assert result["status"] == "progress deadline exceeded"
+
+
+def watches(server):
+    return [r for r in server.requests if "watch" in r[2]]
+
+
+def test_wait_for_missing_object_backs_off(server, api):
+    [result] = api.wait([CONFIGMAP], "ready", timeout=2)
+    assert result["status"] == "not found"
+    # 0.5s, then 1s between watches that returned nothing
+    assert len(watches(server)) <= 3
+
+
+def test_wait_retries_watch_errors_after_a_delay(server, api):
+    api.apply(DEPLOYMENT, "kubespray")
+    server.rollout = [{"replicas": 2, "updatedReplicas": 2, "availableReplicas": 2}]
+    server.watch_errors = [{"kind": "Status", "code": 500, "message": "internal error"}] * 2
+    start = time.time()
+    [result] = api.wait([DEPLOYMENT], "rollout", timeout=5)
+    assert result["ready"] is True
+    assert len(watches(server)) == 3
+    assert time.time() - start >= 1.5
+
+
+def test_wait_lists_again_after_410(server, api):
+    api.apply(DEPLOYMENT, "kubespray")
+    server.rollout = [{"replicas": 2, "updatedReplicas": 2, "availableReplicas": 2}]
+    server.watch_errors = [{"kind": "Status", "code": 410, "message": "too old resource version"}]
+    [result] = api.wait([DEPLOYMENT], "rollout", timeout=5)
+    assert result["ready"] is True
+    lists = [r for r in server.requests if "fieldSelector" in r[2] and "watch" not in r[2]]
+    assert len(lists) == 2
+    assert all("resourceVersion" in w[2] for w in watches(server))
@@ -1,14 +1,16 @@
 import sys
 import time
-import requests
 import os
 import subprocess
-import yaml
 from dotenv import load_dotenv
 from pathlib import Path
-import shutil
-from ruamel.yaml import YAML
-from ruamel.yaml.scalarstring import DoubleQuotedScalarString
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import ssh_mux
+from api_client import INVENTORY_FIELDS, DashboardClient
+from group_vars import sync_group_vars
+from yaml_overrides import YamlOverrides
+from inventory import InventoryError, NodeRecord, build_inventory, write_inventory, write_keys
 
 # Load env from ../dashboard-autokube/.env
 env_path = Path(__file__).resolve().parent.parent / "dashboard-autokube" / ".env"
@@ -34,10 +36,8 @@ print(f"🔗 NEXTAUTH_URL: {nextauth_url}", flush=True)
 # Fetch cluster data
 try:
     print("🌐 Fetching cluster info from API...", flush=True)
-    headers = {"Authorization": f"Bearer {api_token}"}
-    response = requests.get(f"{nextauth_url}/api/clusters/?id={cluster_id}", headers=headers)
-    response.raise_for_status()
-    cluster_data = response.json()
+    with DashboardClient(nextauth_url, api_token) as api:
+        cluster_data = api.get_cluster(cluster_id, fields=INVENTORY_FIELDS)
     print(f"📦 Cluster info: {cluster_data}", flush=True)
 except Exception as e:
     print(f"❌ Failed to fetch cluster data: {e}", flush=True)
@@ -46,53 +46,21 @@ except Exception as e:
 # Build inventory
 inventory_dir = Path(__file__).resolve().parent / "kubespray" / "inventory" / cluster_id
 inventory_dir.mkdir( exist_ok=True)
-hosts_file = inventory_dir / "hosts.yaml"
+inventory_format = os.getenv("INVENTORY_FORMAT", "yaml")
 ssh_key_dir = inventory_dir / "keys"
 ssh_key_dir.mkdir( exist_ok=True)
 
-# 📂 Copy group_vars
+# 📂 group_vars source (synced incrementally once overrides are known)
 group_vars_src = Path(__file__).resolve().parent / "kubespray" / "inventory" / "local" / "group_vars"
 group_vars_dest = inventory_dir / "group_vars"
 
-kubespray_dir = Path(__file__).resolve().parent / "kubespray"
-
-if group_vars_src.exists():
-    if group_vars_dest.exists():
-        shutil.rmtree(group_vars_dest)
-    shutil.copytree(group_vars_src, group_vars_dest)
-    print(f"📂 group_vars copied to: {group_vars_dest}", flush=True)
-else:
-    print(f"⚠️ group_vars source folder not found: {group_vars_src}", flush=True)
-
-print(f"📁 Creating inventory at: {hosts_file}", flush=True)
+print(f"📁 Creating inventory in: {inventory_dir}", flush=True)
 
 # 📦 Update group_vars YAML files with cluster config
-group_vars_k8s = inventory_dir / "group_vars" / "k8s_cluster" / "k8s-cluster.yml"
-group_vars_addons = inventory_dir / "group_vars" / "k8s_cluster" / "addons.yml"
-kubespray_defaults = kubespray_dir / "roles" / "kubespray-defaults" / "defaults" / "main" / "download.yml"
-
-def update_yaml_file(file_path, updates):
-    if not file_path.exists():
-        print(f"⚠️ {file_path} not found, skipping update", flush=True)
-        return
-
-    yaml = YAML()
-    yaml.preserve_quotes = True
-    yaml.width = 4096  # Prevent line wrapping
-    yaml.indent(mapping=2, sequence=4, offset=2)
-
-    with open(file_path, "r") as f:
-        data = yaml.load(f) or {}
+group_vars_k8s = Path("k8s_cluster") / "k8s-cluster.yml"
+group_vars_addons = Path("k8s_cluster") / "addons.yml"
 
-    for key, value in updates.items():
-        if isinstance(value, str):
-            value = DoubleQuotedScalarString(value)  # Preserve double quotes
-        data[key] = value
-
-    with open(file_path, "w") as f:
-        yaml.dump(data, f)
-
-    print(f"✅ Updated: {file_path}", flush=True)
+overrides = YamlOverrides()
 
 
 runtime_map = {
@@ -105,24 +73,23 @@ k8s_cluster_updates = {
     "container_manager": runtime_map.get(cluster_data.get("containerRuntime", "CONTAINERD"), "containerd")
 }
 
+# 📌 Runtime versions go into this cluster's group_vars/all, which take
+# precedence over roles/kubespray-defaults, so the shared checkout stays
+# read-only and concurrent deploys never touch the same file
 container_version = cluster_data.get("containerVersion")
-download_updates = {}
+runtime_overrides = {}
 
 if container_version:
     if cluster_data.get("containerRuntime", "CONTAINERD") == "CONTAINERD":
-        download_updates = {
+        runtime_overrides[str(Path("all") / "containerd.yml")] = {
             "containerd_version": container_version
         }
     elif cluster_data.get("containerRuntime", "CONTAINERD") == "DOCKER":
-        download_updates = {
+        runtime_overrides[str(Path("all") / "docker.yml")] = {
             "cri_dockerd_version": container_version
         }
-if download_updates:
-    update_yaml_file(kubespray_defaults, download_updates)
 
 
-update_yaml_file(group_vars_k8s, k8s_cluster_updates)
-
 # ➕ Update addons in addons.yml
 cluster_config = cluster_data.get("clusterConfig", {})
 addons_updates = {
@@ -163,91 +130,49 @@ if addons_updates["local_path_provisioner_enabled"]:
     addons_updates["local_path_provisioner_helper_image_repo"] = lp.get("helperImageRepo", "busybox")
     addons_updates["local_path_provisioner_helper_image_tag"] = lp.get("helperImageTag", "latest")
 
+if group_vars_src.exists():
+    changed = sync_group_vars(group_vars_src, group_vars_dest, {
+        str(group_vars_k8s): k8s_cluster_updates,
+        str(group_vars_addons): addons_updates,
+        **runtime_overrides,
+    }, overrides.apply_all)
+    print(f"📂 group_vars synced to {group_vars_dest} ({len(changed)} files changed)", flush=True)
+else:
+    print(f"⚠️ group_vars source folder not found: {group_vars_src}", flush=True)
 
-update_yaml_file(group_vars_addons, addons_updates)
-
-
-
-all_hosts = {}
-children = {
-    "kube_control_plane": {"hosts": {}},
-    "kube_node": {"hosts": {}},
-    "etcd": {"hosts": {}},
-    "k8s_cluster": {"children": {"kube_control_plane": {}, "kube_node": {}}},
-    "calico_rr": {"hosts": {}},
-}
-
-role_counters = {}
-
-for node in cluster_data.get("nodes", []):
-    role = node.get("role", "worker").lower()
-    role_key = "master" if role == "master" else "worker"
-    role_counters.setdefault(role_key, 0)
-    role_counters[role_key] += 1
-    name = f"{role_key}{role_counters[role_key]}"
-    name = node["hostname"]
-
-
-    ip = node["ipAddress"]
-    user = node["username"]
-    auth_type = node.get("authType")
-    host_entry = {
-        "ip": ip,
-        "access_ip": ip,
-        "ansible_host": ip,
-        "ansible_user": user
-    }
-
-    if auth_type == "PASSWORD":
-        password = node["password"]
-        host_entry["ansible_ssh_pass"] = password
-        host_entry["ansible_become_password"] = password
-    elif auth_type == "SSH_KEY":
-        ssh_key = node.get("sshKey")
-        if not ssh_key:
-            print(f"❌ Missing sshKey for node {name}", flush=True)
-            sys.exit(1)
-        key_path = ssh_key_dir / f"{name}_id_rsa"
-        with open(key_path, "w") as kf:
-            kf.write(ssh_key)
-        os.chmod(key_path, 0o600)
-        host_entry["ansible_ssh_private_key_file"] = str(key_path)
-        host_entry["ansible_become"] = True
-    else:
-        print(f"❌ Unknown authType '{auth_type}' for node {name}", flush=True)
-        sys.exit(1)
-
-    all_hosts[name] = host_entry
 
-    if role_key == "master":
-        children["kube_control_plane"]["hosts"][name] = {}
-        children["etcd"]["hosts"][name] = {}
-    else:
-        children["kube_node"]["hosts"][name] = {}
-
-# Final structure
-inventory = {
-    "all": {
-        "hosts": all_hosts,
-        "children": children,
-    }
-}
+# 🧱 Build inventory
+try:
+    node_records = [NodeRecord.from_api(node) for node in cluster_data.get("nodes", [])]
+    inventory = build_inventory(
+        node_records,
+        ssh_key_dir,
+        # 🔁 Reuse the preflight's SSH ControlMaster sockets in every Ansible task
+        all_vars=ssh_mux.ansible_vars(cluster_id),
+    )
+    write_keys(node_records, ssh_key_dir)
+    hosts_file = write_inventory(inventory, inventory_dir, inventory_format)
+except (InventoryError, KeyError) as e:
+    print(f"❌ Invalid cluster nodes: {e}", flush=True)
+    sys.exit(1)
 
-# Write YAML
-with open(hosts_file, "w") as f:
-    yaml.dump(inventory, f, default_flow_style=False)
+print(f"✅ {hosts_file.name} generated successfully!", flush=True)
 
-print("✅ hosts.yaml generated successfully!", flush=True)
+# 🔗 Dynamic inventory entry point for scale/upgrade playbooks
+dynamic_inventory = inventory_dir / "inventory.py"
+if not dynamic_inventory.is_symlink():
+    dynamic_inventory.symlink_to(os.path.relpath(Path(__file__).resolve().parent / "dynamic_inventory.py", inventory_dir))
 
 # 🔌 Run ansible ping to validate connectivity
 # 🔒 Function to test SSH per node
 def test_ssh_connection(ip, user, password=None, key_path=None):
+    mux_opts = ssh_mux.control_options(cluster_id)
     if key_path:
-        ssh_cmd = ["ssh", "-i", str(key_path), "-o", "StrictHostKeyChecking=no", f"{user}@{ip}", "echo SSH_OK"]
+        ssh_cmd = ["ssh", "-i", str(key_path), "-o", "StrictHostKeyChecking=no", *mux_opts, f"{user}@{ip}", "echo SSH_OK"]
     elif password:
-        ssh_cmd = ["sshpass", "-p", password, "ssh", "-o", "StrictHostKeyChecking=no", "-o", "PreferredAuthentications=password", f"{user}@{ip}", "echo SSH_OK"]
+        ssh_cmd = ["sshpass", "-p", password, "ssh", "-o", "StrictHostKeyChecking=no", "-o", "PreferredAuthentications=password", *mux_opts, f"{user}@{ip}", "echo SSH_OK"]
     else:
-        ssh_cmd = ["ssh", "-o", "StrictHostKeyChecking=no", f"{user}@{ip}", "echo SSH_OK"]
+        ssh_cmd = ["ssh", "-o", "StrictHostKeyChecking=no", *mux_opts, f"{user}@{ip}", "echo SSH_OK"]
 
     try:
         result = subprocess.run(ssh_cmd, check=True, capture_output=True, text=True, timeout=10)
@@ -257,28 +182,41 @@ def test_ssh_connection(ip, user, password=None, key_path=None):
     except Exception as ex:
         return False, str(ex)
 
-# 🔍 Test SSH connection for each node before ansible
-print("🔍 Testing raw SSH connection to all nodes...", flush=True)
-try:
-    for node in cluster_data.get("nodes", []):
-        hostname = node["hostname"]
-        ip = node["ipAddress"]
-        user = node["username"]
-        auth_type = node.get("authType")
-        password = node.get("password")
-        key_path = None
-
-        if auth_type == "SSH_KEY":
-            key_path = ssh_key_dir / f"{hostname}_id_rsa"
-
-        success, output = test_ssh_connection(ip, user, password, key_path)
+# 🔍 Test SSH connection for each node before ansible (in parallel)
+preflight_workers = max(1, int(os.getenv("SSH_PREFLIGHT_WORKERS", "16")))
+
+
+def preflight_node(node):
+    key_path = node.key_path(ssh_key_dir) if node.auth_type == "SSH_KEY" else None
+
+    started = time.monotonic()
+    success, output = test_ssh_connection(node.ip, node.user, node.password, key_path)
+    return node.hostname, node.ip, success, output, time.monotonic() - started
+
+
+print(f"🔍 Testing raw SSH connection to {len(node_records)} nodes ({preflight_workers} workers)...", flush=True)
+
+preflight_results = []
+with ThreadPoolExecutor(max_workers=min(preflight_workers, len(node_records)) or 1) as pool:
+    futures = [pool.submit(preflight_node, node) for node in node_records]
+    for future in as_completed(futures):
+        hostname, ip, success, output, elapsed = future.result()
+        preflight_results.append((hostname, ip, success, output, elapsed))
         if success:
-            print(f"✅ SSH to {hostname} ({ip}) succeeded: {output}", flush=True)
+            print(f"✅ SSH to {hostname} ({ip}) succeeded in {elapsed:.2f}s: {output}", flush=True)
         else:
-            print(f"❌ SSH to {hostname} ({ip}) failed: {output}", flush=True)
-            sys.exit(1)
-except subprocess.CalledProcessError as e:
-    print("❌ Ansible ssh failed:\n", e.stderr, flush=True)
+            print(f"❌ SSH to {hostname} ({ip}) failed after {elapsed:.2f}s: {output}", flush=True)
+
+# 📊 Per-node latency summary, slowest first
+print("📊 SSH preflight summary:", flush=True)
+for hostname, ip, success, _, elapsed in sorted(preflight_results, key=lambda r: r[4], reverse=True):
+    status = "OK" if success else "FAILED"
+    print(f"   {hostname:<24} {ip:<16} {status:<7} {elapsed:6.2f}s", flush=True)
+
+failed = [r for r in preflight_results if not r[2]]
+if failed:
+    print(f"❌ SSH preflight failed for {len(failed)}/{len(preflight_results)} nodes: "
+          f"{', '.join(r[0] for r in failed)}", flush=True)
     sys.exit(1)
 
 print("✅ Script completed!", flush=True)
@@ -0,0 +1,37 @@
+"""
+Per-cluster SSH connection multiplexing shared by every deploy stage.
+
+The SSH preflight in myscript.py, every kubespray task and the application
+installer all connect through the same ControlMaster sockets, so only the
+first connection to a node pays for the TCP and key-exchange handshake.
+"""
+import os
+from pathlib import Path
+
+CONTROL_ROOT = Path(os.getenv("SSH_CONTROL_DIR", "/tmp/autokube-ssh"))
+CONTROL_PERSIST = os.getenv("SSH_CONTROL_PERSIST", "30m")
+
+
+def control_dir(cluster_id):
+    path = CONTROL_ROOT / cluster_id
+    path.mkdir(parents=True, exist_ok=True, mode=0o700)
+    return path
+
+
+def control_options(cluster_id):
+    # %C is a hash of local host, remote host, port and user, so Ansible and
+    # the plain ssh calls resolve to the same socket for a given node
+    return [
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={control_dir(cluster_id)}/%C",
+        "-o", f"ControlPersist={CONTROL_PERSIST}",
+    ]
+
+
+def ansible_vars(cluster_id):
+    # Ansible only adds its own ControlPath (from control_path) when none of
+    # ssh_args and the common args set one, so the ControlPath in the common
+    # args is the socket every task uses
+    return {
+        "ansible_ssh_common_args": " ".join(control_options(cluster_id)),
+    }
@@ -0,0 +1,169 @@
+"""
+Content-hashed virtualenv for the deploy pipeline.
+
+The venv is keyed on the hash of kubespray's requirements.txt plus the
+interpreter version, built once under scripts/.venvs/<key> and exposed as
+scripts/venv. Runs whose key matches an existing, completed venv skip
+dependency installation entirely. Apart from the current one, only the
+AUTOKUBE_VENV_KEEP (default 2) most recently used venvs are kept, and never
+one a running deploy holds a shared lock on (.venvs/<key>.lock).
+
+Usage:
+    python3 venv_manager.py [--wheelhouse DIR] [--prewarm]
+
+--wheelhouse (or AUTOKUBE_WHEELHOUSE) installs from a local wheel cache
+with --no-index, for hosts without access to PyPI. --prewarm fills that
+cache from PyPI instead of building a venv.
+"""
+import argparse
+import fcntl
+import hashlib
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import venv
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+REQUIREMENTS = SCRIPTS_DIR / "kubespray" / "requirements.txt"
+VENVS_DIR = SCRIPTS_DIR / ".venvs"
+VENV_LINK = SCRIPTS_DIR / "venv"
+STAMP_FILE = ".autokube-stamp"
+LINK_LOCK = VENVS_DIR / "link.lock"
+KEEP = int(os.getenv("AUTOKUBE_VENV_KEEP", "2"))
+
+
+def env_key(requirements=REQUIREMENTS):
+    digest = hashlib.sha256()
+    digest.update(requirements.read_bytes())
+    digest.update(f"{sys.implementation.name}-{platform.python_version()}-{platform.machine()}".encode())
+    return digest.hexdigest()[:16]
+
+
+def is_ready(venv_dir, key):
+    stamp = venv_dir / STAMP_FILE
+    return stamp.exists() and stamp.read_text().strip() == key
+
+
+def pip_install_args(requirements, wheelhouse=None):
+    args = ["install", "--disable-pip-version-check", "-r", str(requirements)]
+    if wheelhouse:
+        args += ["--no-index", "--find-links", str(wheelhouse)]
+    return args
+
+
+def build(venv_dir, key, requirements, wheelhouse=None):
+    if venv_dir.exists():
+        # Left over from an interrupted build
+        shutil.rmtree(venv_dir)
+
+    print(f"📦 Creating virtual environment {venv_dir}...", flush=True)
+    venv.create(venv_dir, with_pip=True)
+
+    print(f"📦 Installing {requirements}" + (f" from {wheelhouse}" if wheelhouse else "") + "...", flush=True)
+    subprocess.run([str(venv_dir / "bin" / "python"), "-m", "pip", *pip_install_args(requirements, wheelhouse)], check=True)
+
+    # Only a fully installed venv is stamped, so a crash mid-install rebuilds
+    (venv_dir / STAMP_FILE).write_text(key + "\n")
+
+
+def link(venv_dir):
+    """Point scripts/venv at venv_dir; callers hold LINK_LOCK."""
+    if VENV_LINK.is_symlink() and VENV_LINK.resolve() == venv_dir.resolve():
+        return
+
+    legacy = None
+    if VENV_LINK.exists() and not VENV_LINK.is_symlink():
+        # Unmanaged venv from before the hashed layout; os.replace can't
+        # swap a directory for a symlink, so move it out of the way first
+        legacy = VENVS_DIR / f"legacy-{os.getpid()}"
+        os.replace(VENV_LINK, legacy)
+
+    tmp_link = VENV_LINK.with_name(f".venv-link-{os.getpid()}")
+    tmp_link.unlink(missing_ok=True)
+    tmp_link.symlink_to(venv_dir.relative_to(SCRIPTS_DIR))
+    os.replace(tmp_link, VENV_LINK)
+
+    if legacy:
+        shutil.rmtree(legacy)
+
+
+def prune(current, keep=KEEP):
+    """Remove old venvs, keeping current and the `keep` most recently used others."""
+    others = [
+        path for path in VENVS_DIR.iterdir()
+        if path.is_dir() and path != current and (path / STAMP_FILE).exists()
+    ]
+    others.sort(key=lambda path: (path / STAMP_FILE).stat().st_mtime, reverse=True)
+    for path in others[keep:]:
+        with open(VENVS_DIR / f"{path.name}.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # being rebuilt, or in use by a running deploy
+            print(f"🧹 Removing old virtual environment {path.name}", flush=True)
+            shutil.rmtree(path)
+
+
+def ensure_venv(requirements=REQUIREMENTS, wheelhouse=None):
+    key = env_key(requirements)
+    venv_dir = VENVS_DIR / key
+    VENVS_DIR.mkdir(exist_ok=True)
+
+    if is_ready(venv_dir, key):
+        print(f"✅ Virtual environment up to date ({key})", flush=True)
+    else:
+        # Concurrent deploys wait for a single build of the same key
+        with open(VENVS_DIR / f"{key}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if is_ready(venv_dir, key):
+                print(f"✅ Virtual environment built by another deploy ({key})", flush=True)
+            else:
+                build(venv_dir, key, requirements, wheelhouse)
+                print(f"📦 Dependencies installed ({key})", flush=True)
+
+    # The stamp's mtime records when a venv was last used, for prune()
+    (venv_dir / STAMP_FILE).touch()
+    with open(LINK_LOCK, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        link(venv_dir)
+        prune(venv_dir)
+    return venv_dir
+
+
+def prewarm(requirements, wheelhouse):
+    wheelhouse.mkdir(parents=True, exist_ok=True)
+    print(f"📦 Downloading wheels for {requirements} into {wheelhouse}...", flush=True)
+    subprocess.run(
+        [sys.executable, "-m", "pip", "wheel", "--disable-pip-version-check",
+         "-r", str(requirements), "-w", str(wheelhouse)],
+        check=True,
+    )
+    print("✅ Wheel cache ready", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create or reuse the deploy virtualenv")
+    parser.add_argument("--requirements", type=Path, default=REQUIREMENTS)
+    parser.add_argument("--wheelhouse", type=Path, default=os.getenv("AUTOKUBE_WHEELHOUSE") or None,
+                        help="install from this local wheel cache instead of PyPI")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="populate --wheelhouse from PyPI and exit")
+    args = parser.parse_args()
+
+    try:
+        if args.prewarm:
+            if not args.wheelhouse:
+                parser.error("--prewarm requires --wheelhouse or AUTOKUBE_WHEELHOUSE")
+            prewarm(args.requirements, args.wheelhouse)
+        else:
+            ensure_venv(args.requirements, args.wheelhouse)
+    except subprocess.CalledProcessError as e:
+        print(f"❌ {' '.join(map(str, e.cmd))} failed (code {e.returncode})", flush=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Batched, round-trip YAML override engine.
+
+All patches go through one configured ruamel instance. Each target file is
+parsed once, patched in memory and written back atomically, and only when
+the rendered content actually differs from what is on disk.
+"""
+import io
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from ruamel.yaml import YAML
+from ruamel.yaml.scalarstring import DoubleQuotedScalarString, ScalarString
+
+
+class YamlOverrides:
+    def __init__(self):
+        self.yaml = YAML()
+        self.yaml.preserve_quotes = True
+        self.yaml.width = 4096  # Prevent line wrapping
+        self.yaml.indent(mapping=2, sequence=4, offset=2)
+
+    @staticmethod
+    def _coerce(old, new):
+        if isinstance(new, str) and not isinstance(new, ScalarString):
+            # Keep the scalar style already used for this key; new keys get double quotes
+            if isinstance(old, ScalarString):
+                return type(old)(new)
+            if isinstance(old, str):
+                return new
+            return DoubleQuotedScalarString(new)
+        return new
+
+    def apply(self, file_path, updates):
+        """Patch one file; returns True when it was rewritten."""
+        file_path = Path(file_path)
+        if not file_path.exists():
+            print(f"⚠️ {file_path} not found, skipping update", flush=True)
+            return False
+
+        original = file_path.read_text()
+        self.yaml.explicit_start = original.lstrip().startswith("---")
+        data = self.yaml.load(original) or {}
+
+        for key, value in updates.items():
+            data[key] = self._coerce(data.get(key), value)
+
+        out = io.StringIO()
+        self.yaml.dump(data, out)
+        rendered = out.getvalue()
+
+        if rendered == original:
+            print(f"✔️ Unchanged: {file_path}", flush=True)
+            return False
+
+        fd, tmp = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(rendered)
+            shutil.copymode(file_path, tmp)
+            os.replace(tmp, file_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        print(f"✅ Updated: {file_path}", flush=True)
+        return True
+
+    def apply_all(self, patches):
+        """Apply ``{path: updates}``; returns the paths that were rewritten."""
+        return [path for path, updates in patches.items() if updates and self.apply(path, updates)]